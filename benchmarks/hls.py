@@ -0,0 +1,138 @@
+"""
+Benchmark the HLS playlist scanner against m3u8
+
+Compares utils.hls with m3u8.loads on a master playlist with a large
+bitrate ladder, alternate audio and subtitles, and on an ad-stitched
+media playlist shaped like the ones served by Pluto.
+
+Usage:
+    python -m benchmarks.hls [--variants 60] [--segments 3000] [--runs 20]
+"""
+from __future__ import annotations
+
+import argparse
+import time
+
+import m3u8
+
+from utils.hls import iter_segments, scan_master
+
+LADDER = ((416, 234), (640, 360), (768, 432), (960, 540), (1280, 720), (1920, 1080))
+ADS = ("Pluto_TV_OandO", "_ad/", "/creative/", "Bumper", "Promo/", "WarningCard")
+
+
+def build_master(variants: int) -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:6", "#EXT-X-INDEPENDENT-SEGMENTS"]
+    for lang in ("en", "es", "fr", "de"):
+        lines.append(
+            f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aac",LANGUAGE="{lang}",NAME="{lang}",'
+            f'DEFAULT={"YES" if lang == "en" else "NO"},AUTOSELECT=YES,CHANNELS="2",'
+            f'URI="audio/{lang}/index.m3u8"'
+        )
+        lines.append(
+            f'#EXT-X-MEDIA:TYPE=SUBTITLES,GROUP-ID="subs",LANGUAGE="{lang}",NAME="{lang}",'
+            f'DEFAULT=NO,AUTOSELECT=YES,URI="subs/{lang}/index.m3u8"'
+        )
+    for i in range(variants):
+        width, height = LADDER[i % len(LADDER)]
+        bandwidth = 300000 + i * 150000
+        lines.append(
+            f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},AVERAGE-BANDWIDTH={bandwidth - 50000},"
+            f'RESOLUTION={width}x{height},FRAME-RATE=29.970,CODECS="avc1.640028,mp4a.40.2",'
+            f'AUDIO="aac",SUBTITLES="subs",CLOSED-CAPTIONS=NONE'
+        )
+        lines.append(f"video/{height}p_{bandwidth}/index.m3u8")
+    return "\n".join(lines) + "\n"
+
+
+def build_stitched(segments: int) -> str:
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:7", "#EXT-X-MEDIA-SEQUENCE:0"]
+    for i in range(segments):
+        # Content with an ad break every 60 segments, like stitched VOD playlists
+        if i % 60 == 0 and i:
+            lines.append("#EXT-X-DISCONTINUITY")
+            for n in range(5):
+                lines.append("#EXTINF:6.000,")
+                lines.append(
+                    f"https://siloh.pluto.tv/{ADS[n % len(ADS)]}/clip_{i}_{n}/hls_3-{n}.ts"
+                )
+            lines.append("#EXT-X-DISCONTINUITY")
+        lines.append("#EXTINF:6.006,")
+        lines.append(
+            f"https://siloh.pluto.tv/main/60d0cafe/hls/hls_3-{i}.ts"
+        )
+    lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+
+def master_m3u8(text: str) -> tuple:
+    playlists = m3u8.loads(text).playlists
+    return sorted({x.stream_info.resolution[1] for x in playlists}, reverse=True)
+
+
+def master_scanner(text: str) -> tuple:
+    return scan_master(text).heights
+
+
+def segment_m3u8(text: str) -> str:
+    segment = None
+    for seg in m3u8.loads(text).segments:
+        if not any(ad in seg.uri for ad in ADS):
+            segment = seg.uri
+    return segment
+
+
+def segment_scanner(text: str) -> str:
+    segment = None
+    for uri in iter_segments(text):
+        if not any(ad in uri for ad in ADS):
+            segment = uri
+    return segment
+
+
+def measure(func: callable, text: str, runs: int) -> tuple:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func(text)
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def compare(label: str, text: str, runs: int, *funcs: callable) -> None:
+    print(f"{label} ({len(text) / 1024:.0f} KiB)")
+    results = []
+    for name, func in funcs:
+        result, best = measure(func, text, runs)
+        results.append(result)
+        print(f"  {name:<10} {best * 1000:>9.2f} ms")
+
+    if any(x != results[0] for x in results):
+        raise SystemExit(f"Results disagree: {results}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--variants", type=int, default=60)
+    parser.add_argument("--segments", type=int, default=3000)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    compare(
+        f"Master playlist, {args.variants} variants",
+        build_master(args.variants),
+        args.runs,
+        ("m3u8", master_m3u8),
+        ("utils.hls", master_scanner),
+    )
+    compare(
+        f"Stitched media playlist, {args.segments} segments",
+        build_stitched(args.segments),
+        args.runs,
+        ("m3u8", segment_m3u8),
+        ("utils.hls", segment_scanner),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""
+Local mock streaming service
+
+Serves a catalog, clear DASH or HLS manifests, segments and subtitles in
+the shape of a real service, for services/mock to download from without
+any network access. Every response waits `latency` seconds before the first
+byte, and all responses share one link of `bandwidth` bytes per second, so
+sequential and parallel downloads compete the way they would at home.
+
+Routes:
+    /api/series/<slug>                   catalog of seasons and episodes
+    /dash/<episode>.mpd                  single-period DASH manifest
+    /hls/<episode>/master.m3u8           HLS master playlist
+    /hls/<episode>/<track>.m3u8          HLS media playlist
+    /segments/<episode>/<track>/init.mp4
+    /segments/<episode>/<track>/<n>.m4s
+    /subtitles/<episode>.vtt
+
+Usage:
+    python -m benchmarks.mock.server [--port 8790] [--latency 0.02] [--bandwidth 50]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHUNK = 64 * 1024
+LADDER = ((1920, 1080, 5000000), (1280, 720, 3000000), (640, 360, 800000))
+AUDIO_BANDWIDTH = 128000
+INIT_SIZE = 1024
+CUE = "{start} --> {end}\nLine {n} of the mock subtitles.\n\n"
+
+
+class Throttle:
+    """Token bucket shared by all connections, a rate of 0 means unlimited"""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.available = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, size: int) -> None:
+        if not self.rate:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            # At most a second's worth of burst
+            self.available = min(self.rate, self.available + (now - self.updated) * self.rate)
+            self.updated = now
+            self.available -= size
+            wait = -self.available / self.rate if self.available < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Catalog:
+    def __init__(
+        self,
+        seasons: int = 2,
+        episodes: int = 5,
+        segments: int = 30,
+        segment_size: int = 256 * 1024,
+        segment_duration: int = 4,
+        protocol: str = "dash",
+    ) -> None:
+        self.seasons = seasons
+        self.episodes = episodes
+        self.segments = segments
+        self.segment_size = segment_size
+        self.segment_duration = segment_duration
+        self.protocol = protocol
+        self.payloads = {}
+
+    @property
+    def duration(self) -> int:
+        return self.segments * self.segment_duration
+
+    def episode_ids(self) -> list:
+        return [
+            f"s{season:02}e{number:02}"
+            for season in range(1, self.seasons + 1)
+            for number in range(1, self.episodes + 1)
+        ]
+
+    def manifest_url(self, base: str, episode: str) -> str:
+        if self.protocol == "hls":
+            return f"{base}/hls/{episode}/master.m3u8"
+        return f"{base}/dash/{episode}.mpd"
+
+    def series(self, base: str, slug: str) -> dict:
+        return {
+            "id": slug,
+            "title": slug.replace("-", " ").title(),
+            "year": 2020,
+            "seasons": [
+                {
+                    "number": season,
+                    "episodes": [
+                        {
+                            "id": f"s{season:02}e{number:02}",
+                            "number": number,
+                            "title": f"Chapter {season * 100 + number}",
+                            "manifest": self.manifest_url(base, f"s{season:02}e{number:02}"),
+                            "subtitles": f"{base}/subtitles/s{season:02}e{number:02}.vtt",
+                        }
+                        for number in range(1, self.episodes + 1)
+                    ],
+                }
+                for season in range(1, self.seasons + 1)
+            ],
+        }
+
+    def mpd(self, base: str, episode: str) -> str:
+        segments = f"{base}/segments/{episode}"
+        videos = "\n".join(
+            f'      <Representation id="video-{h}" bandwidth="{b}" width="{w}" height="{h}" '
+            f'codecs="avc1.640028" frameRate="25"/>'
+            for w, h, b in LADDER
+        )
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT{self.duration}S" minBufferTime="PT2S" profiles="urn:mpeg:dash:profile:isoff-live:2011">
+  <Period id="0" start="PT0S">
+    <AdaptationSet contentType="video" mimeType="video/mp4" segmentAlignment="true">
+      <SegmentTemplate timescale="1" duration="{self.segment_duration}" startNumber="1" media="{segments}/$RepresentationID$/$Number$.m4s" initialization="{segments}/$RepresentationID$/init.mp4"/>
+{videos}
+    </AdaptationSet>
+    <AdaptationSet contentType="audio" mimeType="audio/mp4" lang="en">
+      <SegmentTemplate timescale="1" duration="{self.segment_duration}" startNumber="1" media="{segments}/$RepresentationID$/$Number$.m4s" initialization="{segments}/$RepresentationID$/init.mp4"/>
+      <Representation id="audio-en" bandwidth="{AUDIO_BANDWIDTH}" codecs="mp4a.40.2" audioSamplingRate="48000"/>
+    </AdaptationSet>
+  </Period>
+</MPD>
+"""
+
+    def master(self, base: str, episode: str) -> str:
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:6",
+            f'#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aac",LANGUAGE="en",NAME="English",DEFAULT=YES,'
+            f'AUTOSELECT=YES,URI="{base}/hls/{episode}/audio-en.m3u8"',
+        ]
+        for w, h, b in LADDER:
+            lines.append(
+                f'#EXT-X-STREAM-INF:BANDWIDTH={b + AUDIO_BANDWIDTH},RESOLUTION={w}x{h},'
+                f'CODECS="avc1.640028,mp4a.40.2",AUDIO="aac"'
+            )
+            lines.append(f"{base}/hls/{episode}/video-{h}.m3u8")
+        return "\n".join(lines) + "\n"
+
+    def media(self, base: str, episode: str, track: str) -> str:
+        segments = f"{base}/segments/{episode}/{track}"
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:7",
+            f"#EXT-X-TARGETDURATION:{self.segment_duration}",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+            f'#EXT-X-MAP:URI="{segments}/init.mp4"',
+        ]
+        for n in range(1, self.segments + 1):
+            lines.append(f"#EXTINF:{self.segment_duration:.3f},")
+            lines.append(f"{segments}/{n}.m4s")
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def subtitles(self) -> str:
+        cues = []
+        for n in range(self.duration // 2):
+            start, end = n * 2, n * 2 + 1.5
+            cues.append(CUE.format(start=timestamp(start), end=timestamp(end), n=n + 1))
+        return "WEBVTT\n\n" + "".join(cues)
+
+    def segment(self, track: str) -> bytes:
+        # Audio segments are smaller, in proportion to the bitrate
+        size = self.segment_size
+        if track.startswith("audio"):
+            size = max(1024, size * AUDIO_BANDWIDTH // LADDER[0][2])
+
+        payload = self.payloads.get(size)
+        if payload is None:
+            payload = self.payloads[size] = bytes(size)
+        return payload
+
+
+def timestamp(seconds: float) -> str:
+    h, rest = divmod(seconds, 3600)
+    m, s = divmod(rest, 60)
+    return f"{int(h):02}:{int(m):02}:{s:06.3f}"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: MockServer
+
+    def base(self) -> str:
+        return f"http://{self.headers.get('Host') or self.server.address}"
+
+    def send(self, body: bytes, content_type: str, counted: bool = False) -> None:
+        time.sleep(self.server.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+
+        view = memoryview(body)
+        for start in range(0, len(body), CHUNK):
+            chunk = view[start : start + CHUNK]
+            self.server.throttle.take(len(chunk))
+            self.wfile.write(chunk)
+        self.server.count(len(body), counted)
+
+    def not_found(self) -> None:
+        body = b'{"error": "Not found"}'
+        self.send_response(404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        catalog = self.server.catalog
+        base = self.base()
+        path = self.path.split("?")[0]
+
+        if match := re.fullmatch(r"/api/series/([\w-]+)", path):
+            body = json.dumps(catalog.series(base, match.group(1))).encode("utf-8")
+            return self.send(body, "application/json")
+        if match := re.fullmatch(r"/dash/(\w+)\.mpd", path):
+            return self.send(catalog.mpd(base, match.group(1)).encode("utf-8"), "application/dash+xml")
+        if match := re.fullmatch(r"/hls/(\w+)/master\.m3u8", path):
+            body = catalog.master(base, match.group(1)).encode("utf-8")
+            return self.send(body, "application/vnd.apple.mpegurl")
+        if match := re.fullmatch(r"/hls/(\w+)/([\w-]+)\.m3u8", path):
+            body = catalog.media(base, match.group(1), match.group(2)).encode("utf-8")
+            return self.send(body, "application/vnd.apple.mpegurl")
+        if match := re.fullmatch(r"/segments/\w+/([\w-]+)/init\.mp4", path):
+            return self.send(bytes(INIT_SIZE), "video/mp4", counted=True)
+        if match := re.fullmatch(r"/segments/\w+/([\w-]+)/(\d+)\.m4s", path):
+            if not 1 <= int(match.group(2)) <= catalog.segments:
+                return self.not_found()
+            return self.send(catalog.segment(match.group(1)), "video/iso.segment", counted=True)
+        if re.fullmatch(r"/subtitles/\w+\.vtt", path):
+            return self.send(catalog.subtitles().encode("utf-8"), "text/vtt", counted=True)
+
+        self.not_found()
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        catalog: Catalog,
+        host: str = "127.0.0.1",
+        port: int = 8790,
+        latency: float = 0.0,
+        bandwidth: float = 0,
+    ) -> None:
+        super().__init__((host, port), MockHandler)
+        self.catalog = catalog
+        self.latency = latency
+        self.throttle = Throttle(bandwidth)
+        self.address = f"{host}:{self.server_address[1]}"
+        # Media bytes served, manifests and the catalog aren't counted
+        self.bytes = 0
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def count(self, size: int, media: bool) -> None:
+        with self.lock:
+            self.requests += 1
+            if media:
+                self.bytes += size
+
+    def reset(self) -> None:
+        with self.lock:
+            self.bytes = 0
+            self.requests = 0
+
+    def start(self) -> MockServer:
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--protocol", choices=("dash", "hls"), default="dash")
+    parser.add_argument("--seasons", type=int, default=2)
+    parser.add_argument("--episodes", type=int, default=5)
+    parser.add_argument("--segments", type=int, default=30)
+    parser.add_argument("--segment-size", type=int, default=256 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before the first byte")
+    parser.add_argument("--bandwidth", type=float, default=0, help="Link speed in MB/s, 0 for unlimited")
+    args = parser.parse_args()
+
+    catalog = Catalog(
+        args.seasons, args.episodes, args.segments, args.segment_size, protocol=args.protocol
+    )
+    server = MockServer(
+        catalog, port=args.port, latency=args.latency, bandwidth=args.bandwidth * 1024 * 1024
+    )
+    print(f"Serving mock service on http://{server.address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Benchmark the streaming MPD parser against the BeautifulSoup path
+
+Builds a synthetic multi-period manifest, similar to the ad-stitched ones
+served by Pluto and CTV, and times how long it takes to get the heights,
+codecs and default KID out of it with each approach.
+
+Usage:
+    python -m benchmarks.mpd [--periods 200] [--runs 5]
+"""
+from __future__ import annotations
+
+import argparse
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from utils.mpd import parse_mpd
+
+HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" xmlns:cenc="urn:mpeg:cenc:2013" '
+    'type="static" mediaPresentationDuration="PT{duration}S" minBufferTime="PT2S">\n'
+)
+PERIOD = """\
+<Period id="{period}" duration="PT30S">
+  <BaseURL>https://cdn.example.com/{period}/</BaseURL>
+  <AdaptationSet contentType="video" mimeType="video/mp4" segmentAlignment="true">
+    <ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011" value="cenc" cenc:default_KID="0b4a1f6c-54d1-4f77-9f3e-6a1a{period:08x}"/>
+    <ContentProtection schemeIdUri="urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed"><cenc:pssh>AAAANHBzc2gAAAAA7e+LqXnWSs6jyCfc1R0h7QAAABQIARIQC0ofbFTRT3efPmoaAAAAAA==</cenc:pssh></ContentProtection>
+    <SegmentTemplate timescale="90000" media="$RepresentationID$/$Time$.m4s" initialization="$RepresentationID$/init.mp4">
+      <SegmentTimeline>
+{timeline}
+      </SegmentTimeline>
+    </SegmentTemplate>
+{videos}
+  </AdaptationSet>
+  <AdaptationSet contentType="audio" mimeType="audio/mp4" lang="en">
+    <SegmentTemplate timescale="48000" media="$RepresentationID$/$Time$.m4s" initialization="$RepresentationID$/init.mp4" duration="96000"/>
+    <Representation id="audio-{period}" codecs="mp4a.40.2" bandwidth="128000" audioSamplingRate="48000"/>
+  </AdaptationSet>
+</Period>
+"""
+VIDEO = '    <Representation id="video-{period}-{height}" bandwidth="{bandwidth}" width="{width}" height="{height}" codecs="avc1.640028" frameRate="25"/>'
+LADDER = ((1920, 1080, 6000000), (1280, 720, 3500000), (960, 540, 2000000), (640, 360, 800000))
+
+
+def build_manifest(periods: int, segments: int = 15) -> bytes:
+    timeline = "\n".join(
+        f'        <S t="{i * 180000}" d="180000"/>' for i in range(segments)
+    )
+    body = "".join(
+        PERIOD.format(
+            period=period,
+            timeline=timeline,
+            videos="\n".join(
+                VIDEO.format(period=period, width=w, height=h, bandwidth=b)
+                for w, h, b in LADDER
+            ),
+        )
+        for period in range(periods)
+    )
+    return (HEADER.format(duration=periods * 30) + body + "</MPD>\n").encode("utf-8")
+
+
+def with_soup(data: bytes) -> tuple:
+    soup = BeautifulSoup(data, "xml")
+    elements = soup.find_all("Representation")
+    heights = sorted(
+        {int(x.attrs["height"]) for x in elements if x.attrs.get("height")},
+        reverse=True,
+    )
+    codecs = [x.attrs["codecs"] for x in elements if x.attrs.get("codecs")]
+    kid = soup.select_one("ContentProtection").attrs.get("cenc:default_KID")
+    return heights, len(codecs), kid
+
+
+def with_parser(data: bytes) -> tuple:
+    mpd = parse_mpd(data)
+    return mpd.heights, len(mpd.codecs), mpd.default_kid
+
+
+def measure(func: callable, data: bytes, runs: int) -> tuple:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = func(data)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, min(timings), peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--periods", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    data = build_manifest(args.periods)
+    print(f"Manifest: {args.periods} periods, {len(data) / 1024 / 1024:.2f} MiB\n")
+
+    results = {}
+    for name, func in (("BeautifulSoup", with_soup), ("utils.mpd", with_parser)):
+        result, best, peak = measure(func, data, args.runs)
+        results[name] = result
+        print(f"{name:<15} {best * 1000:>9.1f} ms {peak / 1024 / 1024:>9.2f} MiB peak")
+
+    if len(set(map(repr, results.values()))) != 1:
+        raise SystemExit(f"Parsers disagree: {results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Benchmark the whole get flow against the local mock service
+
+Starts benchmarks/mock/server.py in-process and downloads its catalog with
+services/mock through the daemon's job queue, using the stand-ins for
+N_m3u8DL-RE and mkvmerge in benchmarks/mock/bin. Every mode downloads the
+whole catalog into a fresh folder and reports episodes per minute and MB/s
+of media served:
+
+    sequential   one job, titles one after another
+    pipelined    one job with --background-mux
+    parallel     one job per episode on --workers workers
+
+Usage:
+    python -m benchmarks.pipeline [--modes sequential,pipelined,parallel]
+        [--engine n_m3u8dl-re] [--protocol dash] [--seasons 2] [--episodes 5]
+        [--segments 30] [--segment-size 262144] [--latency 0.02] [--bandwidth 50]
+        [--mux-rate 200] [--workers 4] [--threads 8] [--real-tools]
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlparse
+
+import yaml
+
+from benchmarks.mock.server import Catalog, MockServer
+from utils.commands import get
+from utils.daemon import JobQueue
+from utils.manager import Service, service_manager
+from utils.progress import live_view, progress_hub
+
+MODES = ("sequential", "pipelined", "parallel")
+SERIES_URL = "https://mock.freevine.test/series/example"
+STUBS = Path(__file__).parent / "mock" / "bin"
+MOCK = Path("services") / "mock"
+
+
+def register_mock() -> None:
+    """Make services/mock known to the service manager, it's not in services.json"""
+    service_manager.services[urlparse(SERIES_URL).netloc] = Service(
+        name="MOCK",
+        alias=["MOCK"],
+        path=MOCK / "mock.py",
+        api=MOCK / "api.yaml",
+        cache=MOCK / "cache.json",
+        quality="1080p, AAC2.0",
+        config=MOCK / "config.yaml",
+        profile=MOCK / "profile.yaml",
+        cookies=MOCK / "cookies.txt",
+        credentials="none",
+    )
+
+
+def mock_address() -> tuple:
+    """Host and port the mock service expects the server on"""
+    with service_manager.services[urlparse(SERIES_URL).netloc].api.open() as f:
+        api = urlparse(yaml.safe_load(f)["api"])
+    return api.hostname, api.port
+
+
+def job_args(mode: str, catalog: Catalog, common: list) -> list:
+    if mode == "parallel":
+        return [
+            [SERIES_URL, "--episode", episode.upper(), *common]
+            for episode in catalog.episode_ids()
+        ]
+    if mode == "pipelined":
+        return [[SERIES_URL, "--complete", "--background-mux", *common]]
+    return [[SERIES_URL, "--complete", *common]]
+
+
+def run_mode(mode: str, args: argparse.Namespace, catalog: Catalog, server: MockServer) -> dict:
+    folder = Path(tempfile.mkdtemp(prefix=f"freevine-{mode}-"))
+    # Every job gets a fresh copy of this config
+    service_manager.config.update(
+        {
+            "save_dir": {"series": str(folder / "downloads"), "movies": str(folder / "downloads")},
+            "temp_dir": str(folder / "temp"),
+            "format": "mkv",
+            "muxer": "mkvmerge",
+            "metrics": None,
+        }
+    )
+    common = ["--no-cache", "--engine", args.engine, "--threads", str(args.threads)]
+
+    jobs = JobQueue(get, workers=args.workers if mode == "parallel" else 1)
+    server.reset()
+    start = time.perf_counter()
+    submitted = [jobs.submit(x) for x in job_args(mode, catalog, common)]
+    while any(job.state in ("queued", "running") for job in submitted):
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    outputs = list((folder / "downloads").rglob("*.mkv"))
+    failed = [job.error for job in submitted if job.state == "failed"]
+    shutil.rmtree(folder, ignore_errors=True)
+
+    return {
+        "episodes": len(outputs),
+        "failed": failed,
+        "seconds": elapsed,
+        "bytes": server.bytes,
+        "requests": server.requests,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--modes", type=str, default=",".join(MODES))
+    parser.add_argument("--engine", choices=("n_m3u8dl-re", "native"), default="n_m3u8dl-re")
+    parser.add_argument("--protocol", choices=("dash", "hls"), default="dash")
+    parser.add_argument("--seasons", type=int, default=2)
+    parser.add_argument("--episodes", type=int, default=5, help="Episodes per season")
+    parser.add_argument("--segments", type=int, default=30, help="Segments per episode")
+    parser.add_argument("--segment-size", type=int, default=256 * 1024)
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds before the first byte")
+    parser.add_argument("--bandwidth", type=float, default=50, help="Link speed in MB/s, 0 for unlimited")
+    parser.add_argument("--mux-rate", type=float, default=200, help="Mux speed of the stand-ins in MB/s")
+    parser.add_argument("--workers", type=int, default=4, help="Jobs at once in parallel mode")
+    parser.add_argument("--threads", type=int, default=8, help="Segment downloads per job")
+    parser.add_argument("--real-tools", action="store_true", help="Use the installed N_m3u8DL-RE and mkvmerge")
+    args = parser.parse_args()
+
+    modes = [x.strip() for x in args.modes.split(",")]
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        parser.error(f"Unknown modes: {', '.join(sorted(unknown))}")
+
+    # Progress bars would be drawn over the results
+    progress_hub.unsubscribe(live_view)
+
+    if not args.real_tools:
+        os.environ["PATH"] = f"{STUBS}{os.pathsep}{os.environ.get('PATH', '')}"
+        os.environ["MOCK_MUX_RATE"] = str(args.mux_rate)
+
+    catalog = Catalog(
+        args.seasons, args.episodes, args.segments, args.segment_size, protocol=args.protocol
+    )
+    register_mock()
+    host, port = mock_address()
+    server = MockServer(
+        catalog, host, port, latency=args.latency, bandwidth=args.bandwidth * 1024 * 1024
+    ).start()
+
+    total = args.seasons * args.episodes
+    print(
+        f"{total} episodes of {args.segments} segments over {args.protocol.upper()}, "
+        f"{args.engine}, {args.latency * 1000:.0f} ms latency, "
+        f"{args.bandwidth or 'unlimited'} MB/s link\n"
+    )
+    print(f"{'Mode':<12} {'Episodes':>9} {'Time':>9} {'Episodes/min':>13} {'MB/s':>8} {'Requests':>9}")
+    try:
+        for mode in modes:
+            result = run_mode(mode, args, catalog, server)
+            seconds = result["seconds"]
+            print(
+                f"{mode:<12} {result['episodes']:>4}/{total:<4} {seconds:>8.2f}s "
+                f"{result['episodes'] / seconds * 60:>13.1f} "
+                f"{result['bytes'] / 1024 / 1024 / seconds:>8.2f} {result['requests']:>9}"
+            )
+            for error in result["failed"]:
+                print(f"  failed: {error}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Benchmark the streaming subtitle converter against subby
+
+Builds feature-length WebVTT and TTML files from the fixtures and converts
+them to SRT with utils/srt.py and with subby, reporting the best time and
+the peak memory of each. Memory is the growth of the peak RSS of a fresh
+process, since lxml allocates outside of what tracemalloc sees.
+
+Then converts --files of them one after another, across a process pool with
+convert_batch, and with convert_batch again once the conversions are cached.
+
+Usage:
+    python -m benchmarks.subtitles [--cues 2000] [--files 40] [--runs 3]
+"""
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from benchmarks.suite import long_subtitles
+from utils.srt import convert, convert_batch, subby_convert
+
+CONVERTERS = (("utils.srt", convert), ("subby", subby_convert))
+
+
+def max_rss() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KiB everywhere else
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def peak_memory(func: callable, source: Path, sub_type: str) -> int:
+    """Runs in a fresh process, so earlier conversions don't hide the peak"""
+    output = source.with_name(f"peak.{func.__name__}.srt")
+    before = max_rss()
+    func(source, output, sub_type)
+    return max_rss() - before
+
+
+def measure(func: callable, source: Path, sub_type: str, runs: int) -> tuple:
+    output = source.with_name(f"{func.__name__}.srt")
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(source, output, sub_type)
+        timings.append(time.perf_counter() - start)
+
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        peak = pool.submit(peak_memory, func, source, sub_type).result()
+
+    return output.read_text(encoding="utf-8").count(" --> "), min(timings), peak
+
+
+def compare(sub_type: str, cues: int, runs: int) -> None:
+    data = long_subtitles(sub_type, cues)
+    try:
+        size = data.source.stat().st_size
+        print(f"{sub_type.upper()}: {cues} cues, {size / 1024 / 1024:.2f} MiB")
+        for name, func in CONVERTERS:
+            try:
+                count, best, peak = measure(func, data.source, sub_type, runs)
+            except Exception as e:
+                print(f"  {name:<10} failed: {e.__class__.__name__}: {e}")
+                continue
+            print(
+                f"  {name:<10} {best * 1000:>9.1f} ms {count / best:>10.0f} cues/s "
+                f"{peak / 1024 / 1024:>9.2f} MiB peak"
+            )
+    finally:
+        data.cleanup()
+
+
+def batch(cues: int, count: int) -> None:
+    folder = Path(tempfile.mkdtemp(prefix="freevine-bench-"))
+    cache = folder / "cache"
+    sources = []
+    try:
+        for i in range(count):
+            sub_type = ("vtt", "ttml")[i % 2]
+            data = long_subtitles(sub_type, cues)
+            # Every file is different, or the cache would convert it once
+            source = folder / f"{i}.{sub_type}"
+            source.write_text(
+                f"{data.source.read_text(encoding='utf-8')}\n" + " " * i, encoding="utf-8"
+            )
+            data.cleanup()
+            sources.append((source, source.with_suffix(".srt"), sub_type))
+
+        print(f"\n{count} files of {cues} cues")
+
+        start = time.perf_counter()
+        for source, output, sub_type in sources:
+            convert(source, output, sub_type)
+        sequential = time.perf_counter() - start
+        print(f"  {'sequential':<10} {sequential:>9.2f} s")
+
+        # The first batch fills the cache, the second one only copies from it
+        for label in ("batch", "cached"):
+            start = time.perf_counter()
+            results = convert_batch(sources, cache=cache)
+            elapsed = time.perf_counter() - start
+
+            failed = [x for x in results if isinstance(x, Exception)]
+            print(
+                f"  {label:<10} {elapsed:>9.2f} s {sequential / elapsed:>9.1f}x"
+                + (f" ({len(failed)} failed: {failed[0]})" if failed else "")
+            )
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--cues", type=int, default=2000, help="Cues per file")
+    parser.add_argument("--files", type=int, default=40, help="Files in the batch")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    for sub_type in ("vtt", "ttml"):
+        compare(sub_type, args.cues, args.runs)
+    batch(args.cues, args.files)
+
+
+if __name__ == "__main__":
+    main()
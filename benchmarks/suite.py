@@ -0,0 +1,406 @@
+"""
+Benchmark the pure-Python hot paths against a stored baseline
+
+Times title construction, episode selection, filename cleaning, manifest
+parsing, search result parsing and subtitle conversion on fixtures in
+benchmarks/fixtures, scaled up to the size of a long series, and compares
+the best time and peak memory of each against benchmarks/baseline.json.
+Anything slower or bigger than the baseline by more than the threshold is
+reported as a regression and the run exits with 1.
+
+Timings depend on the machine, so record the baseline on the machine you
+compare on with --save. It only replaces the benchmarks that ran.
+
+Usage:
+    python -m benchmarks.suite [--only titles,search] [--runs 5] [--threshold 0.25] [--save]
+"""
+from __future__ import annotations
+
+import argparse
+import copy
+import json
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+
+from benchmarks.hls import build_master
+from benchmarks.mpd import build_manifest
+from utils.manifests import manifest_cache
+from utils.options import Options
+from utils.search.api import _parse
+from utils.titles import Episode, Series
+from utils.srt import convert_file
+from utils.tokens import Token, token_store
+from utils.utilities import (
+    clean_filename,
+    from_m3u8,
+    from_mpd,
+    get_heights,
+    load_xml,
+    set_filename,
+    string_cleaning,
+)
+
+FIXTURES = Path(__file__).parent / "fixtures"
+BASELINE = Path(__file__).parent / "baseline.json"
+
+EPISODES = 10000
+SEASONS = 40
+RESULTS = 500
+CUES = 5000
+PERIODS = 200
+VARIANTS = 200
+
+SERIES_TEMPLATE = "{title}.S{season}E{episode}.{name}.{resolution}.{service}.WEB-DL.{audio}.H.264"
+MOVIE_TEMPLATE = "{title}.{year}.{resolution}.{service}.WEB-DL.{audio}.H.264"
+TITLES = (
+    "Crème Brûlée: Kitchen Nightmares & More",
+    "What's Up, Doc?",
+    "L'Été Indien / Indian Summer",
+    "Mr. Smith Goes to... Town!!",
+    "Who Wants to Be a Millionaire? #1",
+    "Çà et Là — Pokémon’s “Greatest” Hits",
+)
+TIMESTAMP = re.compile(r"(\d{2}):(\d{2}):(\d{2})\.(\d{3})")
+
+
+class Benchmark:
+    __slots__ = ("name", "setup", "func")
+
+    def __init__(self, name: str, setup: callable, func: callable) -> None:
+        self.name = name
+        # Builds the input once, outside of the timings
+        self.setup = setup
+        self.func = func
+
+
+# Fixtures
+
+
+def build_episodes(count: int = EPISODES) -> list:
+    per_season = count // SEASONS
+    episodes = []
+    for i in range(count):
+        season, number = divmod(i, per_season)
+        title = TITLES[i % len(TITLES)]
+        # Every few names are just the episode number, which Episode drops
+        name = f"Episode {number + 1}" if i % 7 == 0 else f"The {title.split()[0]} Affair, Part {i}"
+        episodes.append(
+            dict(
+                id_=f"{i:08x}",
+                service="BENCH",
+                title=title,
+                season=season + 1,
+                number=number + 1,
+                name=name,
+                year=2000 + season % 20,
+                data=f"https://cdn.example.com/{i:08x}/manifest.mpd",
+            )
+        )
+    return episodes
+
+
+def build_series(count: int = EPISODES) -> Series:
+    return Series([Episode(**x) for x in build_episodes(count)])
+
+
+def shift(text: str, offset: float) -> str:
+    def replace(match: re.Match) -> str:
+        h, m, s, ms = map(int, match.groups())
+        total = round((h * 3600 + m * 60 + s) * 1000 + ms + offset * 1000)
+        h, total = divmod(total, 3600000)
+        m, total = divmod(total, 60000)
+        s, ms = divmod(total, 1000)
+        return f"{h:02}:{m:02}:{s:02}.{ms:03}"
+
+    return TIMESTAMP.sub(replace, text)
+
+
+def stretch(text: str, start: str, end: str, cues: int) -> str:
+    """Repeat the cues between the first `start` and the last `end` until there are `cues` of them"""
+    head, rest = text.split(start, 1)
+    body, tail = rest.rsplit(end, 1)
+    body = start + body + end
+
+    times = [float(h) * 3600 + float(m) * 60 + float(s) for h, m, s, _ in TIMESTAMP.findall(body)]
+    period = int(max(times)) + 1
+    per_body = max(1, len(times) // 2)
+
+    repeats = -(-cues // per_body)
+    return head + "\n".join(shift(body, i * period) for i in range(repeats)) + tail
+
+
+class SubtitleFile:
+    """Long subtitle file in a temporary folder, removed once the benchmark is done"""
+
+    def __init__(self, sub_type: str, text: str) -> None:
+        self.folder = Path(tempfile.mkdtemp(prefix="freevine-bench-"))
+        self.sub_type = sub_type
+        self.source = self.folder / f"subtitle.{sub_type}"
+        self.source.write_text(text, encoding="utf-8")
+
+    def cleanup(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def long_subtitles(sub_type: str, cues: int = CUES) -> SubtitleFile:
+    if sub_type == "vtt":
+        text = (FIXTURES / "sample.vtt").read_text(encoding="utf-8")
+        text = stretch(text, "\n1\n", "\n", cues)
+    else:
+        text = (FIXTURES / "sample.ttml").read_text(encoding="utf-8")
+        text = stretch(text, "<p ", "</p>", cues)
+    return SubtitleFile(sub_type, text)
+
+
+def search_query(name: str, count: int = RESULTS) -> object:
+    fixture = json.loads((FIXTURES / "search.json").read_text(encoding="utf-8"))[name]
+    query = copy.deepcopy(fixture["response"])
+    *parents, key = fixture["path"] or [None]
+
+    parent = query
+    for x in parents:
+        parent = parent[x]
+
+    if key is None:
+        return query * count
+    # Lists get more items, and HTML more of the same element
+    parent[key] = parent[key] * count
+    return query
+
+
+class FakeResponse:
+    def __init__(self, data: object) -> None:
+        self.data = data
+        self.content = data if isinstance(data, bytes) else b""
+
+    def json(self) -> object:
+        return self.data
+
+    def raise_for_status(self) -> None:
+        pass
+
+
+class FakeClient:
+    """Client that answers every request with the same response"""
+
+    def __init__(self, data: object) -> None:
+        self.data = data
+        self.headers = {}
+
+    def get(self, url: str, **kwargs) -> FakeResponse:
+        return FakeResponse(self.data)
+
+
+# Benchmarks
+
+
+def construct_episodes(episodes: list) -> list:
+    return [Episode(**x) for x in episodes]
+
+
+def construct_series(episodes: list) -> Series:
+    return Series(episodes)
+
+
+def options(**kwargs) -> Options:
+    fields = dict(episode=None, season=None, titles=False, url=None, tmp=None)
+    return Options(SimpleNamespace(**{**fields, **kwargs}))
+
+
+def clean_titles(titles: list) -> list:
+    # Clean every time instead of timing cache hits
+    string_cleaning.cache_clear()
+    return [string_cleaning(x) for x in titles]
+
+
+def render_filenames(series: Series) -> list:
+    service = SimpleNamespace(
+        movie=False,
+        config={"filename": {"series": SERIES_TEMPLATE, "movies": MOVIE_TEMPLATE}},
+    )
+    return [set_filename(service, x, "1080", "AAC2.0") for x in series]
+
+
+def filenames(series: Series) -> list:
+    string_cleaning.cache_clear()
+    clean_filename.cache_clear()
+    return render_filenames(series)
+
+
+def heights(data: bytes) -> tuple:
+    # Parse every time instead of timing cache hits
+    manifest_cache.clear()
+    return get_heights(FakeClient(data), "https://cdn.example.com/bench/manifest.mpd")[0]
+
+
+def parse_search(name: str) -> callable:
+    def run(query: object) -> list:
+        client = FakeClient(query) if name == "PlutoTV" else None
+        return _parse(query, {"name": name, "url": None, "params": {}}, client)
+
+    return run
+
+
+def convert(data: SubtitleFile) -> Path:
+    # Straight to the converter, converted subtitles are cached otherwise
+    return convert_file(data.source, data.folder / "subtitle.srt", data.sub_type)
+
+
+def benchmarks() -> list:
+    with (FIXTURES / "search.json").open(encoding="utf-8") as f:
+        services = list(json.load(f))
+
+    suite = [
+        Benchmark("titles.episodes", build_episodes, construct_episodes),
+        Benchmark(
+            "titles.series",
+            lambda: construct_episodes(build_episodes()),
+            construct_series,
+        ),
+        Benchmark(
+            "options.episode",
+            build_series,
+            lambda x: options(episode=f"S{SEASONS:02}E{EPISODES // SEASONS:02}").get_episode(x),
+        ),
+        Benchmark(
+            "options.range",
+            build_series,
+            lambda x: options(episode="S01E01-S05E20").get_episode(x),
+        ),
+        Benchmark(
+            "options.mix",
+            build_series,
+            lambda x: options(episode="S01E01,S10E10,S20E20,S30E30").get_episode(x),
+        ),
+        Benchmark("options.season", build_series, lambda x: options(season="S10").get_season(x)),
+        Benchmark("options.complete", build_series, lambda x: options().get_complete(x)),
+        Benchmark(
+            "filenames.string_cleaning",
+            lambda: [str(x) for x in build_series()],
+            clean_titles,
+        ),
+        Benchmark("filenames.set_filename", build_series, filenames),
+        # Listing, planning and downloading render the same filenames again
+        Benchmark("filenames.cached", build_series, render_filenames),
+        Benchmark("manifests.from_mpd", lambda: build_manifest(PERIODS), from_mpd),
+        Benchmark("manifests.get_heights", lambda: build_manifest(PERIODS), heights),
+        Benchmark("manifests.load_xml", lambda: build_manifest(PERIODS), load_xml),
+        Benchmark("manifests.from_m3u8", lambda: build_master(VARIANTS), from_m3u8),
+    ]
+    for name in services:
+        slug = re.sub(r"\W+", "_", name.lower())
+        suite.append(
+            Benchmark(f"search.{slug}", lambda name=name: search_query(name), parse_search(name))
+        )
+    for sub_type in ("vtt", "ttml"):
+        suite.append(
+            Benchmark(f"subtitles.{sub_type}", lambda x=sub_type: long_subtitles(x), convert)
+        )
+    return suite
+
+
+# Runner
+
+
+def measure(func: callable, data: object, runs: int) -> tuple:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(data)
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(timings), peak
+
+
+def load_baseline() -> dict:
+    try:
+        with BASELINE.open(encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {"results": {}}
+
+
+def change(value: float, base: float) -> str:
+    if not base:
+        return "-"
+    return f"{(value - base) / base * 100:+.0f}%"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--only", type=str, default=None, help="Comma-separated name prefixes")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--threshold", type=float, default=0.25)
+    parser.add_argument("--save", action="store_true", help="Store the results as the baseline")
+    args = parser.parse_args()
+
+    # Search for Pluto asks the token store for a session first
+    token_store.tokens[token_store.key("pluto")] = Token("bench", expires_in=86400)
+
+    suite = benchmarks()
+    if args.only:
+        prefixes = tuple(x.strip() for x in args.only.split(","))
+        suite = [x for x in suite if x.name.startswith(prefixes)]
+
+    baseline = load_baseline()
+    stored = baseline.get("results", {})
+    results = {}
+    regressions = []
+
+    print(f"{'Benchmark':<28} {'Time':>10} {'Base':>10} {'Δ':>6} {'Peak':>10} {'Base':>10} {'Δ':>6}")
+    for bench in suite:
+        data = bench.setup()
+        try:
+            seconds, peak = measure(bench.func, data, args.runs)
+        finally:
+            if hasattr(data, "cleanup"):
+                data.cleanup()
+        results[bench.name] = {"seconds": seconds, "peak": peak}
+
+        base = stored.get(bench.name, {})
+        base_seconds, base_peak = base.get("seconds"), base.get("peak")
+        print(
+            f"{bench.name:<28} {seconds * 1000:>8.2f}ms "
+            f"{f'{base_seconds * 1000:.2f}ms' if base_seconds else '-':>10} {change(seconds, base_seconds):>6} "
+            f"{peak / 1024 / 1024:>7.2f}MiB "
+            f"{f'{base_peak / 1024 / 1024:.2f}MiB' if base_peak else '-':>10} {change(peak, base_peak):>6}"
+        )
+
+        if base_seconds and seconds > base_seconds * (1 + args.threshold):
+            regressions.append(f"{bench.name}: time {change(seconds, base_seconds)}")
+        if base_peak and peak > base_peak * (1 + args.threshold):
+            regressions.append(f"{bench.name}: peak memory {change(peak, base_peak)}")
+
+    if args.save:
+        baseline = {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": {**stored, **results},
+        }
+        with BASELINE.open("w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"\nSaved {len(results)} result(s) to {BASELINE}")
+        return
+
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%}:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
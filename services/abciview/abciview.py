@@ -9,29 +9,27 @@ from __future__ import annotations
 
 import json
 import re
-import subprocess
 import sys
-import time
 from collections import Counter
 from pathlib import Path
 from urllib.parse import urlparse
 
 import click
-import requests
-from bs4 import BeautifulSoup
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.manifests import manifest_cache
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
+from utils.subtitles import fetch_subtitles
 from utils.titles import Episode, Movie, Movies, Series
 from utils.utilities import (
     append_id,
-    convert_subtitles,
     force_numbering,
-    get_heights,
     get_wvd,
-    in_cache,
     info,
     kid_to_pssh,
     set_filename,
@@ -150,16 +148,14 @@ class ABC(Config):
             ]
         )
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str) -> str:
-        r = self.client.get(manifest)
-        r.raise_for_status()
-
-        if "cenc" not in r.text:
+        if b"cenc" not in manifest_cache.get(self.client, manifest):
             self.log.error("Unable to parse manifest. Possible VPN/proxy detection")
             sys.exit(0)
 
-        self.soup = BeautifulSoup(r.content, "xml")
-        heights, self.soup = get_heights(self.client, manifest)
+        mpd = load_mpd(self.client, manifest)
+        heights = mpd.heights
         resolution = heights[0]
 
         if quality is not None:
@@ -168,7 +164,7 @@ class ABC(Config):
             else:
                 resolution = min(heights, key=lambda x: abs(int(x) - int(quality)))
 
-        return resolution
+        return resolution, mpd
 
     def get_playlist(self, video_id: str) -> tuple:
         r = self.client.get(self.config["vod"].format(video_id=video_id)).json()
@@ -232,25 +228,24 @@ class ABC(Config):
 
         return [episode[0]], title
 
+    def get_subtitles(self, stream: object) -> tuple:
+        _, subtitle = self.get_playlist(stream.id)
+        return subtitle, "vtt"
+
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest, subtitle = self.get_playlist(stream.id)
-        self.res = self.get_mediainfo(manifest, self.quality)
-        pssh = kid_to_pssh(self.soup)
+        self.sub_path = (
+            fetch_subtitles(self, subtitle, stream.id, sub_type="vtt")
+            if subtitle is not None and not self.skip_download
+            else None
+        )
+        self.res, mpd = self.get_mediainfo(manifest, self.quality)
+        pssh = kid_to_pssh(mpd)
         customdata = self.get_license_url(stream.id)
         self.client.headers.update({"customdata": customdata})
 
@@ -262,29 +257,12 @@ class ABC(Config):
         self.save_path = set_save_path(stream, self, title)
         self.manifest = manifest
         self.key_file = self.tmp / "keys.txt"
-        self.sub_path = None
 
         self.log.info(f"{str(stream)}")
         click.echo("")
 
         if subtitle is not None and not self.skip_download:
             self.log.info(f"Subtitles: {subtitle}")
-            try:
-                sub = self.client.get(subtitle)
-                sub.raise_for_status()
-            except requests.exceptions.HTTPError:
-                self.log.warning(f"Subtitle response {sub.status_code}, skipping")
-            else:
-                sub_path = self.tmp / f"{self.filename}.vtt"
-                with open(sub_path, "wb") as f:
-                    f.write(sub.content)
-
-                if not self.sub_no_fix:
-                    sub_path = convert_subtitles(
-                        self.tmp, self.filename, sub_type="vtt"
-                    )
-
-                self.sub_path = sub_path
 
         if self.skip_download:
             self.log.info(f"Filename: {self.filename}")
@@ -296,7 +274,7 @@ class ABC(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
@@ -10,24 +10,22 @@ from __future__ import annotations
 
 import json
 import re
-import subprocess
 import sys
-import time
 from collections import Counter
 
 import click
-import m3u8
-import requests
 
 from utils.args import get_args
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.hls import load_master
+from utils.metrics import timed
+from utils.options import batch_download, get_downloads
+from utils.subtitles import fetch_subtitles
 from utils.titles import Episode, Movie, Movies, Series
 from utils.utilities import (
     append_id,
-    convert_subtitles,
     force_numbering,
-    in_cache,
     is_title_match,
     set_filename,
     set_save_path,
@@ -206,24 +204,22 @@ class BBC(Config):
 
         return self.get_streams(media)
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: int, resolution=None):
-        r = self.client.get(manifest)
-        r.raise_for_status()
-
         base = manifest.split("master")[0]
 
-        m3u8_obj = m3u8.loads(r.text)
+        master = load_master(self.client, manifest)
 
         playlists = sorted(
             [
                 {
-                    "resolution": playlist.stream_info.resolution,
-                    "bandwidth": playlist.stream_info.bandwidth,
-                    "codec": playlist.stream_info.codecs.split(",")[1],
-                    "audio": playlist.stream_info.audio,
-                    "uri": base + playlist.uri,
+                    "resolution": variant.resolution,
+                    "bandwidth": variant.bandwidth,
+                    "codec": variant.codecs.split(",")[1],
+                    "audio": variant.audio,
+                    "uri": base + variant.uri,
                 }
-                for playlist in m3u8_obj.playlists
+                for variant in master.variants
             ],
             key=lambda x: x["resolution"][1],
             reverse=True,
@@ -353,50 +349,34 @@ class BBC(Config):
 
         return [episode[0]], title
 
+    def get_subtitles(self, stream: object) -> tuple:
+        _, subtitle = self.get_playlist(stream.id)
+        return subtitle, "ttml"
+
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest, subtitle = self.get_playlist(stream.id)
+        self.sub_path = (
+            fetch_subtitles(self, subtitle, stream.id, sub_type="ttml")
+            if subtitle is not None and not self.skip_download
+            else None
+        )
         playlist, self.res = self.get_mediainfo(manifest, self.quality)
 
         self.filename = set_filename(self, stream, self.res, audio="AAC2.0")
         self.save_path = set_save_path(stream, self, title)
         self.manifest = manifest if self.skip_download else playlist
         self.key_file = None  # not encrypted
-        self.sub_path = None
 
         self.log.info(f"{str(stream)}")
         click.echo("")
 
         if subtitle is not None and not self.skip_download:
             self.log.info(f"Subtitles: {subtitle}")
-            try:
-                sub = self.client.get(subtitle)
-                sub.raise_for_status()
-            except requests.exceptions.HTTPError:
-                self.log.warning(f"Subtitle response {sub.status_code}, skipping")
-            else:
-                sub_path = self.tmp / f"{self.filename}.ttml"
-                with open(sub_path, "wb") as f:
-                    f.write(sub.content)
-
-                if not self.sub_no_fix:
-                    sub_path = convert_subtitles(self.tmp, self.filename, sub_type="ttml")
-                
-                self.sub_path = sub_path
 
         if self.skip_download:
             self.log.info(f"Filename: {self.filename}")
@@ -408,7 +388,7 @@ class BBC(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
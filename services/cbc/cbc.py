@@ -11,26 +11,27 @@ from __future__ import annotations
 
 import json
 import re
-import subprocess
 import sys
-import time
 from collections import Counter
-from datetime import datetime, timedelta
-from pathlib import Path
+from datetime import datetime, timezone
 from urllib.parse import urlparse
 
 import click
-import yaml
 from bs4 import BeautifulSoup
 
 from utils.args import get_args
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.hls import parse_master
+from utils.manifests import manifest_cache
+from utils.metrics import timed
+from utils.options import batch_download, get_downloads
+from utils.server import manifest_server
 from utils.titles import Episode, Movie, Movies, Series
+from utils.tokens import Token, token_store
 from utils.utilities import (
     force_numbering,
     append_id,
-    in_cache,
     is_url,
     set_filename,
     set_save_path,
@@ -60,7 +61,7 @@ class CBC(Config):
 
         self.get_options()
 
-    def login(self) -> str:
+    def login(self) -> Token:
         if not self.username and not self.password:
             self.log.error(
                 "Required credentials were not found. See 'freevine.py profile --help'"
@@ -80,32 +81,20 @@ class CBC(Config):
         if not r.ok:
             raise ConnectionError(f"{r.json().get('Description')}")
 
-        auth = json.loads(r.content)
-        access_token = auth.get("access_token")
-        refresh_token = auth.get("refresh_token")
-        expiry = datetime.strptime(auth.get("expires_in"), "%Y-%m-%dT%H:%M:%S.%fZ")
-
-        profile = Path("services") / "cbc" / "profile.yaml"
-        with open(profile, "r") as f:
-            data = yaml.safe_load(f)
-
-        data["cache"] = {}
-
-        data["cache"]["login"] = {
-            "token": access_token,
-            "expiry": expiry,
-            "refresh": refresh_token,
-        }
-
-        with open(profile, "w") as f:
-            yaml.safe_dump(data, f, sort_keys=False)
-
         self.log.info("+ New login tokens placed in cache")
-        return access_token
+        return self.login_token(json.loads(r.content))
 
-    def access_token(self, token: str) -> str:
+    def login_token(self, auth: dict) -> Token:
+        expiry = datetime.strptime(auth.get("expires_in"), "%Y-%m-%dT%H:%M:%S.%fZ")
+        return Token(
+            auth.get("access_token"),
+            expiry=expiry.replace(tzinfo=timezone.utc),
+            refresh=auth.get("refresh_token"),
+        )
+
+    def access_token(self) -> Token:
         params = {
-            "access_token": token,
+            "access_token": self.get_login_token(),
             "apikey": self.config["apikey"],
             "jwtapp": "jwt",
         }
@@ -126,26 +115,12 @@ class CBC(Config):
             json=payload,
         ).json()
 
-        access_token = auth.get("accessToken")
-        refresh_token = auth.get("refreshToken")
-
-        expiry = datetime.now() + timedelta(seconds=auth.get("accessTokenExpiresIn"))
-
-        profile = Path("services") / "cbc" / "profile.yaml"
-        with open(profile, "r") as f:
-            data = yaml.safe_load(f)
-
-        data["cache"]["access"] = {
-            "token": access_token,
-            "expiry": expiry,
-            "refresh": refresh_token,
-        }
-
-        with open(profile, "w") as f:
-            yaml.safe_dump(data, f, sort_keys=False)
-
         self.log.info("+ New access tokens placed in cache")
-        return access_token
+        return Token(
+            auth.get("accessToken"),
+            expires_in=auth.get("accessTokenExpiresIn"),
+            refresh=auth.get("refreshToken"),
+        )
 
     def claims_token(self, token: str) -> str:
         headers = {
@@ -160,70 +135,44 @@ class CBC(Config):
 
         return resp["claimsToken"]
 
-    def refresh_auth_token(self, token: str) -> str:
+    def refresh_auth_token(self, token: Token) -> Token:
         payload = {
             "email": self.username,
             "password": self.password,
-            "refresh_token": token,
+            "refresh_token": token.refresh,
         }
         params = {"apikey": self.config["apikey"]}
-        auth = self.client.post(
+        r = self.client.post(
             "https://api.loginradius.com/identity/v2/auth/login",
             json=payload,
             params=params,
         )
-
-        access_token = auth.get("access_token")
-        refresh_token = auth.get("refresh_token")
-        expiry = datetime.strptime(auth.get("expires_in"), "%Y-%m-%dT%H:%M:%S.%fZ")
-
-        profile = Path("services") / "cbc" / "profile.yaml"
-        with open(profile, "r") as f:
-            data = yaml.safe_load(f)
-
-        data["cache"]["login"]["token"] = access_token
-        data["cache"]["login"]["refresh"] = refresh_token
-        data["cache"]["login"]["expiry"] = expiry
-
-        with open(profile, "w") as f:
-            yaml.safe_dump(data, f, sort_keys=False)
+        r.raise_for_status()
 
         self.log.info("+ Tokens refreshed")
-        return access_token
-
-    def authenticate(self):
-        cache = self.config.get("cache")
-
-        if not cache:
-            self.log.info("Cache is empty, aquiring new login tokens...")
-            auth_token = self.login()
-            access_token = self.access_token(auth_token)
+        return self.login_token(r.json())
 
-        elif cache and cache["login"]["expiry"] < datetime.now():
-            self.log.info("Refreshing expired login tokens...")
-            auth_token = self.refresh_auth_token(cache["login"]["refresh"])
+    def get_login_token(self) -> str:
+        return token_store.get(
+            "cbc", self.login, self.refresh_auth_token, profile=self.username
+        ).value
 
-        else:
-            self.log.info("Using cached login tokens")
-            auth_token = cache["login"].get("token")
-
-        if not cache and access_token:
-            access_token = access_token
-
-        elif cache and cache["access"]["expiry"] < datetime.now():
-            access_token = self.access_token(auth_token)
+    def authenticate(self):
+        # The access token is derived from the login token, which outlives it
+        return token_store.get("cbc-access", self.access_token, profile=self.username).value
 
-        else:
-            access_token = cache["access"]["token"]
+    def set_claims(self) -> None:
+        access_token = self.authenticate()
+        claims_token = self.claims_token(access_token)
+        self.client.headers.update({"x-claims-token": claims_token})
 
-        return access_token
+    def resume_session(self, downloads: list) -> None:
+        self.set_claims()
 
     def get_data(self, url: str):
         show_id = urlparse(url).path.split("/")[1]
 
-        access_token = self.authenticate()
-        claims_token = self.claims_token(access_token)
-        self.client.headers.update({"x-claims-token": claims_token})
+        self.set_claims()
         url = self.config["shows"].format(show=show_id)
 
         return self.client.get(url).json()
@@ -280,17 +229,9 @@ class CBC(Config):
             ]
         )
 
+    @timed("mediainfo")
     def get_mediainfo(self, quality: int, m3u8: str, audio: list) -> str:
-        resolutions = []
-
-        lines = m3u8.splitlines()
-
-        for line in lines:
-            if "RESOLUTION=" in line:
-                resolution = re.search("RESOLUTION=\d+x(\d+)", line).group(1)
-                resolutions.append(resolution)
-
-        resolutions.sort(key=lambda x: int(x), reverse=True)
+        resolutions = [str(x) for x in parse_master(m3u8).heights]
 
         if "EC-3" in audio and "best" or "ec3" in self.config["audio"]["select"]:
             audio = "DDP5.1"
@@ -328,7 +269,7 @@ class CBC(Config):
             'URI="{uri}QualityLevels({bitrate})/Manifest({codec},format=m3u8-aapl)"'
         )
 
-        m3u8_text = self.client.get(url).text
+        m3u8_text = manifest_cache.get(self.client, url).decode("utf-8")
 
         try:
             r = self.client.get(smooth)
@@ -382,8 +323,7 @@ class CBC(Config):
                         )
                         audio.append(level.attrs.get("FourCC"))
 
-            with open(self.tmp / "manifest.m3u8", "w") as f:
-                f.write(m3u8_text)
+            url = manifest_server.serve(m3u8_text, "manifest.m3u8")
 
         return url, m3u8_text, audio
 
@@ -424,17 +364,7 @@ class CBC(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         mpd_url, m3u8, audio = self.get_playlist(stream.data)
@@ -442,7 +372,7 @@ class CBC(Config):
 
         self.filename = set_filename(self, stream, self.res, audio)
         self.save_path = set_save_path(stream, self, title)
-        self.manifest = self.tmp / "manifest.m3u8" if self.xml else mpd_url
+        self.manifest = mpd_url
         self.key_file = None  # Not encrypted
         self.sub_path = None
 
@@ -453,7 +383,7 @@ class CBC(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
@@ -12,9 +12,7 @@ from __future__ import annotations
 import asyncio
 import json
 import re
-import subprocess
 import sys
-import time
 from collections import Counter
 from pathlib import Path
 from urllib.parse import urlparse
@@ -26,13 +24,15 @@ from bs4 import BeautifulSoup
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Series
 from utils.utilities import (
     append_id,
     force_numbering,
     get_wvd,
-    in_cache,
     kid_to_pssh,
     set_filename,
     set_save_path,
@@ -128,17 +128,12 @@ class CBS(Config):
 
         return lic_url, token
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str) -> str:
-        r = self.client.get(manifest)
-        soup = BeautifulSoup(r.content, "xml")
-        elements = soup.find_all("Representation")
-        codecs = [x.attrs["codecs"] for x in elements if x.attrs.get("codecs")]
+        mpd = load_mpd(self.client, manifest)
+        codecs = mpd.codecs
         heights = sorted(
-            [
-                int(x.attrs["height"])
-                for x in elements
-                if x.attrs.get("height") and "thumb" not in x.attrs.get("id")
-            ],
+            {x.height for x in mpd.videos if x.height and "thumb" not in (x.id or "")},
             reverse=True,
         )
         resolution = heights[0]
@@ -154,7 +149,7 @@ class CBS(Config):
             else:
                 resolution = min(heights, key=lambda x: abs(int(x) - int(quality)))
 
-        return resolution, soup, audio
+        return resolution, mpd, audio
 
     def get_content(self, url: str) -> object:
         with self.console.status("Fetching series titles..."):
@@ -215,17 +210,12 @@ class CBS(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
+        batch_download(self, downloads, title)
 
-            self.download(download, title)
+    def resume_session(self, downloads: list) -> None:
+        # License tokens from episode URLs are short-lived, so fetch new ones
+        for download in downloads:
+            download.lic_url = None
 
     def download(self, stream: object, title: str) -> None:
         if stream.premium:
@@ -236,8 +226,8 @@ class CBS(Config):
             stream.lic_url, token = self.get_config(stream.id)
             self.client.headers.update({"authorization": token})
 
-        self.res, soup, audio = self.get_mediainfo(stream.data, self.quality)
-        pssh = kid_to_pssh(soup)
+        self.res, mpd, audio = self.get_mediainfo(stream.data, self.quality)
+        pssh = kid_to_pssh(mpd)
 
         keys = self.get_keys(pssh, stream.lic_url)
         with open(self.tmp / "keys.txt", "w") as file:
@@ -259,7 +249,7 @@ class CBS(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
@@ -13,34 +13,33 @@ from __future__ import annotations
 import base64
 import json
 import re
-import subprocess
 import sys
-import time
 from collections import Counter
-from datetime import datetime
 from pathlib import Path
 
 import click
 import httpx
 import requests
-import yaml
-from bs4 import BeautifulSoup
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import unpad
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.manifests import manifest_cache
+from utils.metrics import timed
+from utils.mpd import parse_mpd
+from utils.options import batch_download, get_downloads
+from utils.subtitles import fetch_subtitles
 from utils.proxies import proxy_session
 from utils.titles import Episode, Movie, Movies, Series
+from utils.tokens import Token, token_store
 from utils.utilities import (
     append_id,
-    convert_subtitles,
     expiration,
     force_numbering,
     get_wvd,
-    in_cache,
     kid_to_pssh,
     set_filename,
     set_save_path,
@@ -73,19 +72,9 @@ class CHANNEL4(Config):
         self.get_options()
 
     def get_auth_token(self):
-        cache = self.config.get("cache")
-
-        if not cache:
-            self.log.info("Cache is empty, aquiring new tokens...")
-            token = self.authenticate()
-        elif cache and cache.get("expiry") < datetime.now():
-            self.log.info("Refreshing expired tokens...")
-            token = self.refresh_token()
-        else:
-            self.log.info("Using cached tokens")
-            token = cache.get("token")
-
-        return token
+        return token_store.get(
+            "channel4", self.authenticate, self.refresh_token, profile=self.username
+        ).value
 
     def get_license(self, challenge: bytes, lic_url: str, assets: tuple) -> str:
         manifest, token, asset = assets
@@ -184,7 +173,7 @@ class CHANNEL4(Config):
             ]
         )
 
-    def refresh_token(self):
+    def refresh_token(self, token: Token) -> Token:
         self.client.headers.update(
             {
                 "authorization": f"Basic {self.config['android']['auth']}",
@@ -195,7 +184,7 @@ class CHANNEL4(Config):
             "grant_type": "refresh_token",
             "username": self.username,
             "password": self.password,
-            "refresh_token": self.config["cache"]["refresh"],
+            "refresh_token": token.refresh,
         }
 
         r = self.client.post(self.login, data=data)
@@ -203,27 +192,15 @@ class CHANNEL4(Config):
             raise ConnectionError(f"{r} {r.text}")
 
         auth = json.loads(r.content)
-        token = auth.get("accessToken")
-        refresh = auth.get("refreshToken")
-
-        expiry = expiration(auth.get("expiresIn"), auth.get("issuedAt"))
-
-        profile = Path("services") / "channel4" / "profile.yaml"
-        with open(profile, "r") as f:
-            data = yaml.safe_load(f)
-
-        data["cache"]["token"] = token
-        data["cache"]["refresh"] = refresh
-        data["cache"]["expiry"] = expiry
-
-        with open(profile, "w") as f:
-            yaml.safe_dump(data, f, sort_keys=False)
-
         self.log.info("+ Tokens refreshed")
 
-        return token
+        return Token(
+            auth.get("accessToken"),
+            expiry=expiration(auth.get("expiresIn"), auth.get("issuedAt")),
+            refresh=auth.get("refreshToken"),
+        )
 
-    def authenticate(self):
+    def authenticate(self) -> Token:
         if not self.username and not self.password:
             self.log.error(
                 "Required credentials were not found. See 'freevine.py profile --help'"
@@ -249,23 +226,13 @@ class CHANNEL4(Config):
             raise ConnectionError(f"{r} {r.text}")
 
         auth = json.loads(r.content)
-        token = auth.get("accessToken")
-        refresh = auth.get("refreshToken")
-
-        expiry = expiration(auth.get("expiresIn"), auth.get("issuedAt"))
-
-        profile = Path("services") / "channel4" / "profile.yaml"
-        with open(profile, "r") as f:
-            data = yaml.safe_load(f)
-
-        data["cache"] = {"token": token, "expiry": expiry, "refresh": refresh}
-
-        with open(profile, "w") as f:
-            yaml.safe_dump(data, f, sort_keys=False)
-
         self.log.info("+ New tokens placed in cache")
 
-        return token
+        return Token(
+            auth.get("accessToken"),
+            expiry=expiration(auth.get("expiresIn"), auth.get("issuedAt")),
+            refresh=auth.get("refreshToken"),
+        )
 
     def android_playlist(self, video_id: str, bearer: str, quality: str) -> tuple:
         self.log.info("Requesting ANDROID assets...")
@@ -321,25 +288,24 @@ class CHANNEL4(Config):
         return manifest, token, subtitle
 
     def get_heights(self, manifest: str, client: str = None) -> tuple:
-        r = httpx.get(manifest)
-        if not r.is_success:
-            self.log.warning(
-                "Request for %s manifest returned %s, attempting proxy request...",
-                client,
-                r,
-            )
-            r = proxy_session(self, url=manifest, method="get", location="UK")
-            if not r.ok:
-                self.log.warning("Proxy attempt failed. %s", r)
-                return
+        entry = manifest_cache.lookup(manifest)
+        if entry is None:
+            r = httpx.get(manifest)
+            if not r.is_success:
+                self.log.warning(
+                    "Request for %s manifest returned %s, attempting proxy request...",
+                    client,
+                    r,
+                )
+                r = proxy_session(self, url=manifest, method="get", location="UK")
+                if not r.ok:
+                    self.log.warning("Proxy attempt failed. %s", r)
+                    return None, None
 
-        self.soup = BeautifulSoup(r.text, "xml")
-        elements = self.soup.find_all("Representation")
-        heights = sorted(
-            [int(x.attrs["height"]) for x in elements if x.attrs.get("height")],
-            reverse=True,
-        )
-        return heights
+            entry = manifest_cache.put(manifest, r.content)
+
+        mpd = manifest_cache.parsed(entry, manifest, parse_mpd)
+        return mpd.heights, mpd
 
     def sort_assets(self, android_assets: tuple, web_assets: tuple) -> tuple:
         android_heights = None
@@ -347,11 +313,11 @@ class CHANNEL4(Config):
 
         if android_assets is not None:
             a_manifest, a_token, a_subtitle = android_assets
-            android_heights = self.get_heights(a_manifest, client="ANDROID")
+            android_heights, a_mpd = self.get_heights(a_manifest, client="ANDROID")
 
         if web_assets is not None:
             b_manifest, b_token, b_subtitle = web_assets
-            web_heights = self.get_heights(b_manifest, client="WEB")
+            web_heights, b_mpd = self.get_heights(b_manifest, client="WEB")
 
         if not android_heights and not web_heights:
             self.log.error(
@@ -364,15 +330,16 @@ class CHANNEL4(Config):
                 "ANDROID data returned None or is missing full quality profile, falling back to WEB data..."
             )
             lic_token = self.decrypt_token(b_token, client="web")
-            return web_heights, b_manifest, lic_token, b_subtitle
+            return web_heights, b_mpd, b_manifest, lic_token, b_subtitle
         else:
             lic_token = self.decrypt_token(a_token, client="android")
-            return android_heights, a_manifest, lic_token, a_subtitle
+            return android_heights, a_mpd, a_manifest, lic_token, a_subtitle
 
+    @timed("mediainfo")
     def get_mediainfo(self, video_id: str, quality: str, bearer: str) -> str:
         android_assets: tuple = self.android_playlist(video_id, bearer, quality)
         web_assets: tuple = self.web_playlist(video_id)
-        heights, manifest, lic_token, subtitle = self.sort_assets(
+        heights, mpd, manifest, lic_token, subtitle = self.sort_assets(
             android_assets, web_assets
         )
         resolution = heights[0]
@@ -383,7 +350,7 @@ class CHANNEL4(Config):
             else:
                 resolution = min(heights, key=lambda x: abs(int(x) - int(quality)))
 
-        return resolution, manifest, lic_token, subtitle
+        return resolution, mpd, manifest, lic_token, subtitle
 
     def get_content(self, url: str) -> object:
         if self.movie:
@@ -441,23 +408,18 @@ class CHANNEL4(Config):
         bearer = self.get_auth_token()
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title, bearer)
+        batch_download(self, downloads, title, bearer)
 
     def download(self, stream: object, title: str, bearer: str) -> None:
-        self.res, manifest, token, subtitle = self.get_mediainfo(
+        self.res, mpd, manifest, token, subtitle = self.get_mediainfo(
             stream.id, self.quality, bearer
         )
-        pssh = kid_to_pssh(self.soup)
+        self.sub_path = (
+            fetch_subtitles(self, subtitle, stream.id, sub_type="vtt", client=requests)
+            if subtitle is not None and not self.skip_download
+            else None
+        )
+        pssh = kid_to_pssh(mpd)
         assets = manifest, token, stream.data
 
         keys = self.get_keys(pssh, self.lic_url, assets)
@@ -468,29 +430,12 @@ class CHANNEL4(Config):
         self.save_path = set_save_path(stream, self, title)
         self.manifest = manifest
         self.key_file = self.tmp / "keys.txt"
-        self.sub_path = None
 
         click.echo("")
         self.log.info(f"{str(stream)}")
 
         if subtitle is not None and not self.skip_download:
             self.log.info(f"Subtitles: {subtitle}")
-            try:
-                sub = requests.get(subtitle)
-                sub.raise_for_status()
-            except requests.exceptions.HTTPError:
-                self.log.warning(f"Subtitle response {sub.status_code}, skipping")
-            else:
-                sub_path = self.tmp / f"{self.filename}.vtt"
-                with open(sub_path, "wb") as f:
-                    f.write(sub.content)
-
-                if not self.sub_no_fix:
-                    sub_path = convert_subtitles(
-                        self.tmp, self.filename, sub_type="vtt"
-                    )
-
-                self.sub_path = sub_path
 
         if self.skip_download:
             self.log.info(f"Filename: {self.filename}")
@@ -502,7 +447,7 @@ class CHANNEL4(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
                 click.echo("")
             except Exception as e:
                 raise ValueError(f"{e}")
@@ -14,29 +14,28 @@ import hashlib
 import hmac
 import json
 import re
-import subprocess
 import sys
-import time
 from collections import Counter
 from datetime import datetime
 from pathlib import Path
 from urllib.parse import urlparse, urlunparse
 
 import click
-from bs4 import BeautifulSoup
 from Crypto.Cipher import AES
 from Crypto.Util.Padding import unpad
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Movie, Movies, Series
 from utils.utilities import (
     force_numbering,
     append_id,
     get_wvd,
-    in_cache,
     kid_to_pssh,
     set_filename,
     set_save_path,
@@ -154,25 +153,19 @@ class CHANNEL5(Config):
 
         return manifest, lic_url
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str) -> tuple:
-        r = self.client.get(manifest)
-        r.raise_for_status()
-
-        self.soup = BeautifulSoup(r.text, "xml")
-        elements = self.soup.find_all("Representation")
-        heights = sorted(
-            [int(x.attrs["height"]) for x in elements if x.attrs.get("height")],
-            reverse=True,
-        )
+        mpd = load_mpd(self.client, manifest)
+        heights = mpd.heights
 
         if quality is not None:
             if int(quality) in heights:
-                return quality
+                return quality, mpd
             else:
                 closest_match = min(heights, key=lambda x: abs(int(x) - int(quality)))
-                return closest_match
+                return closest_match, mpd
 
-        return heights[0]
+        return heights[0], mpd
 
     def get_content(self, url: str) -> tuple:
         if self.movie:
@@ -257,20 +250,12 @@ class CHANNEL5(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(f"Slowing things down for {self.slowdown} seconds..."):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest, lic_url = self.get_playlist(stream.id)
-        self.res = self.get_mediainfo(manifest, self.quality)
-        pssh = kid_to_pssh(self.soup)
+        self.res, mpd = self.get_mediainfo(manifest, self.quality)
+        pssh = kid_to_pssh(mpd)
 
         keys = self.get_keys(pssh, lic_url)
         with open(self.tmp / "keys.txt", "w") as file:
@@ -291,7 +276,7 @@ class CHANNEL5(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
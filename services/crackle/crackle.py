@@ -10,25 +10,24 @@ Info:
 from __future__ import annotations
 
 import json
-import subprocess
-import time
 from collections import Counter
 from pathlib import Path
 from urllib.parse import urlparse
 
 import click
-from bs4 import BeautifulSoup
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Movie, Movies, Series
 from utils.utilities import (
     force_numbering,
     append_id,
     get_wvd,
-    in_cache,
     kid_to_pssh,
     set_filename,
     set_save_path,
@@ -136,28 +135,20 @@ class CRACKLE(Config):
 
         return lic_url, manifest
 
-    def get_mediainfo(self, manifest: str, quality: str) -> str:
-        r = self.client.get(manifest)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.content, "xml")
-        new_manifest = soup.select_one("BaseURL").text + "index.mpd"
-        r = self.client.get(new_manifest)
-        r.raise_for_status()
-        self.soup = BeautifulSoup(r.content, "xml")
-        elements = self.soup.find_all("Representation")
-        heights = sorted(
-            [int(x.attrs["height"]) for x in elements if x.attrs.get("height")],
-            reverse=True,
-        )
+    @timed("mediainfo")
+    def get_mediainfo(self, manifest: str, quality: str) -> tuple:
+        new_manifest = load_mpd(self.client, manifest).base_urls[0] + "index.mpd"
+        mpd = load_mpd(self.client, new_manifest)
+        heights = mpd.heights
 
         if quality is not None:
             if int(quality) in heights:
-                return quality
+                return quality, mpd
             else:
                 closest_match = min(heights, key=lambda x: abs(int(x) - int(quality)))
-                return closest_match
+                return closest_match, mpd
 
-        return heights[0]
+        return heights[0], mpd
 
     def get_content(self, url: str) -> object:
         if self.movie:
@@ -221,22 +212,12 @@ class CRACKLE(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         lic_url, manifest = self.get_playlist(stream.id)
-        self.res = self.get_mediainfo(manifest, self.quality)
-        pssh = kid_to_pssh(self.soup)
+        self.res, mpd = self.get_mediainfo(manifest, self.quality)
+        pssh = kid_to_pssh(mpd)
 
         keys = self.get_keys(pssh, lic_url)
         with open(self.tmp / "keys.txt", "w") as file:
@@ -257,7 +238,7 @@ class CRACKLE(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
@@ -10,32 +10,31 @@ from __future__ import annotations
 
 import asyncio
 import json
-import subprocess
-import time
 import sys
 from collections import Counter
-from datetime import datetime
 from pathlib import Path
 from urllib.parse import urlparse
 
 import click
 import httpx
-import requests
-import yaml
-from bs4 import BeautifulSoup
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.manifests import manifest_cache
+from utils.metrics import timed
+from utils.mpd import add_representation, load_mpd
+from utils.options import batch_download, get_downloads
+from utils.server import manifest_server
+from utils.subtitles import fetch_subtitles
 from utils.titles import Episode, Movie, Movies, Series
+from utils.tokens import Token, token_store
 from utils.utilities import (
     append_id,
-    convert_subtitles,
     force_numbering,
     from_mpd,
     get_wvd,
-    in_cache,
     pssh_from_init,
     set_filename,
     set_save_path,
@@ -67,28 +66,18 @@ class CTV(Config):
         self.get_options()
 
     def get_auth_token(self):
-        cache = self.config.get("cache")
-
-        if not cache:
-            self.log.info("Cache is empty, aquiring new tokens...")
-            token = self.authenticate()
-        elif cache and cache.get("expiry") < datetime.now():
-            self.log.info("Refreshing expired tokens...")
-            token = self.refresh_token()
-        else:
-            self.log.info("Using cached tokens")
-            token = cache.get("token")
-
-        return token
+        return token_store.get(
+            "ctv", self.authenticate, self.refresh_token, profile=self.username
+        ).value
 
-    def refresh_token(self):
+    def refresh_token(self, token: Token) -> Token:
         headers = {"authorization": f"Basic {self.config['auth']}"}
 
         data = {
             "grant_type": "refresh_token",
             "username": self.username,
             "password": self.password,
-            "refresh_token": self.config["cache"]["refresh"],
+            "refresh_token": token.refresh,
         }
 
         r = self.client.post(self.login, headers=headers, data=data)
@@ -96,27 +85,15 @@ class CTV(Config):
             raise ConnectionError(f"{r} {r.text}")
 
         auth = json.loads(r.content)
-        token = auth.get("access_token")
-        refresh = auth.get("refresh_token")
-
-        expiry = expiration(auth.get("expires_in"), auth.get("creation_date"))
-
-        profile = Path("services") / "ctv" / "profile.yaml"
-        with open(profile, "r") as f:
-            data = yaml.safe_load(f)
-
-        data["cache"]["token"] = token
-        data["cache"]["refresh"] = refresh
-        data["cache"]["expiry"] = expiry
-
-        with open(profile, "w") as f:
-            yaml.safe_dump(data, f, sort_keys=False)
-
         self.log.info("+ Tokens refreshed")
 
-        return token
+        return Token(
+            auth.get("access_token"),
+            expiry=expiration(auth.get("expires_in"), auth.get("creation_date")),
+            refresh=auth.get("refresh_token"),
+        )
 
-    def authenticate(self):
+    def authenticate(self) -> Token:
         if not self.username and not self.password:
             self.log.error(
                 "Required credentials were not found. See 'freevine.py profile --help'"
@@ -138,23 +115,13 @@ class CTV(Config):
             raise ConnectionError(f"{r} {r.text}")
 
         auth = json.loads(r.content)
-        token = auth.get("access_token")
-        refresh = auth.get("refresh_token")
-
-        expiry = expiration(auth.get("expires_in"), auth.get("creation_date"))
-
-        profile = Path("services") / "ctv" / "profile.yaml"
-        with open(profile, "r") as f:
-            data = yaml.safe_load(f)
-
-        data["cache"] = {"token": token, "expiry": expiry, "refresh": refresh}
-
-        with open(profile, "w") as f:
-            yaml.safe_dump(data, f, sort_keys=False)
-
         self.log.info("+ New tokens placed in cache")
 
-        return token
+        return Token(
+            auth.get("access_token"),
+            expiry=expiration(auth.get("expires_in"), auth.get("creation_date")),
+            refresh=auth.get("refresh_token"),
+        )
 
     def get_license(self, challenge: bytes, lic_url: str) -> bytes:
         r = self.client.post(url=lic_url, data=challenge)
@@ -327,14 +294,12 @@ class CTV(Config):
         subtitle = f"{base}/{id}/contentPackages/{pkg_id}/manifest.vtt"
         return manifest, subtitle
 
-    def get_init(self, soup):
-        base = soup.select_one("BaseURL").text
+    def get_init(self, mpd: object):
+        base = mpd.base_urls[0]
 
-        rep_id = soup.select_one("Representation").attrs.get("id")
-        template = (
-            soup.select_one("SegmentTemplate")
-            .attrs.get("initialization")
-            .replace("$RepresentationID$", f"{rep_id}")
+        representation = mpd.representations[0]
+        template = representation.template.initialization.replace(
+            "$RepresentationID$", f"{representation.id}"
         )
 
         r = self.client.get(f"{base}{template}")
@@ -350,7 +315,9 @@ class CTV(Config):
         if not response.is_success:
             raise ConnectionError(f"{response}")
 
-        return from_mpd(response.text, url)
+        # Looked up with the session in get_mediainfo
+        manifest_cache.put(url, response.content, self.client)
+        return from_mpd(response.content, url)
 
     async def parse_manifests(self, data: dict) -> list:
         headers = {"authorization": f"Bearer {self.auth}"} if self.auth else {}
@@ -358,6 +325,7 @@ class CTV(Config):
             tasks = [self.fetch_manifests(async_client, x) for x in data]
             return await asyncio.gather(*tasks)
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str) -> str:
         content = asyncio.run(
             self.parse_manifests(
@@ -375,40 +343,37 @@ class CTV(Config):
                 (t["id"] for t in streams if "id" in t and "-dv-" in t["id"]), None
             )
 
-        r = self.client.get(manifest)
-        self.soup = BeautifulSoup(r.text, "xml")
+        data = manifest_cache.get(self.client, manifest)
+        mpd = load_mpd(self.client, manifest)
 
-        tags = self.soup.find_all("Representation")
-        codecs = [x.attrs["codecs"] for x in tags if x.attrs.get("codecs")]
-        heights = sorted(
-            [int(x.attrs["height"]) for x in tags if x.attrs.get("height")],
-            reverse=True,
-        )
+        codecs = mpd.codecs
+        heights = mpd.heights
 
         audio = "DD5.1" if "ac-3" in codecs else "AAC2.0"
 
+        text = data.decode("utf-8")
         if dv_audio:
-            self.soup.find("AdaptationSet", {"contentType": "audio"}).append(
-                self.soup.new_tag(
-                    "Representation",
-                    id=f"{dv_audio}",
-                    codecs="mp4a.40.2",
-                    mimeType="audio/mp4",
-                    bandwidth="128000",
-                )
+            text = add_representation(
+                text,
+                "audio",
+                {
+                    "id": f"{dv_audio}",
+                    "codecs": "mp4a.40.2",
+                    "mimeType": "audio/mp4",
+                    "bandwidth": "128000",
+                },
             )
 
-        with open(self.tmp / "manifest.mpd", "w") as f:
-            f.write(str(self.soup.prettify()))
+        self.manifest = manifest_server.serve(text)
 
         if quality is not None:
             if int(quality) in heights:
-                return quality, audio
+                return quality, audio, mpd
             else:
                 closest_match = min(heights, key=lambda x: abs(int(x) - int(quality)))
-                return closest_match, audio
+                return closest_match, audio, mpd
 
-        return heights[0], audio
+        return heights[0], audio, mpd
 
     def get_content(self, url: str) -> object:
         if self.movie:
@@ -493,22 +458,17 @@ class CTV(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest, subtitle = self.get_playlist(stream.data, stream.id)
-        self.res, audio = self.get_mediainfo(manifest, self.quality)
-        pssh = self.get_init(self.soup)
+        self.sub_path = (
+            fetch_subtitles(self, subtitle, stream.id, sub_type="vtt")
+            if subtitle is not None and not self.skip_download
+            else None
+        )
+        self.res, audio, mpd = self.get_mediainfo(manifest, self.quality)
+        pssh = self.get_init(mpd)
 
         keys = self.get_keys(pssh, self.lic_url)
         with open(self.tmp / "keys.txt", "w") as file:
@@ -516,31 +476,13 @@ class CTV(Config):
 
         self.filename = set_filename(self, stream, self.res, audio)
         self.save_path = set_save_path(stream, self, title)
-        self.manifest = self.tmp / "manifest.mpd"
         self.key_file = self.tmp / "keys.txt"
-        self.sub_path = None
 
         self.log.info(f"{str(stream)}")
         click.echo("")
 
         if subtitle is not None and not self.skip_download:
             self.log.info(f"Subtitles: {subtitle}")
-            try:
-                sub = self.client.get(subtitle)
-                sub.raise_for_status()
-            except requests.exceptions.HTTPError:
-                self.log.warning(f"Subtitle response {sub.status_code}, skipping")
-            else:
-                sub_path = self.tmp / f"{self.filename}.vtt"
-                with open(sub_path, "wb") as f:
-                    f.write(sub.content)
-
-                if not self.sub_no_fix:
-                    sub_path = convert_subtitles(
-                        self.tmp, self.filename, sub_type="vtt"
-                    )
-
-                self.sub_path = sub_path
 
         if self.skip_download:
             self.log.info(f"Filename: {self.filename}")
@@ -552,7 +494,7 @@ class CTV(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
@@ -10,8 +10,6 @@ from __future__ import annotations
 
 import json
 import re
-import subprocess
-import time
 from collections import Counter
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
@@ -19,19 +17,21 @@ from urllib.parse import urlparse, urlunparse
 
 import click
 import httpx
-import m3u8
 from bs4 import BeautifulSoup
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.hls import load_master
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Movie, Movies, Series
 from utils.utilities import (
     append_id,
     force_numbering,
     get_wvd,
-    in_cache,
     set_filename,
     set_save_path,
     string_cleaning,
@@ -145,18 +145,8 @@ class CW(Config):
 
         return manifest, lic_url
 
-    def get_pssh(self, soup: str) -> str:
-        system = re.compile(
-            r"urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed", re.IGNORECASE
-        )
-        return soup.find("ContentProtection", {"schemeIdUri": system}).text
-
-    def get_dash_quality(self, soup: object, quality: str) -> str:
-        elements = soup.find_all("Representation")
-        heights = sorted(
-            [int(x.attrs["height"]) for x in elements if x.attrs.get("height")],
-            reverse=True,
-        )
+    def get_dash_quality(self, mpd: object, quality: str) -> str:
+        heights = mpd.heights
         res = heights[0]
 
         if quality is not None:
@@ -168,16 +158,10 @@ class CW(Config):
         return res
 
     def get_hls_quality(self, manifest: str, quality: str) -> str:
-        r = httpx.get(manifest)
-        r.raise_for_status()
-        m3u8_obj = m3u8.loads(r.text)
+        master = load_master(httpx, manifest)
 
-        playlists = []
-        if m3u8_obj.is_variant:
-            for playlist in m3u8_obj.playlists:
-                playlists.append(playlist.stream_info.resolution[1])
-
-            heights = sorted([x for x in playlists], reverse=True)
+        if master.is_variant:
+            heights = master.heights
             res = heights[0]
 
         if quality is not None:
@@ -188,13 +172,12 @@ class CW(Config):
 
         return res
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str) -> str:
         if manifest.endswith(".mpd"):
-            r = httpx.get(manifest)
-            r.raise_for_status()
-            self.soup = BeautifulSoup(r.content, "xml")
-            pssh = self.get_pssh(self.soup)
-            res = self.get_dash_quality(self.soup, quality)
+            mpd = load_mpd(httpx, manifest)
+            pssh = mpd.pssh()
+            res = self.get_dash_quality(mpd, quality)
 
         if manifest.endswith(".m3u8"):
             pssh = None
@@ -261,17 +244,7 @@ class CW(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest, lic_url = self.get_playlist(stream.data)
@@ -296,7 +269,7 @@ class CW(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
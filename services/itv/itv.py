@@ -9,8 +9,6 @@ ITV L3 is 720p, AAC 2.0 max
 from __future__ import annotations
 
 import json
-import subprocess
-import time
 from collections import Counter
 from pathlib import Path
 
@@ -21,15 +19,19 @@ from bs4 import BeautifulSoup
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.manifests import manifest_cache
+from utils.metrics import timed
+from utils.mpd import append_template_params, load_mpd, replace_base_url
+from utils.options import batch_download, get_downloads
+from utils.server import manifest_server
+from utils.subtitles import fetch_subtitles
 from utils.titles import Episode, Movie, Movies, Series
 from utils.utilities import (
     append_id,
     construct_pssh,
-    convert_subtitles,
     force_numbering,
     get_wvd,
-    in_cache,
     set_filename,
     set_save_path,
     string_cleaning,
@@ -136,37 +138,30 @@ class ITV(Config):
 
         return mpd_url, lic_url, subtitle
 
-    def get_mediainfo(self, manifest: str, quality: str) -> str:
-        r = requests.get(manifest)
-        r.raise_for_status()
-
-        self.soup = BeautifulSoup(r.content, "xml")
-        elements = self.soup.find_all("Representation")
-        heights = sorted(
-            [int(x.attrs["height"]) for x in elements if x.attrs.get("height")],
-            reverse=True,
-        )
-
+    def rewrite_manifest(self, data: bytes, manifest: str) -> str:
         new_base, params = manifest.split(".mpd")
         new_base += "dash/"
-        self.soup.select_one("BaseURL").string = new_base
 
-        segments = self.soup.find_all("SegmentTemplate")
-        for segment in segments:
-            segment["media"] += params
-            segment["initialization"] += params
+        text = replace_base_url(data.decode("utf-8"), new_base)
+        return append_template_params(text, params)
 
-        with open(self.tmp / "manifest.mpd", "w") as f:
-            f.write(str(self.soup.prettify()))
+    @timed("mediainfo")
+    def get_mediainfo(self, manifest: str, quality: str) -> tuple:
+        mpd = load_mpd(requests, manifest)
+        heights = mpd.heights
+
+        self.manifest = manifest_server.serve(
+            self.rewrite_manifest(manifest_cache.get(requests, manifest), manifest)
+        )
 
         if quality is not None:
             if int(quality) in heights:
-                return quality
+                return quality, mpd
             else:
                 closest_match = min(heights, key=lambda x: abs(int(x) - int(quality)))
-                return closest_match
+                return closest_match, mpd
 
-        return heights[0]
+        return heights[0], mpd
 
     def get_content(self, url: str) -> object:
         if self.movie:
@@ -224,25 +219,24 @@ class ITV(Config):
 
         return [episode[0]], title
 
+    def get_subtitles(self, stream: object) -> tuple:
+        _, _, subtitle = self.get_playlist(stream.data)
+        return subtitle, "vtt"
+
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest, lic_url, subtitle = self.get_playlist(stream.data)
-        self.res = self.get_mediainfo(manifest, self.quality)
-        pssh = construct_pssh(self.soup)
+        self.sub_path = (
+            fetch_subtitles(self, subtitle, stream.id, sub_type="vtt")
+            if subtitle is not None and not self.skip_download
+            else None
+        )
+        self.res, mpd = self.get_mediainfo(manifest, self.quality)
+        pssh = construct_pssh(mpd)
 
         keys = self.get_keys(pssh, lic_url)
         with open(self.tmp / "keys.txt", "w") as file:
@@ -250,29 +244,13 @@ class ITV(Config):
 
         self.filename = set_filename(self, stream, self.res, audio="AAC2.0")
         self.save_path = set_save_path(stream, self, title)
-        self.manifest = self.tmp / "manifest.mpd"
         self.key_file = self.tmp / "keys.txt"
-        self.sub_path = None
 
         self.log.info(f"{str(stream)}")
         click.echo("")
 
         if subtitle is not None and not self.skip_download:
             self.log.info(f"Subtitles: {subtitle}")
-            try:
-                sub = self.client.get(subtitle)
-                sub.raise_for_status()
-            except requests.exceptions.HTTPError:
-                self.log.warning(f"Subtitle response {sub.status_code}, skipping")
-            else:
-                sub_path = self.tmp / f"{self.filename}.vtt"
-                with open(sub_path, "wb") as f:
-                    f.write(sub.content)
-
-                if not self.sub_no_fix:
-                    sub_path = convert_subtitles(self.tmp, self.filename, sub_type="vtt")
-                
-                self.sub_path = sub_path
 
         if self.skip_download:
             self.log.info(f"Filename: {self.filename}")
@@ -284,7 +262,7 @@ class ITV(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
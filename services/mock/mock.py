@@ -0,0 +1,167 @@
+"""
+MOCK
+Author: freevine
+
+Info:
+Test service for the local mock streaming service in benchmarks/mock, so the
+whole get flow can run offline. Start the server first:
+
+    python -m benchmarks.mock.server
+
+and download from it with:
+
+    freevine.py get --complete https://mock.freevine.test/series/example
+
+
+"""
+from __future__ import annotations
+
+import json
+import sys
+from collections import Counter
+from urllib.parse import urlparse
+
+from utils.args import get_args
+from utils.config import Config
+from utils.downloader import run_downloader
+from utils.hls import load_master
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
+from utils.subtitles import fetch_subtitles
+from utils.titles import Episode, Series
+from utils.utilities import (
+    append_id,
+    force_numbering,
+    set_filename,
+    set_save_path,
+    string_cleaning,
+    update_cache,
+)
+
+
+class MOCK(Config):
+    def __init__(self, config, **kwargs):
+        super().__init__(config, **kwargs)
+
+        with self.config["download_cache"].open("r") as file:
+            self.cache = json.load(file)
+
+        self.get_options()
+
+    def get_data(self, url: str) -> dict:
+        slug = urlparse(url).path.split("/")[2]
+
+        r = self.client.get(self.config["series"].format(api=self.config["api"], slug=slug))
+        r.raise_for_status()
+        return r.json()
+
+    def get_series(self, url: str) -> Series:
+        data = self.get_data(url)
+
+        return Series(
+            [
+                Episode(
+                    id_=episode["id"],
+                    service="MOCK",
+                    title=data["title"],
+                    season=int(season["number"]),
+                    number=int(episode["number"]),
+                    name=episode["title"],
+                    year=data["year"],
+                    data=episode["manifest"],
+                    subtitle=episode.get("subtitles"),
+                )
+                for season in data["seasons"]
+                for episode in season["episodes"]
+            ]
+        )
+
+    @timed("mediainfo")
+    def get_mediainfo(self, manifest: str, quality: str) -> tuple:
+        if manifest.endswith(".m3u8"):
+            heights = load_master(self.client, manifest).heights
+        else:
+            heights = load_mpd(self.client, manifest).heights
+
+        if quality is not None:
+            if int(quality) in heights:
+                return int(quality)
+            return min(heights, key=lambda x: abs(x - int(quality)))
+
+        return heights[0]
+
+    def get_content(self, url: str) -> object:
+        if self.movie:
+            self.log.error("The mock service only has series")
+            sys.exit(1)
+
+        with self.console.status("Fetching series titles..."):
+            content = self.get_series(url)
+
+            title = string_cleaning(str(content))
+            seasons = Counter(x.season for x in content)
+            num_seasons = len(seasons)
+            num_episodes = sum(seasons.values())
+
+            if self.force_numbering:
+                content = force_numbering(content)
+            if self.append_id:
+                content = append_id(content)
+
+        self.log.info(
+            f"{str(content)}: {num_seasons} Season(s), {num_episodes} Episode(s)\n"
+        )
+
+        return content, title
+
+    def get_episode_from_url(self, url: str):
+        # https://mock.freevine.test/series/<slug>/<episode id>
+        episode_id = urlparse(url).path.split("/")[3]
+
+        with self.console.status("Getting episode from URL..."):
+            episode = [x for x in self.get_series(url) if x.id == episode_id]
+
+        if not episode:
+            self.log.error(f"{episode_id} was not found")
+            sys.exit(1)
+
+        title = string_cleaning(str(Series(episode)))
+
+        return [episode[0]], title
+
+    def get_subtitles(self, stream: object) -> tuple:
+        return stream.subtitle, "vtt"
+
+    def get_options(self) -> None:
+        downloads, title = get_downloads(self)
+
+        batch_download(self, downloads, title)
+
+    def download(self, stream: object, title: str) -> None:
+        self.sub_path = (
+            fetch_subtitles(self, stream.subtitle, stream.id, sub_type="vtt")
+            if stream.subtitle is not None and not self.skip_download
+            else None
+        )
+        self.res = self.get_mediainfo(stream.data, self.quality)
+
+        self.filename = set_filename(self, stream, self.res, audio="AAC2.0")
+        self.save_path = set_save_path(stream, self, title)
+        self.manifest = stream.data
+        self.key_file = None
+
+        self.log.info(f"{str(stream)}")
+
+        args, file_path = get_args(self)
+
+        if not file_path.exists():
+            try:
+                run_downloader(self, args, file_path)
+            except Exception as e:
+                raise ValueError(f"{e}")
+        else:
+            self.log.warning(f"{self.filename} already exists. Skipping download...\n")
+
+        if not self.skip_download and file_path.exists():
+            update_cache(self.cache, self.config, stream)
@@ -12,22 +12,23 @@ from __future__ import annotations
 
 import asyncio
 import re
-import subprocess
 import json
-import time
 from collections import Counter
 from pathlib import Path
 from urllib.parse import urlparse
 
 import click
 import httpx
-from bs4 import BeautifulSoup
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Movie, Movies, Series
+from utils.tokens import Token, token_store
 from utils.utilities import (
     force_numbering,
     append_id,
@@ -37,7 +38,6 @@ from utils.utilities import (
     set_save_path,
     string_cleaning,
     is_url,
-    in_cache,
     update_cache,
 )
 
@@ -77,14 +77,21 @@ class Plex(Config):
         response = self.get_license(challenge, lic_url)
         return widevine.parse(response)
 
-    def get_auth_token(self) -> str:
+    def anonymous_user(self) -> Token:
         r = self.client.post(self.config["user"])
         if not r.ok:
             raise ConnectionError(r.json()["Error"].get("message"))
 
-        self.auth_token = r.json()["authToken"]
+        # Anonymous tokens don't say when they expire, so they're renewed daily
+        return Token(r.json()["authToken"], expires_in=86400)
+
+    def get_auth_token(self) -> str:
+        self.auth_token = token_store.get("plex", self.anonymous_user).value
         return self.auth_token
 
+    def resume_session(self, downloads: list) -> None:
+        self.client.headers.update({"x-plex-token": self.get_auth_token()})
+
     def get_data(self, url: str) -> dict:
         kind, video_id = urlparse(url).path.split("/")[-2:]
 
@@ -184,12 +191,8 @@ class Plex(Config):
             ]
         )
 
-    def get_dash_quality(self, soup: object, quality: str) -> str:
-        elements = soup.find_all("Representation")
-        heights = sorted(
-            [int(x.attrs["height"]) for x in elements if x.attrs.get("height")],
-            reverse=True,
-        )
+    def get_dash_quality(self, mpd: object, quality: str) -> str:
+        heights = mpd.heights
         if not heights:
             self.log.warning("Manifest did not contain proper media info, using 720p as placeholder...")
             resolution = 720
@@ -205,12 +208,11 @@ class Plex(Config):
 
         return resolution
 
+    @timed("mediainfo")
     def get_mediainfo(self, stream: object, quality: str) -> str:
-        r = self.client.get(stream.data)
-        r.raise_for_status()
-        self.soup = BeautifulSoup(r.content, "xml")
-        pssh = kid_to_pssh(self.soup) if stream.drm else None
-        quality = self.get_dash_quality(self.soup, quality)
+        mpd = load_mpd(self.client, stream.data)
+        pssh = kid_to_pssh(mpd) if stream.drm else None
+        quality = self.get_dash_quality(mpd, quality)
 
         self.sub_lang = None
         if stream.subtitle:
@@ -248,17 +250,7 @@ class Plex(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         self.res, pssh = self.get_mediainfo(stream, self.quality)
@@ -292,7 +284,7 @@ class Plex(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
@@ -16,30 +16,31 @@ from __future__ import annotations
 import base64
 import json
 import re
-import subprocess
 import sys
-import time
-import uuid
 from collections import Counter
+from functools import partial
 from pathlib import Path
+from typing import Iterator
 from urllib.parse import urlparse
 
 import click
-import m3u8
-import requests
-from bs4 import BeautifulSoup
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.hls import iter_segments, load_master, parse_master
+from utils.manifests import manifest_cache
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
+from utils.server import manifest_server
 from utils.titles import Episode, Movie, Movies, Series
+from utils.tokens import pluto_session, region, token_store
 from utils.utilities import (
     append_id,
     force_numbering,
     get_wvd,
-    in_cache,
-    is_path,
     is_url,
     set_filename,
     set_save_path,
@@ -78,38 +79,29 @@ class PLUTO(Config):
         response = self.get_license(challenge, lic_url)
         return widevine.parse(response)
 
+    def get_session(self) -> None:
+        # Shared with search and other jobs in the same region until it's about to expire
+        token = token_store.get(
+            "pluto", partial(pluto_session, self.client), region=region(self.proxy)
+        )
+        self.token = token.value
+        self.client.headers.update({"Authorization": f"Bearer {self.token}"})
+        self.client.params = token.data["params"]
+
+    def resume_session(self, downloads: list) -> None:
+        self.get_session()
+
     def get_data(self, url: str) -> dict:
         type = urlparse(url).path.split("/")[3]
         video_id = urlparse(url).path.split("/")[4]
 
-        params = {
-            "appName": "web",
-            "appVersion": "na",
-            "clientID": str(uuid.uuid1()),
-            "deviceDNT": 0,
-            "deviceId": "unknown",
-            "clientModelNumber": "na",
-            "serverSideAds": "false",
-            "deviceMake": "unknown",
-            "deviceModel": "web",
-            "deviceType": "web",
-            "deviceVersion": "unknown",
-            "sid": str(uuid.uuid1()),
-            "drmCapabilities": "widevine:L3",
-        }
-
-        response = self.client.get("https://boot.pluto.tv/v4/start", params=params)
-        response.raise_for_status()
-
-        self.token = response.json()["sessionToken"]
+        self.get_session()
 
         info = (
             f"{self.api}/series/{video_id}/seasons"
             if type == "series"
             else f"{self.api}/items?ids={video_id}"
         )
-        self.client.headers.update({"Authorization": f"Bearer {self.token}"})
-        self.client.params = params
 
         r = self.client.get(info)
         if not r.ok:
@@ -158,10 +150,7 @@ class PLUTO(Config):
         base = "https://cfd-v4-service-stitcher-dash-use1-1.prd.pluto.tv/v2"
 
         url = f"{base}{stitch}"
-        r = self.client.get(url)
-        r.raise_for_status()
-        soup = BeautifulSoup(r.content, "xml")
-        base_urls = soup.find_all("BaseURL")
+        base_urls = load_mpd(self.client, url).base_urls
         ads = (
             "Pluto_TV_OandO",
             "_ad/",
@@ -171,8 +160,8 @@ class PLUTO(Config):
             "WarningCard",
         )
         for base_url in base_urls:
-            if not any(ad in base_url.text for ad in ads):
-                new_base = base_url.text
+            if not any(ad in base_url for ad in ads):
+                new_base = base_url
 
         parse = urlparse(new_base)
         _path = parse.path.split("/")
@@ -195,14 +184,10 @@ class PLUTO(Config):
         url = f"{base}{stitch}"
         response = self.client.get(url).text
 
-        pattern = r"#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=(\d+)"
-        matches = re.findall(pattern, response)
+        variants = parse_master(response).variants
+        max_bandwidth = max((x.bandwidth or 0) for x in variants if x.program_id == 1)
+        url = url.replace("master.m3u8", f"{max_bandwidth}/playlist.m3u8")
 
-        max_bandwidth = sorted(matches, key=int, reverse=True)
-        url = url.replace("master.m3u8", f"{max_bandwidth[0]}/playlist.m3u8")
-
-        response = self.client.get(url).text
-        playlist = m3u8.loads(response)
         ads = (
             "Pluto_TV_OandO",
             "_ad/",
@@ -211,9 +196,17 @@ class PLUTO(Config):
             "Promo/",
             "WarningCard",
         )
-        for seg in playlist.segments:
-            if not any(ad in seg.uri for ad in ads):
-                segment = seg.uri
+        # Stitched playlists of long movies are huge, so scan them as they
+        # arrive and only keep the last content segment
+        segment = None
+        with self.client.get(url, stream=True) as r:
+            r.raise_for_status()
+            for uri in iter_segments(r.iter_lines()):
+                if not any(ad in uri for ad in ads):
+                    segment = uri
+
+        if segment is None:
+            raise ValueError("Unable to find content in stitched playlist")
 
         if "hls/hls" in segment:
             master = re.sub(r"hls_\d+-\d+\.ts$", "", segment)
@@ -228,30 +221,25 @@ class PLUTO(Config):
             netloc="silo-hybrik.pluto.tv.s3.amazonaws.com",
         ).geturl()
 
-        # TODO: Determine DRM without extra request
-        response = requests.get(master).text
+        # The master is on S3, which rejects the session's bearer token. It's
+        # cached, so get_hls_quality reuses it instead of requesting it again
+        response = manifest_cache.get(
+            self.client, master, headers={"Authorization": None}
+        ).decode("utf-8")
         if re.search(r'#PLUTO-DRM:ID="fairplay"', response):
             self.base_url = master.rsplit("master.m3u8")[0]
-            manifest = self.create_manifest(response, master.rsplit("master.m3u8")[0])
-            with open(self.tmp / "manifest.m3u8", "w") as f:
-                f.write(manifest)
-
-            master = Path(self.tmp / "manifest.m3u8")
+            master = manifest_server.serve(
+                partial(self.create_manifest, response, self.base_url), "manifest.m3u8"
+            )
 
         return master
 
-    def create_manifest(self, text, url) -> str:
-        lines = text.split("\n")
-        for i in range(len(lines)):
-            lines[i] = lines[i].replace("fp/", "")
+    def create_manifest(self, text, url) -> Iterator[str]:
+        for line in text.splitlines(keepends=True):
+            line = line.replace("fp/", "")
+            yield url + line if "hls_" in line else line
 
-            if "hls_" in lines[i]:
-                lines[i] = url + lines[i]
-
-        text = "\n".join(lines)
-        return text
-
-    def get_playlist(self, playlists: str) -> Path | str:
+    def get_playlist(self, playlists: str) -> str:
         hls = next((x for x in playlists if x.endswith(".m3u8")), None)
         dash = next((x for x in playlists if x.endswith(".mpd")), None)
 
@@ -266,19 +254,10 @@ class PLUTO(Config):
 
         return manifest
 
-    def get_dash_quality(self, soup: object, quality: str) -> str:
-        elements = soup.find_all("Representation")
-        heights = sorted(
-            [int(x.attrs["height"]) for x in elements if x.attrs.get("height")],
-            reverse=True,
-        )
-
-        # 720p on Pluto is in the adaptationset rather than representation
-        adaptation_sets = soup.find_all("AdaptationSet")
-        for item in adaptation_sets:
-            if item.attrs.get("height"):
-                heights.append(int(item.attrs["height"]))
-                heights.sort(reverse=True)
+    def get_dash_quality(self, mpd: object, quality: str) -> str:
+        # 720p on Pluto is in the adaptationset rather than representation,
+        # which the parsed representations inherit
+        heights = mpd.heights
 
         if quality is not None:
             if int(quality) in heights:
@@ -291,17 +270,17 @@ class PLUTO(Config):
 
     def get_hls_quality(self, manifest, quality: str) -> str:
         self.client.headers.pop("Authorization")
-        if is_path(manifest):
-            m3u8_obj = m3u8.load(str(manifest))
+        local = manifest_server.render(manifest)
+        if local is not None:
+            master = parse_master(local, manifest)
         else:
-            r = self.client.get(manifest)
-            r.raise_for_status()
-            m3u8_obj = m3u8.loads(r.text)
+            master = load_master(self.client, manifest)
 
         playlists = []
-        if m3u8_obj.is_variant:
-            for playlist in m3u8_obj.playlists:
-                playlists.append((playlist.stream_info.resolution[1], playlist.uri))
+        if master.is_variant:
+            for variant in master.variants:
+                if variant.height:
+                    playlists.append((variant.height, variant.uri))
 
             heights = sorted([x[0] for x in playlists], reverse=True)
             res = heights[0]
@@ -322,30 +301,22 @@ class PLUTO(Config):
         array_of_bytes.extend(bytes.fromhex(kid.replace("-", "")))
         return base64.b64encode(bytes.fromhex(array_of_bytes.hex())).decode("utf-8")
 
-    def get_pssh(self, soup) -> str:
-        tags = soup.find_all("ContentProtection")
-        kids = set(
-            [
-                x.attrs.get("cenc:default_KID").replace("-", "")
-                for x in tags
-                if x.attrs.get("cenc:default_KID")
-            ]
-        )
+    def get_pssh(self, mpd: object) -> str:
+        kids = {kid.replace("-", "") for kid in mpd.kids}
 
         return [self.generate_pssh(kid) for kid in kids]
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str, pssh=None) -> str:
-        if is_path(manifest) or manifest.endswith(".m3u8"):
+        if manifest.endswith(".m3u8"):
             quality = self.get_hls_quality(manifest, quality)
             return quality, pssh
 
         elif manifest.endswith(".mpd"):
             self.client.headers.pop("Authorization")
-            r = self.client.get(manifest)
-            r.raise_for_status()
-            self.soup = BeautifulSoup(r.content, "xml")
-            pssh = self.get_pssh(self.soup)
-            quality = self.get_dash_quality(self.soup, quality)
+            mpd = load_mpd(self.client, manifest)
+            pssh = self.get_pssh(mpd)
+            quality = self.get_dash_quality(mpd, quality)
             return quality, pssh
 
     def get_content(self, url: str) -> object:
@@ -379,17 +350,7 @@ class PLUTO(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest = self.get_playlist(stream.data)
@@ -415,7 +376,7 @@ class PLUTO(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
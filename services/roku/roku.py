@@ -13,26 +13,27 @@ from __future__ import annotations
 import concurrent.futures
 import json
 import re
-import subprocess
-import time
 import urllib
 from collections import Counter
+from functools import partial
 from pathlib import Path
 from urllib.parse import urlparse
 
 import click
-from bs4 import BeautifulSoup
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Movie, Movies, Series
+from utils.tokens import region, roku_csrf, token_store
 from utils.utilities import (
     append_id,
     force_numbering,
     get_wvd,
-    in_cache,
     set_filename,
     set_save_path,
     string_cleaning,
@@ -120,13 +121,17 @@ class ROKU(Config):
             ]
         )
 
-    def get_playlist(self, id: str) -> tuple:
-        response = self.client.get("https://therokuchannel.roku.com/api/v1/csrf").json()
-
-        token = response["csrf"]
+    def get_csrf(self) -> str:
+        # One token for the whole batch instead of one per episode
+        token = token_store.get(
+            "roku", partial(roku_csrf, self.client), region=region(self.proxy)
+        )
+        self.client.cookies.update(token.data["cookies"])
+        return token.value
 
+    def get_playlist(self, id: str) -> tuple:
         headers = {
-            "csrf-token": token,
+            "csrf-token": self.get_csrf(),
             "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 \
             (KHTML, like Gecko) Chrome/113.0.0.0 Safari/537.36",
         }
@@ -143,6 +148,13 @@ class ROKU(Config):
         r = self.client.post(
             url, headers=headers, cookies=self.client.cookies, json=payload
         )
+        if r.status_code in (401, 403):
+            # The stored token went stale, get a new one and try once more
+            token_store.invalidate("roku", region=region(self.proxy))
+            headers["csrf-token"] = self.get_csrf()
+            r = self.client.post(
+                url, headers=headers, cookies=self.client.cookies, json=payload
+            )
         r.raise_for_status()
 
         videos = r.json()["playbackMedia"]["videos"]
@@ -162,15 +174,11 @@ class ROKU(Config):
 
         return lic_url, manifest
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str) -> str:
-        r = self.client.get(manifest)
-        self.soup = BeautifulSoup(r.content, "xml")
-        elements = self.soup.find_all("Representation")
-        codecs = [x.attrs["codecs"] for x in elements if x.attrs.get("codecs")]
-        heights = sorted(
-            [int(x.attrs["height"]) for x in elements if x.attrs.get("height")],
-            reverse=True,
-        )
+        mpd = load_mpd(self.client, manifest)
+        codecs = mpd.codecs
+        heights = mpd.heights
 
         audio = "DD5.1" if "ac-3" in codecs else "AAC2.0"
 
@@ -241,17 +249,7 @@ class ROKU(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         pssh = "AAAAKXBzc2gAAAAA7e+LqXnWSs6jyCfc1R0h7QAAAAkiASpI49yVmwY="
@@ -278,7 +276,7 @@ class ROKU(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
@@ -9,8 +9,6 @@ Info:
 from __future__ import annotations
 
 import json
-import subprocess
-import time
 import re
 import base64
 from collections import Counter
@@ -22,15 +20,16 @@ import click
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Movie, Movies, Series
 from utils.utilities import (
     append_id,
     kid_to_pssh,
     force_numbering,
-    get_heights,
     get_wvd,
-    in_cache,
     set_filename,
     set_save_path,
     string_cleaning,
@@ -178,8 +177,10 @@ class RTE(Config):
 
         return manifest, pid
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str) -> str:
-        heights, soup = get_heights(self.client, manifest)
+        mpd = load_mpd(self.client, manifest)
+        heights = mpd.heights
         resolution = heights[0]
 
         if quality is not None:
@@ -188,7 +189,7 @@ class RTE(Config):
             else:
                 resolution = min(heights, key=lambda x: abs(int(x) - int(quality)))
 
-        return resolution, soup
+        return resolution, mpd
 
     def get_content(self, url: str) -> object:
         if self.movie:
@@ -253,23 +254,13 @@ class RTE(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         token, account = self.get_config()
         manifest, pid = self.get_playlist(stream.data, token)
-        self.res, soup = self.get_mediainfo(manifest, self.quality)
-        pssh = kid_to_pssh(soup)
+        self.res, mpd = self.get_mediainfo(manifest, self.quality)
+        pssh = kid_to_pssh(mpd)
 
         keys = self.get_keys(pssh, token, account, pid)
         with open(self.tmp / "keys.txt", "w") as file:
@@ -291,7 +282,7 @@ class RTE(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
@@ -11,10 +11,8 @@ Quality: 1080p, AAC 2.0 max
 from __future__ import annotations
 
 import json
-import subprocess
 import urllib.parse
 import re
-import time
 from collections import Counter
 from pathlib import Path
 
@@ -24,7 +22,10 @@ from bs4 import BeautifulSoup
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Series
 from utils.utilities import (
     construct_pssh,
@@ -34,8 +35,6 @@ from utils.utilities import (
     string_cleaning,
     force_numbering,
     append_id,
-    get_heights,
-    in_cache,
     update_cache
 )
 
@@ -151,6 +150,7 @@ class STV(Config):
                     name=episode.get("title"),
                     year=None,
                     data=None,
+                    drm=self.drm,
                     description=episode.get("summary"),
                 )
                 for series in data
@@ -158,19 +158,19 @@ class STV(Config):
             ]
         )
 
-    def get_mediainfo(self, manifest: str, quality: str) -> str:
-        r = self.client.get(manifest)
-        r.raise_for_status()
-        heights, self.soup = get_heights(self.client, manifest)
+    @timed("mediainfo")
+    def get_mediainfo(self, manifest: str, quality: str) -> tuple:
+        mpd = load_mpd(self.client, manifest)
+        heights = mpd.heights
 
         if quality is not None:
             if int(quality) in heights:
-                return quality
+                return quality, mpd
             else:
                 closest_match = min(heights, key=lambda x: abs(int(x) - int(quality)))
-                return closest_match
+                return closest_match, mpd
 
-        return heights[0]
+        return heights[0], mpd
 
     def get_content(self, url: str) -> object:
         with self.console.status("Fetching series titles..."):
@@ -222,6 +222,7 @@ class STV(Config):
                         name=content.get("title"),
                         year=None,
                         data=None,
+                        drm=self.drm,
                         description=content.get("summary"),
                     )
                 ]
@@ -231,23 +232,18 @@ class STV(Config):
 
         return [episode[0]], title
 
+    def resume_session(self, downloads: list) -> None:
+        self.drm = downloads[0].drm if downloads else None
+
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(f"Slowing things down for {self.slowdown} seconds..."):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest, lic_url = self.get_playlist(stream.id)
-        self.res = self.get_mediainfo(manifest, self.quality)
-        pssh = construct_pssh(self.soup) if self.drm else None
+        self.res, mpd = self.get_mediainfo(manifest, self.quality)
+        pssh = construct_pssh(mpd) if self.drm else None
 
         keys = None
         if self.drm:
@@ -269,7 +265,7 @@ class STV(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
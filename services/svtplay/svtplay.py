@@ -9,24 +9,23 @@ from __future__ import annotations
 
 import json
 import re
-import subprocess
 import sys
-import time
 from collections import Counter
 from urllib.parse import urlparse
 
 import click
-from bs4 import BeautifulSoup
 
 from utils.args import get_args
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.hls import load_master
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Movie, Movies, Series
 from utils.utilities import (
     force_numbering,
     append_id,
-    from_m3u8,
-    in_cache,
     set_filename,
     set_save_path,
     string_cleaning,
@@ -144,15 +143,9 @@ class SVTPlay(Config):
         return manifest
 
     def get_dash_info(self, manifest: str, quality: str) -> tuple:
-        r = self.client.get(manifest)
-        self.soup = BeautifulSoup(r.text, "xml")
-
-        tags = self.soup.find_all("Representation")
-        codecs = [x.attrs["codecs"] for x in tags if x.attrs.get("codecs")]
-        heights = sorted(
-            [int(x.attrs["height"]) for x in tags if x.attrs.get("height")],
-            reverse=True,
-        )
+        mpd = load_mpd(self.client, manifest)
+        codecs = mpd.codecs
+        heights = mpd.heights
 
         audio = "DD5.1" if "ac-3" in codecs else "AAC2.0"
 
@@ -166,11 +159,8 @@ class SVTPlay(Config):
         return heights[0], audio
 
     def get_hls_info(self, manifest: str, quality: str) -> tuple:
-        r = self.client.get(manifest)
-        r.raise_for_status()
-        heights, codecs = from_m3u8(r.text)
-
-        heights = sorted(heights, reverse=True)
+        master = load_master(self.client, manifest)
+        heights, codecs = master.heights, master.codecs
         audio = "DD5.1" if "ac-3" in codecs[0] else "AAC2.0"
 
         self.log.info("Subtitles for this format are currently not supported")
@@ -185,6 +175,7 @@ class SVTPlay(Config):
 
         return heights[0], audio
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str) -> str:
         if manifest.endswith(".mpd"):
             return self.get_dash_info(manifest, quality)
@@ -268,15 +259,7 @@ class SVTPlay(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(f"Slowing things down for {self.slowdown} seconds..."):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest = self.get_playlist(stream.id)
@@ -295,7 +278,7 @@ class SVTPlay(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
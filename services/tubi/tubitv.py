@@ -13,25 +13,25 @@ from __future__ import annotations
 
 import json
 import re
-import subprocess
-import time
 from collections import Counter
 from pathlib import Path
 from urllib.parse import urlparse
 
 import click
-import m3u8
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.hls import load_master
+from utils.metrics import timed
+from utils.options import batch_download, get_downloads
+from utils.subtitles import fetch_subtitles
 from utils.titles import Episode, Movie, Movies, Series
 from utils.utilities import (
     force_numbering,
     append_id,
     get_wvd,
-    in_cache,
     pssh_from_init,
     set_filename,
     set_save_path,
@@ -138,19 +138,18 @@ class TUBITV(Config):
 
         return pssh_from_init(Path(self.tmp / "init.mp4"))
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str, res=""):
-        r = self.client.get(manifest)
-        r.raise_for_status()
-
         url = urlparse(manifest)
         base = f"{url.scheme}://{url.netloc}/{url.path.split('/')[1]}/"
 
-        m3u8_obj = m3u8.loads(r.text)
+        master = load_master(self.client, manifest)
 
         playlists = []
-        if m3u8_obj.is_variant:
-            for playlist in m3u8_obj.playlists:
-                playlists.append((playlist.stream_info.resolution[1], playlist.uri))
+        if master.is_variant:
+            for variant in master.variants:
+                if variant.height:
+                    playlists.append((variant.height, variant.uri))
 
             heights = sorted([x[0] for x in playlists], reverse=True)
             resolution = heights[0]
@@ -238,22 +237,20 @@ class TUBITV(Config):
 
         return [episode[0]], title
 
+    def get_subtitles(self, stream: object) -> tuple:
+        return stream.subtitle, "srt"
+
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
+        self.sub_path = (
+            fetch_subtitles(self, stream.subtitle, stream.id, sub_type="srt")
+            if stream.subtitle is not None and not self.skip_download
+            else None
+        )
         manifest, self.res = self.get_mediainfo(stream.data, self.quality)
 
         keys = None
@@ -267,13 +264,6 @@ class TUBITV(Config):
         self.save_path = set_save_path(stream, self, title)
         self.manifest = stream.data
         self.key_file = self.tmp / "keys.txt" if keys else None
-        self.sub_path = None
-
-        if stream.subtitle is not None:
-            self.sub_path = self.tmp / f"{self.filename}.srt"
-            r = self.client.get(url=f"{stream.subtitle}")
-            with open(self.sub_path, "wb") as f:
-                f.write(r.content)
 
         self.log.info(f"{str(stream)}")
         self.log.info(f"{keys[0]}") if keys else None
@@ -283,7 +273,7 @@ class TUBITV(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
@@ -10,7 +10,6 @@ from __future__ import annotations
 import asyncio
 import json
 import re
-import subprocess
 import sys
 import time
 from collections import Counter
@@ -19,17 +18,19 @@ from urllib.parse import urlparse
 
 import click
 import httpx
-from bs4 import BeautifulSoup
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.hls import load_master
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Movie, Movies, Series
 from utils.utilities import (
     force_numbering,
     append_id,
-    from_m3u8,
     get_cookie,
     get_wvd,
     kid_to_pssh,
@@ -37,7 +38,6 @@ from utils.utilities import (
     set_filename,
     set_save_path,
     string_cleaning,
-    in_cache,
     update_cache,
 )
 
@@ -234,15 +234,9 @@ class TV4Play(Config):
         return manifest, lic_url, token
 
     def get_dash_info(self, manifest: str, quality: str, pssh: str = None) -> tuple:
-        r = self.client.get(manifest)
-        soup = BeautifulSoup(r.text, "xml")
-        pssh = kid_to_pssh(soup)
-
-        tags = soup.find_all("Representation")
-        heights = sorted(
-            [int(x.attrs["height"]) for x in tags if x.attrs.get("height")],
-            reverse=True,
-        )
+        mpd = load_mpd(self.client, manifest)
+        pssh = kid_to_pssh(mpd)
+        heights = mpd.heights
         resolution = heights[0]
         
         if quality is not None:
@@ -254,11 +248,8 @@ class TV4Play(Config):
         return resolution, pssh
 
     def get_hls_info(self, manifest: str, quality: str, pssh: str = None) -> tuple:
-        r = self.client.get(manifest)
-        r.raise_for_status()
-        heights, _ = from_m3u8(r.text)
-
-        heights = sorted(heights, reverse=True)
+        master = load_master(self.client, manifest)
+        heights = master.heights
         resolution = heights[0]
         
         if quality is not None:
@@ -269,6 +260,7 @@ class TV4Play(Config):
 
         return resolution, pssh
 
+    @timed("mediainfo")
     def get_mediainfo(self, manifest: str, quality: str) -> str:
         if manifest.endswith(".mpd"):
             return self.get_dash_info(manifest, quality)
@@ -368,15 +360,7 @@ class TV4Play(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(f"Slowing things down for {self.slowdown} seconds..."):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest, lic_url, token = self.get_playlist(stream.id)
@@ -401,7 +385,7 @@ class TV4Play(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
@@ -13,29 +13,27 @@ import base64
 import json
 import os
 import re
-import subprocess
 import sys
-import time
 from collections import Counter
-from datetime import datetime, timedelta
 from pathlib import Path
 from urllib.parse import urlparse
 
 import click
 import httpx
-import yaml
 
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Movie, Movies, Series
+from utils.tokens import Token, token_store
 from utils.utilities import (
     append_id,
     force_numbering,
-    get_heights,
     get_wvd,
-    in_cache,
     kid_to_pssh,
     set_filename,
     set_save_path,
@@ -57,19 +55,8 @@ class TVNZ(Config):
         self.get_options()
 
     def get_auth_token(self):
-        cache = self.config.get("cache")
-
-        if not cache:
-            self.log.info("Cache is empty, aquiring new tokens...")
-            token = self.authenticate()
-        elif cache and cache.get("expiry") < datetime.now():
-            self.log.info("Token expired, logging in...")
-            token = self.authenticate()
-        else:
-            self.log.info("Using cached tokens")
-            token = cache.get("token")
-
-        return token
+        # No refresh tokens here, expired ones mean logging in again
+        return token_store.get("tvnz", self.authenticate, profile=self.username).value
 
     def get_license(self, challenge: bytes, lic_url: str) -> str:
         r = self.client.post(url=lic_url, data=challenge)
@@ -169,7 +156,7 @@ class TVNZ(Config):
             ]
         )
 
-    def authenticate(self):
+    def authenticate(self) -> Token:
         if not self.username and not self.password:
             self.log.error(
                 "Required credentials were not found. See 'freevine.py profile --help'"
@@ -213,22 +200,9 @@ class TVNZ(Config):
         json_str = re.search(r"response: ({.*};)", r.text).group(1).replace("}};", "}")
 
         auth = json.loads(json_str)
-        token = auth.get("access_token")
-
-        expiry = datetime.now() + timedelta(seconds=auth.get("expires_in"))
-
-        profile = Path("services") / "tvnz" / "profile.yaml"
-        with open(profile, "r") as f:
-            data = yaml.safe_load(f)
-
-        data["cache"] = {"token": token, "expiry": expiry, "refresh": None}
-
-        with open(profile, "w") as f:
-            yaml.safe_dump(data, f, sort_keys=False)
-
         self.log.info("+ New tokens placed in cache")
 
-        return token
+        return Token(auth.get("access_token"), expires_in=auth.get("expires_in"))
 
     def get_playlist(self, data: tuple) -> tuple:
         video_id, account_id = data
@@ -263,8 +237,10 @@ class TVNZ(Config):
 
         return manifest, lic_url
 
+    @timed("mediainfo")
     def get_mediainfo(self, quality: str, manifest: str) -> str:
-        heights, soup = get_heights(self.client, manifest)
+        mpd = load_mpd(self.client, manifest)
+        heights = mpd.heights
         resolution = heights[0]
 
         if quality is not None:
@@ -273,7 +249,7 @@ class TVNZ(Config):
             else:
                 resolution = min(heights, key=lambda x: abs(int(x) - int(quality)))
 
-        return resolution, soup
+        return resolution, mpd
 
     def get_content(self, url: str) -> object:
         if self.movie:
@@ -352,22 +328,12 @@ class TVNZ(Config):
         )
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest, lic_url = self.get_playlist(stream.data)
-        self.res, self.soup = self.get_mediainfo(self.quality, manifest)
-        pssh = kid_to_pssh(self.soup)
+        self.res, mpd = self.get_mediainfo(self.quality, manifest)
+        pssh = kid_to_pssh(mpd)
 
         keys = self.get_keys(pssh, lic_url)
         with open(self.tmp / "keys.txt", "w") as file:
@@ -387,7 +353,7 @@ class TVNZ(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
                 click.echo("")
             except Exception as e:
                 raise ValueError(f"{e}")
@@ -11,8 +11,6 @@ from __future__ import annotations
 
 import json
 import re
-import subprocess
-import time
 from collections import Counter
 from pathlib import Path
 from urllib.parse import urlparse
@@ -22,15 +20,16 @@ import click
 from utils.args import get_args
 from utils.cdm import LocalCDM
 from utils.config import Config
-from utils.options import get_downloads
+from utils.downloader import run_downloader
+from utils.metrics import timed
+from utils.mpd import load_mpd
+from utils.options import batch_download, get_downloads
 from utils.titles import Episode, Series
 from utils.utilities import (
     construct_pssh,
     force_numbering,
     append_id,
-    get_heights,
     get_wvd,
-    in_cache,
     set_filename,
     set_save_path,
     string_cleaning,
@@ -124,19 +123,19 @@ class UKTVPLAY(Config):
 
         return manifest, lic_url
 
-    def get_mediainfo(self, manifest: str, quality: str) -> str:
-        r = self.client.get(manifest)
-        r.raise_for_status()
-        heights, self.soup = get_heights(self.client, manifest)
+    @timed("mediainfo")
+    def get_mediainfo(self, manifest: str, quality: str) -> tuple:
+        mpd = load_mpd(self.client, manifest)
+        heights = mpd.heights
 
         if quality is not None:
             if int(quality) in heights:
-                return quality
+                return quality, mpd
             else:
                 closest_match = min(heights, key=lambda x: abs(int(x) - int(quality)))
-                return closest_match
+                return closest_match, mpd
 
-        return heights[0]
+        return heights[0], mpd
 
     def get_content(self, url: str) -> object:
         if self.movie:
@@ -201,22 +200,12 @@ class UKTVPLAY(Config):
     def get_options(self) -> None:
         downloads, title = get_downloads(self)
 
-        for download in downloads:
-            if not self.no_cache and in_cache(self.cache, download):
-                continue
-
-            if self.slowdown:
-                with self.console.status(
-                    f"Slowing things down for {self.slowdown} seconds..."
-                ):
-                    time.sleep(self.slowdown)
-
-            self.download(download, title)
+        batch_download(self, downloads, title)
 
     def download(self, stream: object, title: str) -> None:
         manifest, lic_url = self.get_playlist(stream.id)
-        self.res = self.get_mediainfo(manifest, self.quality)
-        pssh = construct_pssh(self.soup)
+        self.res, mpd = self.get_mediainfo(manifest, self.quality)
+        pssh = construct_pssh(mpd)
 
         keys = self.get_keys(pssh, lic_url)
         with open(self.tmp / "keys.txt", "w") as file:
@@ -237,7 +226,7 @@ class UKTVPLAY(Config):
 
         if not file_path.exists():
             try:
-                subprocess.run(args, check=True)
+                run_downloader(self, args, file_path)
             except Exception as e:
                 raise ValueError(f"{e}")
         else:
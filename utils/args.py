@@ -3,6 +3,8 @@ import sys
 import shutil
 from pathlib import Path
 
+from utils.storage import choose_temp
+from utils.subtitles import fetching_subtitles, join_subtitles
 from utils.utilities import get_binary
 
 
@@ -89,6 +91,45 @@ def format_settings(service: object) -> tuple:
     return threads, format, muxer, packager
 
 
+def mux_settings(service: object) -> tuple:
+    background = service.config.get("background_mux") or "false"
+    workers = service.config.get("mux_workers")
+
+    if service.background_mux:
+        background = "true"
+    # Nothing to mux
+    if service.sub_only or service.no_mux or service.skip_download:
+        background = "false"
+
+    return background, workers
+
+
+def stage_tracks(service: object) -> bool:
+    """
+    Whether N_m3u8DL-RE leaves the tracks for mux_staged instead of muxing them
+
+    Besides --background-mux, that's the case while subtitles are still being
+    fetched, so they can download alongside the media and be muxed in after
+    """
+    background_mux, _ = mux_settings(service)
+    sub_no_mux = subtitle_settings(service)[0]
+    return background_mux == "true" or (
+        fetching_subtitles(service) and sub_no_mux == "false"
+    )
+
+
+def work_dir(service: object, name: str) -> Path:
+    """
+    Per-title folder in the temp dir
+
+    "tracks" holds tracks waiting for the background muxer, "out" the
+    output of N_m3u8DL-RE until it's moved into place
+    """
+    _, format, _, _ = format_settings(service)
+    temp, _, filename, _ = dir_settings(service, format)
+    return Path(temp) / f"{filename}.{name}"
+
+
 def dir_settings(service: object, format: str) -> tuple:
     temp = service.config["temp_dir"]
     save_path = service.save_path
@@ -99,6 +140,8 @@ def dir_settings(service: object, format: str) -> tuple:
     if service.save_dir != "False":
         save_path = service.save_dir
 
+    # Keep temp files on the destination's device so they can be renamed into place
+    temp = choose_temp(temp, save_path)
     file_path = Path(save_path) / f"{filename}.{format}"
 
     return temp, save_path, filename, file_path
@@ -126,7 +169,6 @@ def get_args(service: object) -> tuple:
 
     manifest = service.manifest
     key_file = service.key_file
-    sub_path = service.sub_path
     sub_only = service.sub_only
     no_mux = service.no_mux
     skip_download = service.skip_download
@@ -135,7 +177,7 @@ def get_args(service: object) -> tuple:
     sub_lang = service.sub_lang if hasattr(service, "sub_lang") else "English"
 
     m3u8dl = get_binary("N_m3u8DL-RE", "n-m3u8dl-re")
-    if not m3u8dl:
+    if not m3u8dl and not service.planning:
         service.log.error("Path to N_m3u8DL-RE was not found")
         sys.exit(1)
 
@@ -146,6 +188,27 @@ def get_args(service: object) -> tuple:
     sub_no_mux, sub_fix, select_sub, drop_sub = subtitle_settings(service)
     added_commands = add_command(service)
 
+    # Subtitles still being fetched are only joined at mux time, see mux_staged,
+    # unless they're ready already or there's nothing to mux them into
+    if fetching_subtitles(service) and (
+        service.sub_path.done()
+        or sub_only
+        or no_mux
+        or skip_download
+        or file_path.exists()
+    ):
+        join_subtitles(service)
+    sub_path = None if fetching_subtitles(service) else service.sub_path
+    staged = stage_tracks(service)
+
+    # Tracks are muxed later, see utils/muxer.py. Muxed output is moved
+    # into save_path once it's complete, see utils/storage.py
+    save_dir = save_path
+    if staged:
+        save_dir = work_dir(service, "tracks")
+    elif not sub_only and not no_mux and not skip_download:
+        save_dir = work_dir(service, "out")
+
     arguments = [
         m3u8dl,
         manifest,
@@ -157,7 +220,7 @@ def get_args(service: object) -> tuple:
         "--save-name",
         filename,
         "--save-dir",
-        save_path,
+        save_dir,
         "--tmp-dir",
         temp,
         "--no-log",
@@ -187,10 +250,10 @@ def get_args(service: object) -> tuple:
         arguments.extend(["--skip-download"])
         arguments.extend(["--write-meta-json", "false"])
 
-    if not sub_only and not no_mux:
+    if not sub_only and not no_mux and not staged:
         arguments.extend(["-M", f"format={format}:muxer={muxer}:skip_sub={sub_no_mux}"])
 
-    if sub_path and sub_no_mux == "false":
+    if sub_path and sub_no_mux == "false" and not staged:
         arguments.extend(["--mux-import", f"path={sub_path}:name={sub_lang}"])
 
     if sub_path and sub_no_mux == "true":
@@ -14,8 +14,12 @@ from rich import print_json
 
 from utils import __version__
 from utils.console import custom_handler
+from utils.daemon import serve as serve_jobs
 from utils.docs.documentation import main_help
 from utils.manager import service_manager
+from utils.metrics import metrics, report as report_metrics
+from utils.planner import load_plan
+from utils.profiler import profiler
 from utils.search.search import search_engine
 from utils.utilities import is_url, check_version, get_binary
 
@@ -41,16 +45,24 @@ def cli(debug: bool):
 
 @cli.command()
 @click.option("--proxy", type=str, default=False, help="Request or specify a proxy server")
+@click.option("--profile", is_flag=True, default=False, help="Profile each phase with cProfile")
+@click.option("--profile-memory", is_flag=True, default=False, help="Also trace allocations when profiling")
 @click.argument("alias", type=str, required=True)
 @click.argument("keywords", type=str, required=True)
-def search(proxy: str, alias: str, keywords: str) -> None:
+def search(proxy: str, profile: bool, profile_memory: bool, alias: str, keywords: str) -> None:
     """
     Search one or multiple services for titles
 
     Usage: freevine.py search bbc,all4 "KEYWORDS"
     """
+    if profile or profile_memory:
+        profiler.enable(memory=profile_memory)
+
     if keywords is not None:
-        search_engine(alias, keywords, proxy)
+        try:
+            search_engine(alias, keywords, proxy)
+        finally:
+            profiler.write()
 
 
 @cli.command(short_help="Download series or movies", help=main_help)
@@ -60,16 +72,23 @@ def search(proxy: str, alias: str, keywords: str) -> None:
 @click.option("--format", type=str, default=False, help="Specify file format")
 @click.option("--muxer", type=str, default=False, help="Select muxer")
 @click.option("--no-mux", is_flag=True, default=False, help="Choose to not mux files")
+@click.option("--background-mux", is_flag=True, default=False, help="Mux on a worker pool while the next title downloads")
 @click.option("--save-name", type=str, default=False, help="Name of saved file")
 @click.option("--save-dir", type=str, default=False, help="Save directory")
 @click.option("--sub-only", is_flag=True, default=False, help="Download only subtitles")
 @click.option("--sub-no-mux", is_flag=True, default=False, help="Choose to not mux subtitles")
 @click.option("--sub-no-fix", is_flag=True, default=False, help="Leave subtitles untouched")
 @click.option("--use-shaka-packager", is_flag=True, default=False, help="Use shaka-packager to decrypt")
+@click.option("--engine", type=str, default=False, help="Download engine (n_m3u8dl-re or native)")
 @click.option("--add-command", multiple=True, default=list, help="Add extra command to N_m3u8DL-RE")
 @click.option("--slowdown", type=int, nargs=1, help="Add sleep (in seconds) between downloads")
 @click.option("--no-cache", is_flag=True, default=False, help="Ignore download cache")
 @click.option("--append-id", is_flag=True, default=False, help="Append video id to filename")
+@click.option("--resume", is_flag=True, default=False, help="Resume unfinished downloads from journal")
+@click.option("--plan", type=str, default=None, help="Resolve titles and write a download plan to this file")
+@click.option("--from-plan", type=click.Path(exists=True), default=None, help="Download the titles of a plan")
+@click.option("--profile", is_flag=True, default=False, help="Profile each phase with cProfile")
+@click.option("--profile-memory", is_flag=True, default=False, help="Also trace allocations when profiling")
 @click.option("-fn", "--force-numbering", is_flag=True, help="Force add numbering to episodes")
 @click.option("-e", "--episode", type=str, help="Download episode(s)")
 @click.option("-s", "--season", type=str, help="Download complete season")
@@ -83,11 +102,46 @@ def search(proxy: str, alias: str, keywords: str) -> None:
 @click.option("-da", "--drop-audio", type=str, default=False, help="Drop audio stream")
 @click.option("-ss", "--select-subtitle", type=str, default=False, help="Select subtitle")
 @click.option("-ds", "--drop-subtitle", type=str, default=False, help="Drop subtitle")
-def get(**kwargs) -> None:
+def get(**kwargs) -> object:
+    """Also run by the daemon for its jobs, which hands over a warm `client`"""
+    if kwargs.get("from_plan"):
+        plan = load_plan(kwargs["from_plan"])
+        # The plan's selection keeps --resume and the journal in step with it
+        kwargs.update(url=plan["url"], **plan["selection"])
+
     url = kwargs.get("episode") if is_url(kwargs.get("episode")) else kwargs.get("url")
 
+    profile, profile_memory = kwargs.pop("profile"), kwargs.pop("profile_memory")
+    if profile or profile_memory:
+        profiler.enable(memory=profile_memory)
+
     Service, config = service_manager.get_service(url)
-    Service(config, **kwargs)
+    # The daemon runs many jobs in one process, each reports only its own metrics
+    with metrics.scope(Service.__name__) as recorded:
+        try:
+            return Service(config, **kwargs)
+        finally:
+            if not any(kwargs.get(x) for x in ("titles", "info", "plan")):
+                report_metrics(config, console, recorded)
+            profiler.write()
+
+
+@cli.command()
+@click.option("--host", type=str, default="127.0.0.1", help="Address to bind the job API to")
+@click.option("--port", type=int, default=8745, help="Port to bind the job API to")
+@click.option("--workers", type=int, default=1, help="Number of jobs to run at the same time")
+def serve(host: str, port: int, workers: int) -> None:
+    """
+    Run a daemon that accepts download jobs over a local HTTP API
+
+    Usage: freevine.py serve --port 8745
+
+    \b
+    Submit jobs with the same arguments as the get command:
+        curl -X POST localhost:8745/jobs -d '{"args": ["--episode", "S01E01", "URL"]}'
+        curl localhost:8745/jobs/JOB_ID
+    """
+    serve_jobs(get, host, port, workers)
 
 
 @cli.command()
@@ -98,7 +152,8 @@ def profile(username: str, password: str, service: str):
     """
     Create a profile with user credentials
 
-    This will create a profile.yaml in service folder, which stores credentials and cache data.
+    This will create a profile.yaml in service folder, which stores credentials.
+    Tokens are kept in utils/settings/tokens.json, per service and username.
     """
 
     log = logging.getLogger()
@@ -213,6 +268,7 @@ def clear_cache():
 
 cli.add_command(search)
 cli.add_command(get)
+cli.add_command(serve)
 cli.add_command(profile)
 cli.add_command(file)
 cli.add_command(service_info)
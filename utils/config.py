@@ -6,8 +6,9 @@ from typing import Any, Optional
 import requests
 from rich.console import Console
 
+from utils.metrics import metrics
 from utils.utilities import is_url
-from utils.proxies import get_proxy
+from utils.proxies import GeoRouter, get_proxies, use_proxy_pool
 
 
 class Config:
@@ -44,11 +45,17 @@ class Config:
         save_dir: Optional[str] = None,
         save_name: Optional[str] = None,
         add_command: Optional[list] = None,
+        engine: Optional[str] = None,
+        background_mux: Optional[bool] = None,
         slowdown: Optional[int] = None,
         force_numbering: Optional[list] = None,
         no_cache: Optional[bool] = None,
         append_id: Optional[bool] = None,
+        resume: Optional[bool] = None,
+        plan: Optional[str] = None,
+        from_plan: Optional[str] = None,
         proxy: Optional[str] = None,
+        client: Optional[requests.Session] = None,
         # skip_download: Optional[bool] = None,
     ) -> None:
         if episode and not is_url(episode):
@@ -90,11 +97,20 @@ class Config:
         self.save_dir = save_dir
         self.save_name = save_name
         self.add_command = add_command
+        self.engine = engine
+        self.background_mux = background_mux
         self.slowdown = slowdown
         self.skip_download = info
         self.force_numbering = force_numbering
         self.no_cache = no_cache
         self.append_id = append_id
+        self.resume = resume
+        self.plan = plan
+        self.from_plan = from_plan
+        # Set on the copies of the service that resolve a plan
+        self.planning = False
+        # Titles of --from-plan by id
+        self.planned = {}
         self.proxy = proxy
 
         self.console = Console()
@@ -103,6 +119,13 @@ class Config:
         self.tmp.mkdir(parents=True, exist_ok=True)
 
         self.log = logging.getLogger()
+        metrics.bind(self.__class__.__name__)
+
+        # A warm session can be handed over by the daemon to reuse
+        # connection pools, cookies and proxy settings between jobs
+        if client is not None:
+            self.client = client
+            return
 
         self.client = requests.Session()
         self.client.timeout = 10.0
@@ -117,5 +140,19 @@ class Config:
         )
 
         if self.proxy != "False":
-            uri = get_proxy(cli=self)
-            self.client.proxies = {"http": uri, "https": uri}
+            proxies = get_proxies(cli=self)
+            if proxies:
+                router = (
+                    GeoRouter(self.config.get("geo"))
+                    if self.config.get("geo_routing", "true") == "true"
+                    else None
+                )
+                use_proxy_pool(self.client, proxies, router)
+
+    def resume_session(self, downloads: list) -> None:
+        """
+        Restore state that is normally set while fetching titles
+
+        Services that set up tokens or headers in get_content should
+        override this, since resumed downloads skip the catalog entirely
+        """
@@ -0,0 +1,293 @@
+"""
+Long-running daemon with a local job queue
+
+Jobs are submitted as regular `get` command lines over a small HTTP/JSON
+API bound to localhost and run through the get command itself. Imported
+service modules, HTTP sessions and proxies are kept warm between jobs, so
+each job skips the cold start. Services set headers and params on their
+session per title, so a session is leased to one running job at a time.
+
+API:
+    POST /jobs          {"args": ["--episode", "S01E01", "URL"]}
+    GET  /jobs          List all jobs
+    GET  /jobs/<id>     Status and progress of a single job
+    DELETE /jobs/<id>   Cancel a queued job
+    GET  /health        Daemon status
+    GET  /metrics       Metrics of all jobs in Prometheus format
+
+Finished jobs are listed for FINISHED_TTL seconds, and only the latest
+MAX_FINISHED of them, so a daemon that runs for weeks doesn't keep the
+log of every job it ever ran.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import requests
+
+from utils.manager import service_manager
+from utils.metrics import metrics
+from utils.planner import load_plan
+from utils.progress import ProgressEvent, progress_hub
+from utils.utilities import is_url
+
+log = logging.getLogger()
+
+FINISHED = ("done", "failed", "cancelled")
+MAX_FINISHED = 200
+FINISHED_TTL = 24 * 3600
+
+
+class Job:
+    def __init__(self, args: list) -> None:
+        self.id = uuid.uuid4().hex[:12]
+        self.args = args
+        self.state = "queued"
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.messages = deque(maxlen=50)
+        # Latest progress event of every track being downloaded
+        self.transfer = {}
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "args": self.args,
+            "state": self.state,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "progress": list(self.messages),
+            "transfer": list(self.transfer.values()),
+        }
+
+
+class JobLogHandler(logging.Handler):
+    """Attach log records emitted by a worker thread to its running job"""
+
+    def __init__(self) -> None:
+        super().__init__(level=logging.INFO)
+        self.jobs = {}
+
+    def emit(self, record: logging.LogRecord) -> None:
+        job = self.jobs.get(threading.get_ident())
+        if job is not None:
+            job.messages.append(
+                {"time": record.created, "level": record.levelname, "message": record.getMessage()}
+            )
+
+
+class JobQueue:
+    def __init__(self, command: click.Command, workers: int = 1) -> None:
+        self.command = command
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.handler = JobLogHandler()
+        logging.getLogger().addHandler(self.handler)
+        progress_hub.subscribe(self.on_progress)
+
+        for _ in range(workers):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def submit(self, args: list) -> Job:
+        job = Job(args)
+        with self.lock:
+            self.prune()
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def cancel(self, job_id: str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is not None and job.state == "queued":
+            job.state = "cancelled"
+            job.finished = time.time()
+        return job
+
+    def all(self) -> list:
+        with self.lock:
+            self.prune()
+            return list(self.jobs.values())
+
+    def prune(self) -> None:
+        """Forget finished jobs past FINISHED_TTL, and all but the latest MAX_FINISHED"""
+        cutoff = time.time() - FINISHED_TTL
+        finished = sorted(
+            (x for x in self.jobs.values() if x.state in FINISHED and x.finished),
+            key=lambda x: x.finished,
+            reverse=True,
+        )
+        for i, job in enumerate(finished):
+            if i >= MAX_FINISHED or job.finished < cutoff:
+                del self.jobs[job.id]
+
+    def on_progress(self, event: ProgressEvent) -> None:
+        # Downloaders publish from the worker thread that runs the job
+        job = self.handler.jobs.get(threading.get_ident())
+        if job is not None:
+            job.transfer[event.track] = event.to_dict()
+
+    def lease(self, key: tuple) -> requests.Session:
+        """
+        Take an idle warm session for a service/proxy pair, or None
+
+        Sessions are created by the first job and handed to the following
+        ones, together with any tokens and proxies set on them, but never
+        to two running jobs at once
+        """
+        with self.lock:
+            idle = self.clients.get(key)
+            return idle.pop() if idle else None
+
+    def release(self, key: tuple, client: requests.Session) -> None:
+        with self.lock:
+            self.clients.setdefault(key, []).append(client)
+
+    def worker(self) -> None:
+        while True:
+            job = self.queue.get()
+            if job.state == "cancelled":
+                continue
+
+            job.state = "running"
+            job.started = time.time()
+            self.handler.jobs[threading.get_ident()] = job
+            try:
+                self.run(job)
+                job.state = "done"
+            except SystemExit as e:
+                # Options and services exit early on listings and errors
+                job.state = "done" if not e.code else "failed"
+                job.error = None if not e.code else f"Exited with code {e.code}"
+            except Exception as e:
+                job.state = "failed"
+                job.error = f"{e.__class__.__name__}: {e}"
+                log.error(f"Job {job.id} failed: {job.error}")
+            finally:
+                job.finished = time.time()
+                self.handler.jobs.pop(threading.get_ident(), None)
+
+    def run(self, job: Job) -> None:
+        ctx = self.command.make_context(self.command.name, list(job.args))
+        kwargs = ctx.params
+        # Profiling covers a whole process, which jobs share
+        kwargs.update(profile=False, profile_memory=False)
+
+        if kwargs.get("from_plan"):
+            url = load_plan(kwargs["from_plan"])["url"]
+        else:
+            url = kwargs.get("episode") if is_url(kwargs.get("episode")) else kwargs.get("url")
+        key = (service_manager.find_service(url).name, kwargs.get("proxy"))
+
+        client = self.lease(key)
+        service = None
+        try:
+            service = self.command.callback(client=client, **kwargs)
+        finally:
+            # Jobs that exit early hand back the session they were given
+            client = getattr(service, "client", None) or client
+            if client is not None:
+                self.release(key, client)
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    jobs: JobQueue = None
+
+    def send_json(self, data: object, status: int = 200) -> None:
+        body = json.dumps(data, indent=4).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def job_id(self) -> str:
+        return self.path.rstrip("/").split("/")[-1]
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/health":
+            states = [job.state for job in self.jobs.all()]
+            return self.send_json(
+                {
+                    "status": "ok",
+                    "queued": states.count("queued"),
+                    "running": states.count("running"),
+                    "sessions": sum(len(x) for x in self.jobs.clients.values()),
+                }
+            )
+
+        if self.path.rstrip("/") == "/jobs":
+            return self.send_json([job.to_dict() for job in self.jobs.all()])
+
+        if self.path.rstrip("/") == "/metrics":
+            body = metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        if self.path.startswith("/jobs/"):
+            job = self.jobs.jobs.get(self.job_id())
+            if job is None:
+                return self.send_json({"error": "Job not found"}, 404)
+            return self.send_json(job.to_dict())
+
+        self.send_json({"error": "Not found"}, 404)
+
+    def do_POST(self) -> None:
+        if self.path.rstrip("/") != "/jobs":
+            return self.send_json({"error": "Not found"}, 404)
+
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            data = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            return self.send_json({"error": "Invalid JSON"}, 400)
+
+        args = data.get("args")
+        if not isinstance(args, list) or not args:
+            return self.send_json({"error": "'args' must be a list of get arguments"}, 400)
+
+        job = self.jobs.submit([str(arg) for arg in args])
+        self.send_json(job.to_dict(), 201)
+
+    def do_DELETE(self) -> None:
+        if not self.path.startswith("/jobs/"):
+            return self.send_json({"error": "Not found"}, 404)
+
+        job = self.jobs.cancel(self.job_id())
+        if job is None:
+            return self.send_json({"error": "Job not found"}, 404)
+        self.send_json(job.to_dict())
+
+    def log_message(self, format: str, *args) -> None:
+        log.debug(f"{self.address_string()} - {format % args}")
+
+
+def serve(command: click.Command, host: str, port: int, workers: int) -> None:
+    jobs = JobQueue(command, workers=workers)
+    handler = type("Handler", (JobHandler,), {"jobs": jobs})
+    server = ThreadingHTTPServer((host, port), handler)
+
+    log.info(f"Serving job queue on http://{host}:{port} with {workers} worker(s)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Shutting down...")
+    finally:
+        server.server_close()
@@ -105,6 +105,9 @@ main_help = f"""
                 freevine.py get --select-audio id=Descriptive --movie URL
             Request only subtitles from title(s):
                 freevine.py get --sub-only --episode/--movie URL
+            Resolve title(s) into a plan without downloading, and download it later:
+                freevine.py get --plan plan.json --episode/--season URL
+                freevine.py get --from-plan plan.json
     \b
             NOTES:
             See "N_m3u8DL-RE --morehelp select-video/audio/subtitle" for possible selection patterns
@@ -0,0 +1,655 @@
+"""
+Built-in segment downloader
+
+Clear HLS and DASH streams can be downloaded without N_m3u8DL-RE. Segments
+are fetched on a pooled async client with a concurrency limit per host and
+written to disk strictly in order, and the progress of every track is kept
+in a small state file next to it, so an interrupted download continues
+where it left off. Tracks are muxed with the configured muxer afterwards,
+or, when ffmpeg is the muxer, fed to it over pipes as they arrive so the
+output is written in a single pass without any intermediate files.
+
+Anything the engine doesn't handle, such as encrypted, live or multi-period
+streams, is handed to N_m3u8DL-RE as before.
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+from collections import deque
+from functools import partial
+from pathlib import Path
+from urllib.parse import urlparse
+
+import httpx
+from rich.progress import BarColumn, MofNCompleteColumn, Progress, TextColumn
+
+from utils.args import (
+    audio_settings,
+    dir_settings,
+    format_settings,
+    mux_settings,
+    stage_tracks,
+    subtitle_settings,
+    video_settings,
+    work_dir,
+)
+from utils.hls import parse_master, scan_media
+from utils.manifests import manifest_cache
+from utils.mpd import load_mpd, parse_mpd, template_segments
+from utils.metrics import metrics, service_name
+from utils.muxer import mux, mux_command, mux_pool, staged_tracks
+from utils.progress import transfer_stats
+from utils.proxies import proxy_for
+from utils.server import manifest_server
+from utils.storage import finalize_dir, partial_path, preflight
+from utils.subtitles import join_subtitles
+from utils.supervisor import supervise
+
+log = logging.getLogger()
+
+ENGINES = ("n_m3u8dl-re", "native")
+RETRIES = 3
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Single-file representations are split into ranges of this size
+CHUNK_SIZE = 8 * 1024 * 1024
+# Segments written between state file updates
+STATE_INTERVAL = 20
+# Selections the engine can honour, anything else needs N_m3u8DL-RE
+SELECTION = re.compile(r"(?:res=\d+|for=best)(?::(?:res=\d+|for=best))*")
+
+
+class Track:
+    __slots__ = ("kind", "segments", "suffix", "streamable")
+
+    def __init__(
+        self, kind: str, segments: list, suffix: str, streamable: bool = True
+    ) -> None:
+        self.kind = kind
+        # (url, byterange) pairs in playback order, initialization first
+        self.segments = segments
+        self.suffix = suffix
+        # Fragmented tracks can be read by the muxer as they arrive, progressive
+        # files may keep their index at the end and need to be on disk first
+        self.streamable = streamable
+
+    @property
+    def fingerprint(self) -> str:
+        """Identify the segment list across runs, ignoring tokens in query strings"""
+        digest = hashlib.sha1()
+        for url, byterange in self.segments:
+            digest.update(f"{urlparse(url).path} {byterange}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def __repr__(self) -> str:
+        return f"Track({self.kind}, {len(self.segments)} segment(s))"
+
+
+class PartialState:
+    """Segments and bytes of a track that are safely on disk"""
+
+    __slots__ = ("path", "fingerprint", "done", "size")
+
+    def __init__(self, path: Path, fingerprint: str) -> None:
+        self.path = path
+        self.fingerprint = fingerprint
+        self.done = 0
+        self.size = 0
+
+    @classmethod
+    def load(cls, path: Path, fingerprint: str, part: Path) -> PartialState:
+        state = cls(path, fingerprint)
+        try:
+            data = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return state
+
+        # A different segment list means a different stream or quality
+        if data.get("fingerprint") != fingerprint:
+            return state
+        if not part.exists() or part.stat().st_size < data["size"]:
+            return state
+
+        state.done = data["done"]
+        state.size = data["size"]
+        return state
+
+    def save(self) -> None:
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(
+            json.dumps(
+                {"fingerprint": self.fingerprint, "done": self.done, "size": self.size}
+            )
+        )
+        os.replace(tmp, self.path)
+
+
+def get_engine(service: object) -> str:
+    engine = getattr(service, "engine", None)
+    if not engine or engine == "False":
+        engine = service.config.get("engine") or ENGINES[0]
+    return str(engine).lower()
+
+
+def check_selection(service: object) -> None:
+    select_video, drop_video = video_settings(service)
+    select_audio, drop_audio = audio_settings(service)
+
+    if drop_video or drop_audio:
+        raise ValueError("drop filters")
+    for select in (select_video, select_audio):
+        if select and not SELECTION.fullmatch(select):
+            raise ValueError(f"selection {select!r}")
+
+
+def manifest_data(service: object, url: str) -> bytes:
+    data = manifest_server.render(url)
+    return data if data is not None else manifest_cache.get(service.client, url)
+
+
+def media_track(service: object, kind: str, url: str) -> Track:
+    data = manifest_cache.get(service.client, url)
+    if not data.lstrip().startswith(b"#EXTM3U"):
+        raise ValueError("variant isn't an HLS media playlist")
+
+    playlist = manifest_cache.parse(service.client, url, scan_media)
+    if playlist.encrypted:
+        raise ValueError("encrypted segments")
+    if not playlist.endlist:
+        raise ValueError("live playlist")
+
+    segments = [(playlist.resolve(x.uri), x.byterange) for x in playlist.segments]
+    if playlist.init is not None:
+        segments.insert(0, (playlist.resolve(playlist.init.uri), playlist.init.byterange))
+
+    return Track(kind, segments, ".mp4" if playlist.init is not None else ".ts")
+
+
+def hls_tracks(service: object, data: bytes, url: str) -> list:
+    master = parse_master(data, url)
+    if not master.is_variant:
+        return [media_track(service, "video", url)]
+
+    if any(key.get("METHOD", "NONE") != "NONE" for key in master.keys):
+        raise ValueError("encrypted stream")
+    if any(media.type in ("SUBTITLES", "CLOSED-CAPTIONS") for media in master.media):
+        raise ValueError("subtitles in the manifest")
+
+    variant = master.best(service.res)
+    tracks = [media_track(service, "video", master.resolve(variant.uri))]
+
+    renditions = [
+        x
+        for x in master.media
+        if x.type == "AUDIO" and x.group_id == variant.audio and x.uri
+    ]
+    if renditions:
+        audio = next((x for x in renditions if x.default), renditions[0])
+        tracks.append(media_track(service, "audio", master.resolve(audio.uri)))
+
+    return tracks
+
+
+def file_ranges(service: object, url: str) -> list:
+    """Split a single-file representation into byte ranges, if the server allows it"""
+    with service.client.get(url, headers={"Range": "bytes=0-0"}, stream=True) as r:
+        r.raise_for_status()
+        total = r.headers.get("Content-Range", "").rpartition("/")[2]
+
+    if r.status_code != 206 or not total.isdigit():
+        return [(url, None)]
+
+    total = int(total)
+    return [
+        (url, (start, min(start + CHUNK_SIZE, total) - 1))
+        for start in range(0, total, CHUNK_SIZE)
+    ]
+
+
+def dash_tracks(service: object, data: bytes, url: str) -> list:
+    # Served manifests and --base-url need their URLs resolved against the real origin
+    base_url = getattr(service, "base_url", None)
+    if base_url or manifest_server.render(url) is not None:
+        mpd = parse_mpd(data, base_url or url)
+    else:
+        mpd = load_mpd(service.client, url)
+
+    if mpd.type == "dynamic":
+        raise ValueError("live manifest")
+    if len(mpd.periods) != 1:
+        raise ValueError("multi-period manifest")
+    if mpd.protection:
+        raise ValueError("encrypted stream")
+
+    period = mpd.periods[0]
+    representations = mpd.representations
+    # Subtitles and anything else the engine would silently leave out go to N_m3u8DL-RE
+    others = {x.kind for x in representations} - {"video", "audio"}
+    if others:
+        kinds = ", ".join(sorted(x or "unknown" for x in others))
+        raise ValueError(f"{kinds} tracks in the manifest")
+
+    videos = [x for x in representations if x.kind == "video"]
+    audios = [x for x in representations if x.kind == "audio"]
+    if not videos:
+        raise ValueError("no video representations")
+
+    target = min(
+        {x.height or 0 for x in videos}, key=lambda x: abs(x - int(service.res or 0))
+    )
+    chosen = [("video", max((x for x in videos if (x.height or 0) == target), key=bandwidth))]
+    if audios:
+        chosen.append(("audio", max(audios, key=bandwidth)))
+
+    tracks = []
+    for kind, rep in chosen:
+        if rep.template is not None:
+            urls = template_segments(rep, period.duration or mpd.duration)
+            segments = [(x, None) for x in urls]
+        elif rep.base_url or rep.parent_url:
+            segments = file_ranges(service, rep.url)
+        else:
+            raise ValueError("unsupported segment addressing")
+
+        suffix = ".webm" if "webm" in (rep.mime_type or "") else ".mp4"
+        tracks.append(Track(kind, segments, suffix, rep.template is not None))
+
+    return tracks
+
+
+def bandwidth(rep: object) -> int:
+    return rep.bandwidth or 0
+
+
+def plan_tracks(service: object) -> list:
+    """
+    Work out the tracks to download from the manifest
+
+    Raises ValueError for anything the engine can't handle
+    """
+    if service.key_file:
+        raise ValueError("encrypted stream")
+    if service.skip_download or service.sub_only:
+        raise ValueError("info and subtitle-only runs")
+    if service.add_command:
+        raise ValueError("extra N_m3u8DL-RE commands")
+    check_selection(service)
+
+    url = str(service.manifest)
+    if not url.startswith("http"):
+        raise ValueError("manifest isn't a URL")
+
+    data = manifest_data(service, url)
+    if data.lstrip().startswith(b"#EXTM3U"):
+        return hls_tracks(service, data, url)
+    return dash_tracks(service, data, url)
+
+
+class SegmentDownloader:
+    def __init__(self, service: object, threads: int, directory: Path) -> None:
+        self.service = service
+        self.threads = threads
+        self.directory = directory
+        self.limits = {}
+        self.progress = None
+
+    def client(self) -> httpx.AsyncClient:
+        session = self.service.client
+        return httpx.AsyncClient(
+            headers=dict(session.headers),
+            cookies=httpx.Cookies(session.cookies),
+            # Segments sit next to the manifest, so they're routed the same way
+            proxy=proxy_for(session, str(self.service.manifest)),
+            follow_redirects=True,
+            timeout=httpx.Timeout(30.0),
+            limits=httpx.Limits(
+                max_connections=self.threads * 4,
+                max_keepalive_connections=self.threads * 4,
+            ),
+        )
+
+    def progress_bar(self) -> Progress:
+        columns = (
+            TextColumn("{task.description:<6}"),
+            BarColumn(),
+            MofNCompleteColumn(),
+        )
+        return Progress(*columns, console=self.service.console)
+
+    def limit(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        if host not in self.limits:
+            self.limits[host] = asyncio.Semaphore(self.threads)
+        return self.limits[host]
+
+    async def fetch(self, client: httpx.AsyncClient, url: str, byterange: tuple) -> bytes:
+        headers = {"Range": "bytes={}-{}".format(*byterange)} if byterange else None
+
+        for attempt in range(RETRIES + 1):
+            try:
+                async with self.limit(url):
+                    r = await client.get(url, headers=headers)
+                r.raise_for_status()
+            except httpx.HTTPError as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if attempt == RETRIES or (status and status not in RETRY_STATUS):
+                    raise
+                log.debug(f"Retrying segment ({e}): {url}")
+                metrics.inc("retries", kind="segment")
+                await asyncio.sleep(2**attempt)
+                continue
+
+            metrics.inc("bytes", len(r.content), kind="segments")
+            if byterange and r.status_code != 206:
+                # The server ignored the range and sent the whole resource
+                return r.content[byterange[0] : byterange[1] + 1]
+            return r.content
+
+    async def fetch_in_order(
+        self, client: httpx.AsyncClient, segments: list, write: callable
+    ) -> None:
+        """Fetch segments ahead within a window, but hand them to `write` in order"""
+        window = self.threads * 2
+        pending = deque()
+
+        try:
+            for url, byterange in segments:
+                pending.append(asyncio.ensure_future(self.fetch(client, url, byterange)))
+                if len(pending) >= window:
+                    await write(await pending.popleft())
+
+            while pending:
+                await write(await pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def download_track(self, client: httpx.AsyncClient, track: Track) -> Path:
+        part = self.directory / f"{track.kind}{track.suffix}"
+        state = PartialState.load(
+            self.directory / f"{track.kind}.json", track.fingerprint, part
+        )
+        if state.done:
+            log.info(f"Resuming {track.kind} at segment {state.done}/{len(track.segments)}")
+
+        task = self.progress.add_task(
+            track.kind.capitalize(), total=len(track.segments), completed=state.done
+        )
+
+        with open(part, "r+b" if part.exists() else "wb") as f:
+            f.truncate(state.size)
+            f.seek(state.size)
+
+            async def write(data: bytes) -> None:
+                f.write(data)
+                state.done += 1
+                state.size += len(data)
+                if state.done % STATE_INTERVAL == 0:
+                    f.flush()
+                    state.save()
+                self.progress.advance(task)
+
+            try:
+                await self.fetch_in_order(client, track.segments[state.done :], write)
+            finally:
+                f.flush()
+                state.save()
+
+        return part
+
+    async def download(self, tracks: list) -> list:
+        with self.progress_bar() as self.progress:
+            async with self.client() as client:
+                return await asyncio.gather(
+                    *(self.download_track(client, track) for track in tracks)
+                )
+
+    async def stream_track(
+        self, client: httpx.AsyncClient, track: Track, target: object
+    ) -> None:
+        task = self.progress.add_task(track.kind.capitalize(), total=len(track.segments))
+
+        # Opening a named pipe blocks until the muxer opens the other end,
+        # and writes block while it's busy with another input
+        pipe = await asyncio.to_thread(open, target, "wb") if isinstance(target, Path) else target
+
+        async def write(data: bytes) -> None:
+            await asyncio.to_thread(pipe.write, data)
+            self.progress.advance(task)
+
+        try:
+            await self.fetch_in_order(client, track.segments, write)
+        finally:
+            await asyncio.to_thread(pipe.close)
+
+    async def stream(self, tracks: list, muxer: str, output: Path, subtitles: list) -> None:
+        """Feed the tracks straight into the muxer, through stdin or named pipes"""
+        if len(tracks) == 1:
+            inputs = ["pipe:0"]
+        else:
+            inputs = [self.directory / f"{track.kind}.pipe" for track in tracks]
+            for fifo in inputs:
+                fifo.unlink(missing_ok=True)
+                os.mkfifo(fifo)
+
+        partial = partial_path(output)
+        command = mux_command(muxer, inputs, partial, subtitles)
+        self.service.log.debug(f"Streaming into: {' '.join(str(x) for x in command)}")
+        process = subprocess.Popen(
+            command, stdin=subprocess.PIPE if len(tracks) == 1 else subprocess.DEVNULL
+        )
+        targets = [process.stdin] if len(tracks) == 1 else inputs
+
+        with self.progress_bar() as self.progress:
+            async with self.client() as client:
+                downloads = asyncio.ensure_future(
+                    asyncio.gather(
+                        *(self.stream_track(client, t, x) for t, x in zip(tracks, targets))
+                    )
+                )
+                exited = asyncio.ensure_future(asyncio.to_thread(process.wait))
+                await asyncio.wait({downloads, exited}, return_when=asyncio.FIRST_COMPLETED)
+
+                if not downloads.done():
+                    error = ValueError(f"{muxer} exited with code {exited.result()}")
+                else:
+                    error = downloads.exception()
+
+                if error is not None:
+                    # Either side failed, take the other one down with it
+                    downloads.cancel()
+                    process.kill()
+                    release_pipes(inputs)
+                    await asyncio.gather(downloads, exited, return_exceptions=True)
+                    partial.unlink(missing_ok=True)
+                    raise error
+
+                code = await exited
+
+        if code != 0:
+            partial.unlink(missing_ok=True)
+            raise ValueError(f"{muxer} exited with code {code}")
+
+        os.replace(partial, output)
+
+
+def release_pipes(inputs: list) -> None:
+    """Unblock writers still waiting for the muxer to open their pipe"""
+    for fifo in inputs:
+        if isinstance(fifo, Path) and fifo.exists():
+            try:
+                os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+
+
+def can_stream(service: object, tracks: list, muxer: str) -> bool:
+    """
+    Whether the tracks can be muxed as they download
+
+    mkvmerge needs seekable input, so only ffmpeg takes segments over pipes
+    """
+    if service.no_mux or muxer != "ffmpeg":
+        return False
+    if not all(track.streamable for track in tracks):
+        return False
+    return len(tracks) == 1 or hasattr(os, "mkfifo")
+
+
+def subtitle_inputs(service: object) -> list:
+    """
+    The service's own subtitle as a (path, name) pair, unless it's stored separately
+
+    Subtitles fetched in the background are joined here, once the media is in,
+    and with --sub-no-mux moved to the save path instead
+    """
+    sub_path = join_subtitles(service)
+    if not sub_path:
+        return []
+
+    if subtitle_settings(service)[0] == "true":
+        _, format, _, _ = format_settings(service)
+        _, save_path, _, _ = dir_settings(service, format)
+        Path(save_path).mkdir(parents=True, exist_ok=True)
+        shutil.move(sub_path, save_path)
+        service.sub_path = None
+        return []
+
+    return [(sub_path, getattr(service, "sub_lang", "English"))]
+
+
+def mux_in_background(
+    service: object, inputs: list, subtitles: list, file_path: Path, cleanup: list
+) -> None:
+    """Leave the tracks for the mux pool, run_download submits them"""
+    _, _, muxer, _ = format_settings(service)
+    _, workers = mux_settings(service)
+    if workers:
+        mux_pool.configure(int(workers))
+
+    service.pending_mux = partial(
+        mux_pool.submit,
+        muxer,
+        inputs,
+        file_path,
+        subtitles,
+        cleanup,
+        source=service_name(service),
+    )
+
+
+def mux_staged(service: object, file_path: Path, background: bool = True) -> None:
+    """Mux the tracks N_m3u8DL-RE left in the staging folder, on the mux pool by default"""
+    _, format, _, _ = format_settings(service)
+    _, save_path, _, _ = dir_settings(service, format)
+    sub_no_mux = subtitle_settings(service)[0]
+    staging = work_dir(service, "tracks")
+    Path(save_path).mkdir(parents=True, exist_ok=True)
+
+    tracks, staged_subtitles = staged_tracks(staging)
+    if not tracks:
+        raise ValueError(f"No tracks were downloaded to {staging}")
+
+    subtitles = subtitle_inputs(service)
+    for path in staged_subtitles:
+        if sub_no_mux == "true":
+            shutil.move(path, save_path)
+        else:
+            # N_m3u8DL-RE names them <filename>.<language>.<ext>
+            subtitles.append((path, path.stem.rpartition(".")[2]))
+
+    cleanup = [staging, *(path for path, _ in subtitles)]
+    if background:
+        mux_in_background(service, tracks, subtitles, file_path, cleanup)
+        return
+
+    _, _, muxer, _ = format_settings(service)
+    mux_pool.job(muxer, tracks, file_path, subtitles, cleanup, service_name(service), None)
+
+
+def native_download(service: object, tracks: list, file_path: Path) -> None:
+    threads, format, muxer, _ = format_settings(service)
+    temp, save_path, filename, _ = dir_settings(service, format)
+    background_mux, _ = mux_settings(service)
+
+    directory = Path(temp) / f"{filename}.native"
+    directory.mkdir(parents=True, exist_ok=True)
+    Path(save_path).mkdir(parents=True, exist_ok=True)
+
+    downloader = SegmentDownloader(service, int(threads), directory)
+
+    if can_stream(service, tracks, muxer):
+        # The muxer starts with the download, so subtitles can't wait for it
+        subtitles = subtitle_inputs(service)
+        # Muxing happens while downloading, so it all counts as download time
+        with metrics.phase("download"):
+            asyncio.run(downloader.stream(tracks, muxer, file_path, subtitles))
+    else:
+        with metrics.phase("download"):
+            parts = asyncio.run(downloader.download(tracks))
+        if service.no_mux:
+            for part in parts:
+                part.replace(Path(save_path) / f"{filename}.{part.stem}{part.suffix}")
+            shutil.rmtree(directory, ignore_errors=True)
+            return
+
+        subtitles = subtitle_inputs(service)
+        cleanup = [directory, *(path for path, _ in subtitles)]
+        if background_mux == "true":
+            mux_in_background(service, parts, subtitles, file_path, cleanup)
+            return
+        with metrics.phase("mux"):
+            mux(muxer, parts, file_path, subtitles)
+
+    for path, _ in subtitles:
+        path.unlink(missing_ok=True)
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_downloader(service: object, args: list, file_path: Path) -> None:
+    """Download with the configured engine, falling back to N_m3u8DL-RE"""
+    # Plans stop once the title is resolved, see utils/planner.py
+    if service.planning:
+        return
+
+    if not service.skip_download and not service.sub_only:
+        _, format, _, _ = format_settings(service)
+        temp, save_path, _, _ = dir_settings(service, format)
+        preflight(service, temp, save_path)
+
+    if get_engine(service) == "native":
+        try:
+            tracks = plan_tracks(service)
+        except (ValueError, LookupError, OSError) as e:
+            log.info(f"Native engine can't handle this stream ({e}), using N_m3u8DL-RE")
+        else:
+            log.debug(f"Native engine: {tracks}")
+            return native_download(service, tracks, file_path)
+
+    # Anything left over from an interrupted run
+    shutil.rmtree(work_dir(service, "out"), ignore_errors=True)
+    try:
+        with metrics.phase("download"):
+            supervise(service, args)
+    finally:
+        # Failed and restarted downloads are dropped too, or they'd pile up in a daemon
+        transferred = transfer_stats.pop(service.filename).get("bytes")
+    if transferred:
+        metrics.inc("bytes", transferred, kind="segments")
+
+    if mux_settings(service)[0] == "true":
+        mux_staged(service, file_path)
+    elif stage_tracks(service):
+        mux_staged(service, file_path, background=False)
+    else:
+        if work_dir(service, "out").exists():
+            finalize_dir(work_dir(service, "out"), file_path.parent)
+        # Moves subtitles that are kept next to the output into place
+        subtitle_inputs(service)
@@ -0,0 +1,60 @@
+"""
+Filename templates
+
+The filename templates in config.yaml are compiled once into a format
+string for each combination of season and episode numbers, with the "S"
+or "E" in front of a missing number already taken out, so rendering a
+filename is a single format call.
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from string import Formatter
+
+
+def escape(literal: str) -> str:
+    return literal.replace("{", "{{").replace("}", "}}")
+
+
+class Template:
+    """Filename template, compiled for every combination of missing numbers"""
+
+    __slots__ = ("variants",)
+
+    def __init__(self, template: str) -> None:
+        parts = list(Formatter().parse(template))
+        self.variants = {
+            (season, episode): self.compile(parts, season, episode)
+            for season in (True, False)
+            for episode in (True, False)
+        }
+
+    @staticmethod
+    def compile(parts: list, season: bool, episode: bool) -> str:
+        """Format string without the S or E right in front of a missing number"""
+        result = []
+        for literal, field, spec, conversion in parts:
+            if (field == "season" and not season and literal.endswith("S")) or (
+                field == "episode" and not episode and literal.endswith("E")
+            ):
+                literal = literal[:-1]
+
+            result.append(escape(literal))
+            if field is not None:
+                result.append(
+                    "{"
+                    + field
+                    + (f"!{conversion}" if conversion else "")
+                    + (f":{spec}" if spec else "")
+                    + "}"
+                )
+        return "".join(result)
+
+    def render(self, **fields) -> str:
+        key = (bool(fields.get("season")), bool(fields.get("episode")))
+        return self.variants[key].format_map(fields)
+
+
+@lru_cache(maxsize=None)
+def compile_template(template: str) -> Template:
+    return Template(template)
@@ -0,0 +1,345 @@
+"""
+Single-pass HLS playlist scanner
+
+Most services only need resolution, bandwidth, codecs and URIs from a
+master playlist, so instead of building the full m3u8 object graph the
+playlist is scanned line by line into compact variant records. Playlists
+the scanner can't make sense of are handed to m3u8 as a fallback.
+"""
+from __future__ import annotations
+
+import logging
+import re
+from urllib.parse import urljoin
+
+import m3u8
+
+from utils.manifests import manifest_cache
+
+ATTRIBUTES = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^",]*)')
+
+# Master playlist tags the scanner reads or can safely skip, anything else goes to m3u8
+MASTER_TAGS = {
+    "#EXTM3U",
+    "#EXT-X-VERSION",
+    "#EXT-X-INDEPENDENT-SEGMENTS",
+    "#EXT-X-START",
+    "#EXT-X-DEFINE",
+    "#EXT-X-MEDIA",
+    "#EXT-X-STREAM-INF",
+    "#EXT-X-I-FRAME-STREAM-INF",
+    "#EXT-X-SESSION-DATA",
+    "#EXT-X-SESSION-KEY",
+    "#EXT-X-KEY",
+    "#EXT-X-CONTENT-STEERING",
+}
+
+log = logging.getLogger()
+
+
+def parse_attributes(line: str) -> dict:
+    """Parse an attribute list such as BANDWIDTH=1280000,CODECS="avc1,mp4a" """
+    attributes = {}
+    for key, value in ATTRIBUTES.findall(line.partition(":")[2]):
+        attributes[key] = value[1:-1] if value[:1] == '"' else value
+    return attributes
+
+
+def to_int(value: str) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Variant:
+    __slots__ = (
+        "uri",
+        "program_id",
+        "bandwidth",
+        "average_bandwidth",
+        "width",
+        "height",
+        "codecs",
+        "frame_rate",
+        "audio",
+        "subtitles",
+    )
+
+    def __init__(self, attributes: dict, uri: str = None) -> None:
+        self.uri = uri
+        self.program_id = to_int(attributes.get("PROGRAM-ID"))
+        self.bandwidth = to_int(attributes.get("BANDWIDTH"))
+        self.average_bandwidth = to_int(attributes.get("AVERAGE-BANDWIDTH"))
+        self.codecs = attributes.get("CODECS")
+        self.frame_rate = attributes.get("FRAME-RATE")
+        self.audio = attributes.get("AUDIO")
+        self.subtitles = attributes.get("SUBTITLES")
+
+        width, _, height = attributes.get("RESOLUTION", "").partition("x")
+        self.width = to_int(width)
+        self.height = to_int(height)
+
+    @property
+    def resolution(self) -> tuple:
+        return (self.width, self.height) if self.height else None
+
+    def __repr__(self) -> str:
+        return f"Variant({self.height}p, {self.bandwidth}, {self.codecs!r}, {self.uri!r})"
+
+
+class Media:
+    __slots__ = ("type", "group_id", "name", "language", "uri", "default", "channels")
+
+    def __init__(self, attributes: dict) -> None:
+        self.type = attributes.get("TYPE")
+        self.group_id = attributes.get("GROUP-ID")
+        self.name = attributes.get("NAME")
+        self.language = attributes.get("LANGUAGE")
+        self.uri = attributes.get("URI")
+        self.default = attributes.get("DEFAULT") == "YES"
+        self.channels = attributes.get("CHANNELS")
+
+    def __repr__(self) -> str:
+        return f"Media({self.type}, {self.group_id!r}, {self.language!r}, {self.uri!r})"
+
+
+class MasterPlaylist:
+    __slots__ = ("url", "variants", "media", "keys")
+
+    def __init__(self, url: str = None) -> None:
+        self.url = url
+        self.variants = []
+        self.media = []
+        # Raw attribute lists of EXT-X-SESSION-KEY and EXT-X-KEY tags
+        self.keys = []
+
+    @property
+    def is_variant(self) -> bool:
+        return bool(self.variants)
+
+    @property
+    def heights(self) -> list:
+        return sorted({v.height for v in self.variants if v.height}, reverse=True)
+
+    @property
+    def codecs(self) -> list:
+        return [v.codecs for v in self.variants if v.codecs]
+
+    def resolve(self, uri: str) -> str:
+        return urljoin(self.url, uri) if self.url else uri
+
+    def best(self, height: int = None) -> Variant:
+        """Highest bandwidth variant, optionally at the height closest to the one given"""
+        variants = [v for v in self.variants if v.height] or self.variants
+        if not variants:
+            return None
+
+        if height is not None:
+            target = min(
+                {v.height for v in variants}, key=lambda x: abs(x - int(height))
+            )
+            variants = [v for v in variants if v.height == target]
+
+        return max(variants, key=lambda v: v.bandwidth or 0)
+
+    def __repr__(self) -> str:
+        return f"MasterPlaylist({len(self.variants)} variant(s), {len(self.media)} media)"
+
+
+class Segment:
+    __slots__ = ("uri", "duration", "byterange")
+
+    def __init__(self, uri: str, duration: float = None, byterange: tuple = None) -> None:
+        self.uri = uri
+        self.duration = duration
+        # Inclusive (first, last) byte positions, like an HTTP Range header
+        self.byterange = byterange
+
+    def __repr__(self) -> str:
+        return f"Segment({self.uri!r}, {self.byterange})"
+
+
+class MediaPlaylist:
+    __slots__ = ("url", "init", "segments", "keys", "endlist")
+
+    def __init__(self, url: str = None) -> None:
+        self.url = url
+        # EXT-X-MAP of fMP4 playlists
+        self.init = None
+        self.segments = []
+        self.keys = []
+        self.endlist = False
+
+    @property
+    def encrypted(self) -> bool:
+        return any(key.get("METHOD", "NONE") != "NONE" for key in self.keys)
+
+    @property
+    def duration(self) -> float:
+        return sum(x.duration or 0 for x in self.segments)
+
+    def resolve(self, uri: str) -> str:
+        return urljoin(self.url, uri) if self.url else uri
+
+    def __repr__(self) -> str:
+        return f"MediaPlaylist({len(self.segments)} segment(s))"
+
+
+def to_byterange(value: str, offset: int = 0) -> tuple:
+    """Convert an EXT-X-BYTERANGE value of <length>[@<offset>] to (first, last)"""
+    length, _, start = value.partition("@")
+    start = int(start) if start else offset
+    return (start, start + int(length) - 1)
+
+
+def lines_of(data: object) -> object:
+    if isinstance(data, bytes):
+        data = data.decode("utf-8")
+    if isinstance(data, str):
+        return data.splitlines()
+    # Iterables of lines, e.g. Response.iter_lines()
+    return (x.decode("utf-8") if isinstance(x, bytes) else x for x in data)
+
+
+def scan_master(data: object, url: str = None) -> MasterPlaylist:
+    """Scan a master playlist from text, bytes or an iterable of lines"""
+    master = MasterPlaylist(url)
+    pending = None
+
+    for line in lines_of(data):
+        line = line.strip()
+        if not line:
+            continue
+
+        if line[0] != "#":
+            if pending is not None:
+                master.variants.append(Variant(pending, line))
+                pending = None
+            continue
+
+        tag = line.partition(":")[0]
+        if tag.startswith("#EXT") and tag not in MASTER_TAGS:
+            raise ValueError(f"Unknown tag {tag}")
+
+        if tag == "#EXT-X-STREAM-INF":
+            if pending is not None:
+                raise ValueError("EXT-X-STREAM-INF without a URI")
+            pending = parse_attributes(line)
+
+        elif tag == "#EXT-X-MEDIA":
+            master.media.append(Media(parse_attributes(line)))
+
+        elif tag in ("#EXT-X-SESSION-KEY", "#EXT-X-KEY"):
+            master.keys.append(parse_attributes(line))
+
+    if pending is not None:
+        raise ValueError("Playlist ended without a variant URI")
+
+    return master
+
+
+def scan_media(data: object, url: str = None) -> MediaPlaylist:
+    """Scan a media playlist from text, bytes or an iterable of lines"""
+    playlist = MediaPlaylist(url)
+    duration = None
+    byterange = None
+    # Ranges without an offset continue where the previous one of the same URI ended
+    offsets = {}
+
+    for line in lines_of(data):
+        line = line.strip()
+        if not line:
+            continue
+
+        if line[0] != "#":
+            if byterange is not None:
+                byterange = to_byterange(byterange, offsets.get(line, 0))
+                offsets[line] = byterange[1] + 1
+            playlist.segments.append(Segment(line, duration, byterange))
+            duration = None
+            byterange = None
+
+        elif line.startswith("#EXTINF:"):
+            duration = float(line[8:].partition(",")[0] or 0)
+
+        elif line.startswith("#EXT-X-BYTERANGE:"):
+            byterange = line[17:]
+
+        elif line.startswith("#EXT-X-MAP:"):
+            attributes = parse_attributes(line)
+            value = attributes.get("BYTERANGE")
+            playlist.init = Segment(
+                attributes["URI"], byterange=to_byterange(value) if value else None
+            )
+
+        elif line.startswith("#EXT-X-KEY"):
+            playlist.keys.append(parse_attributes(line))
+
+        elif line.startswith("#EXT-X-ENDLIST"):
+            playlist.endlist = True
+
+    return playlist
+
+
+def from_m3u8_object(m3u8_obj: m3u8.M3U8, url: str = None) -> MasterPlaylist:
+    master = MasterPlaylist(url)
+
+    for playlist in m3u8_obj.playlists:
+        info = playlist.stream_info
+        attributes = {
+            "PROGRAM-ID": info.program_id,
+            "BANDWIDTH": info.bandwidth,
+            "AVERAGE-BANDWIDTH": info.average_bandwidth,
+            "CODECS": info.codecs,
+            "FRAME-RATE": info.frame_rate,
+            "AUDIO": info.audio,
+            "SUBTITLES": info.subtitles,
+        }
+        if info.resolution:
+            attributes["RESOLUTION"] = "x".join(str(x) for x in info.resolution)
+        master.variants.append(Variant(attributes, playlist.uri))
+
+    for media in m3u8_obj.media:
+        master.media.append(
+            Media(
+                {
+                    "TYPE": media.type,
+                    "GROUP-ID": media.group_id,
+                    "NAME": media.name,
+                    "LANGUAGE": media.language,
+                    "URI": media.uri,
+                    "DEFAULT": media.default,
+                    "CHANNELS": media.channels,
+                }
+            )
+        )
+
+    return master
+
+
+def parse_master(data: object, url: str = None) -> MasterPlaylist:
+    """Scan a master playlist, falling back to m3u8 if the scanner gives up"""
+    if not isinstance(data, (str, bytes)):
+        data = "\n".join(lines_of(data))
+
+    try:
+        return scan_master(data, url)
+    except Exception as e:
+        log.debug(f"Falling back to m3u8 for master playlist: {e}")
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        return from_m3u8_object(m3u8.loads(data), url)
+
+
+def load_master(client: object, url: str, **kwargs) -> MasterPlaylist:
+    """Scan a master playlist, requested with the given client unless it's cached"""
+    return manifest_cache.parse(client, url, parse_master, **kwargs)
+
+
+def iter_segments(data: object) -> object:
+    """Yield segment URIs of a media playlist in order"""
+    for line in lines_of(data):
+        line = line.strip()
+        if line and line[0] != "#":
+            yield line
@@ -0,0 +1,175 @@
+"""
+Crash-safe job journal for batch downloads
+
+Every planned download is recorded with its state so that an interrupted
+or partially failed batch can be continued with --resume, without
+fetching the catalog again or redoing finished work.
+
+States: resolved -> downloading -> (muxing) -> done, or failed
+
+Jobs of the same service share one journal file, so every save merges
+its batch into what's on disk under a file lock.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from utils.titles import Episode, Movie
+from utils.tokens import FileLock
+
+STATES = ("resolved", "downloading", "muxing", "done", "failed")
+TYPES = {"Episode": Episode, "Movie": Movie}
+# Everything needed to download a title again, in the order of its __init__
+FIELDS = {
+    "Episode": (
+        "id",
+        "service",
+        "title",
+        "season",
+        "number",
+        "name",
+        "year",
+        "data",
+        "subtitle",
+        "lic_url",
+        "drm",
+        "premium",
+        "synopsis",
+        "description",
+        "special",
+    ),
+    "Movie": (
+        "id",
+        "service",
+        "title",
+        "name",
+        "year",
+        "data",
+        "subtitle",
+        "lic_url",
+        "synopsis",
+        "drm",
+    ),
+}
+# Jobs of the same service can run at the same time in serve mode
+SAVE_LOCK = threading.Lock()
+
+
+def dump_title(download: object) -> dict:
+    """Journal entry of a title. Raises TypeError if a field can't be stored as JSON"""
+    kind = download.__class__.__name__
+    fields = {name: getattr(download, name, None) for name in FIELDS[kind]}
+    try:
+        json.dumps(fields)
+    except (TypeError, ValueError) as e:
+        raise TypeError(f"{kind} {download.id} can't be written to the journal: {e}") from e
+    return {"type": kind, "fields": fields}
+
+
+def load_title(data: dict) -> object:
+    # Bypass __init__ so names and numbers are restored exactly as planned
+    title = object.__new__(TYPES[data["type"]])
+    title.__dict__.update(data["fields"])
+    return title
+
+
+class Journal:
+    def __init__(self, stream: object) -> None:
+        self.log = logging.getLogger()
+        self.path = Path(stream.config["download_cache"]).with_name("journal.json")
+        self.key = "|".join(
+            str(x)
+            for x in (
+                stream.url,
+                stream.episode,
+                stream.season,
+                stream.complete,
+                stream.movie,
+            )
+        )
+        # Dry runs, plans and listings should never touch the journal
+        self.enabled = not stream.skip_download and not stream.plan
+        self.data = self.load()
+        # Background muxes finish on other threads
+        self.lock = threading.RLock()
+
+    def load(self) -> dict:
+        if not self.path.exists():
+            return {}
+        try:
+            with self.path.open("r") as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            self.log.warning("Job journal is corrupt, starting a new one")
+            return {}
+
+    def save(self) -> None:
+        with SAVE_LOCK, FileLock(self.path.with_suffix(".lock")):
+            # Other batches may have been saved since this one was loaded
+            data = self.load()
+            data[self.key] = self.data.get(self.key)
+
+            # Write to a temporary file first so a crash never leaves a torn journal
+            tmp = self.path.with_name(f"{self.path.stem}.{os.getpid()}.tmp")
+            with tmp.open("w") as f:
+                json.dump(data, f, indent=4)
+            os.replace(tmp, self.path)
+
+    @property
+    def batch(self) -> dict:
+        return self.data.get(self.key)
+
+    def plan(self, downloads: list, title: str) -> None:
+        if not self.enabled:
+            return
+
+        items = {}
+        for download in downloads:
+            # Bookkeeping never stops a download, the title just can't be resumed
+            try:
+                items[str(download.id)] = {
+                    "state": "resolved",
+                    "error": None,
+                    **dump_title(download),
+                }
+            except TypeError as e:
+                self.log.warning(f"Not journaling {str(download)}: {e}")
+
+        self.data[self.key] = {"title": title, "created": time.time(), "items": items}
+        self.save()
+
+    def resume(self) -> tuple:
+        """Return unfinished downloads and title from a previous run"""
+        if self.batch is None:
+            return None, None
+
+        downloads = [
+            load_title(item)
+            for item in self.batch["items"].values()
+            if item["state"] != "done"
+        ]
+        return downloads, self.batch["title"]
+
+    def update(self, download: object, state: str, error: str = None) -> None:
+        if not self.enabled or self.batch is None:
+            return
+
+        with self.lock:
+            item = self.batch["items"].get(str(download.id))
+            if item is None:
+                return
+
+            item["state"] = state
+            item["error"] = error
+            item["updated"] = time.time()
+            self.save()
+
+    def count(self, state: str) -> int:
+        if self.batch is None:
+            return 0
+        return sum(1 for x in self.batch["items"].values() if x["state"] == state)
@@ -1,3 +1,4 @@
+import copy
 import importlib.util
 import json
 import logging
@@ -32,12 +33,17 @@ class Service:
         self.profile = profile
         self.cookies = cookies
         self.credentials = credentials
+        self.module = None
 
     def import_service(self):
+        if self.module is not None:
+            return getattr(self.module, self.name)
+
         spec = importlib.util.spec_from_file_location(self.name, str(self.path))
         service_module = importlib.util.module_from_spec(spec)
         sys.modules[self.name] = service_module
         spec.loader.exec_module(service_module)
+        self.module = service_module
         return getattr(service_module, self.name)
 
 
@@ -59,41 +65,54 @@ class ServiceManager:
 
         self.services = {url: Service(**data) for url, data in data.items()}
 
-    def get_service(self, url) -> tuple:
+    def find_service(self, url) -> Service:
         log = logging.getLogger()
         service = self.services.get(urlparse(url).netloc)
         if service is None:
             log.error("URL did not match any supported service")
             sys.exit(1)
 
+        return service
+
+    def get_service(self, url) -> tuple:
+        """
+        Return service class and a fresh copy of the merged config
+
+        The main config is never mutated, so a long-running process can
+        resolve several services without settings leaking between them
+        """
+        log = logging.getLogger()
+        service = self.find_service(url)
+        config = copy.deepcopy(self.config)
+
         log.info(f"\u001b[1m{service.alias[0]}\u001b[0m")
 
         if service.config.exists():
             log.info("+ Adding service config")
             with open(service.config, "r") as f:
-                self.config.update(yaml.safe_load(f))
+                config.update(yaml.safe_load(f))
 
         if service.profile.exists():
             log.info("+ Adding service profile")
             with open(service.profile, "r") as f:
-                self.config.update(yaml.safe_load(f))
+                config.update(yaml.safe_load(f))
 
         if service.cookies.exists():
             log.info("+ Adding cookie data")
-            self.config["cookies"] = service.cookies
+            config["cookies"] = service.cookies
 
         if service.cache.exists():
-            self.config["download_cache"] = service.cache
+            config["download_cache"] = service.cache
         else:
             service.cache.touch()
             with service.cache.open("w") as file:
                 json.dump({}, file)
-            self.config["download_cache"] = service.cache
+            config["download_cache"] = service.cache
 
         with open(service.api, "r") as f:
-            self.config.update(yaml.safe_load(f))
+            config.update(yaml.safe_load(f))
 
-        return service.import_service(), self.config
+        return service.import_service(), config
 
 
 service_manager = ServiceManager()
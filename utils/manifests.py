@@ -0,0 +1,195 @@
+"""
+Run-scoped manifest cache
+
+Manifests are cached in memory by URL, both as raw bytes and in every
+parsed form they've been requested in, so a manifest is fetched and parsed
+at most once per episode. Entries live until the token embedded in the URL
+expires, or for a short default lifetime if the URL carries none. In serve
+mode the cache is shared by all jobs of the daemon, so entries are also
+keyed by the proxy, headers and params they were requested with: a
+manifest fetched from one region or with one account's auth is never
+handed to a job that would have gotten another one.
+"""
+from __future__ import annotations
+
+import base64
+import json
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, unquote, urlparse
+
+from utils.metrics import metrics
+
+log = logging.getLogger()
+
+DEFAULT_TTL = 300
+MAX_TTL = 3600
+MARGIN = 30
+MAX_ENTRIES = 64
+
+EXPIRY_KEYS = ("exp", "expires", "expiry", "expire", "validto")
+EMBEDDED_EXPIRY = re.compile(r"(?:^|[~&/_])exp(?:ires)?=(\d{10,13})")
+
+
+def to_seconds(value: str) -> float:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    # Some CDNs use milliseconds
+    return value / 1000 if value > 1e12 else value
+
+
+def jwt_expiry(token: str) -> float:
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return to_seconds(json.loads(base64.urlsafe_b64decode(payload)).get("exp"))
+    except (IndexError, ValueError, AttributeError):
+        return None
+
+
+def token_expiry(url: str) -> float:
+    """Best guess of when the token carried by a manifest URL expires"""
+    parsed = urlparse(str(url))
+    params = {k.lower(): v for k, v in parse_qsl(parsed.query)}
+
+    for key in EXPIRY_KEYS:
+        expiry = to_seconds(params.get(key))
+        if expiry and expiry > 1e9:
+            return expiry
+
+    # Signed S3 and GCS URLs
+    if "x-amz-date" in params and "x-amz-expires" in params:
+        signed = datetime.strptime(params["x-amz-date"], "%Y%m%dT%H%M%SZ")
+        signed = signed.replace(tzinfo=timezone.utc).timestamp()
+        return signed + float(params["x-amz-expires"])
+
+    # Akamai tokens (hdnts, hdnea, __token__) can sit in the query or the path
+    match = EMBEDDED_EXPIRY.search(unquote(f"{parsed.path}&{parsed.query}"))
+    if match:
+        return to_seconds(match.group(1))
+
+    for value in params.values():
+        if value.count(".") == 2 and value.startswith("eyJ"):
+            expiry = jwt_expiry(value)
+            if expiry:
+                return expiry
+
+    return None
+
+
+def cache_key(url: str, client: object = None, **kwargs) -> tuple:
+    """URL and what else decides the response: proxy, headers and params of the request"""
+    headers = {k.lower(): v for k, v in (getattr(client, "headers", None) or {}).items()}
+    headers.update({k.lower(): v for k, v in (kwargs.get("headers") or {}).items()})
+    proxies = {
+        **(getattr(client, "proxies", None) or {}),
+        **(kwargs.get("proxies") or {}),
+    }
+
+    return (
+        str(url),
+        proxies.get(urlparse(str(url)).scheme),
+        # Headers set to None are removed from the request
+        tuple(sorted((k, str(v)) for k, v in headers.items() if v is not None)),
+        repr(getattr(client, "params", None) or None),
+        repr(kwargs.get("params")),
+    )
+
+
+class Entry:
+    __slots__ = ("data", "parsed", "expires")
+
+    def __init__(self, data: bytes, expires: float) -> None:
+        self.data = data
+        self.parsed = {}
+        self.expires = expires
+
+
+class ManifestCache:
+    def __init__(self, max_entries: int = MAX_ENTRIES) -> None:
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lifetime(self, url: str) -> float:
+        now = time.time()
+        expiry = token_expiry(url)
+        if expiry is None:
+            return now + DEFAULT_TTL
+        return min(expiry - MARGIN, now + MAX_TTL)
+
+    def lookup(self, url: str, client: object = None, **kwargs) -> Entry:
+        key = cache_key(url, client, **kwargs)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, url: str, data: bytes, client: object = None, **kwargs) -> Entry:
+        """
+        Store a manifest that was fetched elsewhere, e.g. by an async client
+
+        Pass the client and request arguments that later lookups will use
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        entry = Entry(data, self.lifetime(url))
+        if entry.expires <= time.time():
+            log.debug(f"Not caching manifest with an expiring token: {url}")
+            return entry
+
+        key = cache_key(url, client, **kwargs)
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def fetch(self, client: object, url: str, **kwargs) -> Entry:
+        entry = self.lookup(url, client, **kwargs)
+        if entry is not None:
+            self.hits += 1
+            metrics.inc("cache_hits", cache="manifest")
+            return entry
+
+        self.misses += 1
+        metrics.inc("cache_misses", cache="manifest")
+        r = client.get(url, **kwargs)
+        r.raise_for_status()
+        return self.put(url, r.content, client, **kwargs)
+
+    def get(self, client: object, url: str, **kwargs) -> bytes:
+        """Raw manifest bytes, requested with the given client on a miss"""
+        return self.fetch(client, url, **kwargs).data
+
+    def parse(self, client: object, url: str, parser: callable, **kwargs) -> object:
+        """Manifest parsed with `parser(data, url)`, parsed once per entry"""
+        return self.parsed(self.fetch(client, url, **kwargs), url, parser)
+
+    def parsed(self, entry: Entry, url: str, parser: callable) -> object:
+        parsed = entry.parsed.get(parser)
+        if parsed is None:
+            parsed = entry.parsed[parser] = parser(entry.data, url)
+        return parsed
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+manifest_cache = ManifestCache()
@@ -0,0 +1,279 @@
+"""
+Run metrics
+
+Counters and duration histograms per service: how long each phase of the
+pipeline takes (catalog, mediainfo, subtitles, download, mux), bytes
+transferred, retries, cache hits and finished downloads. Everything is
+recorded in `metrics`, printed as a summary at the end of a run, and can
+be written as JSON and as a Prometheus textfile for node_exporter.
+
+Code that runs on behalf of a service labels its metrics through the
+service bound to the current thread, which Config does for every service,
+so the segment downloader or manifest cache don't need to know which
+service they're working for. With `--profile`, phases are also profiled,
+see utils/profiler.py.
+
+`metrics` covers the whole process, which the daemon shares between jobs.
+Each run of `get` also records its service into a scope of its own, and
+that scope is what the run's summary shows.
+"""
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from rich.console import Console
+from rich.table import Table
+
+from utils.profiler import profiler
+from utils.progress import format_size
+
+log = logging.getLogger()
+
+PREFIX = "freevine"
+PHASES = ("search", "parse", "catalog", "mediainfo", "subtitles", "download", "mux")
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+DESCRIPTIONS = {
+    "phase_seconds": ("histogram", "Duration of pipeline phases"),
+    "bytes": ("counter", "Bytes transferred"),
+    "retries": ("counter", "Retried segments, restarts, titles and proxy requests"),
+    "cache_hits": ("counter", "Cache hits"),
+    "cache_misses": ("counter", "Cache misses"),
+    "downloads": ("counter", "Titles by result"),
+}
+
+
+def service_name(service: object) -> str:
+    return service.__class__.__name__.lower()
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "max")
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "max": self.max,
+            "buckets": dict(zip(map(str, BUCKETS), self.counts)),
+        }
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # (service, Metrics) of every open scope
+        self.scopes = []
+
+    def bind(self, service: str) -> None:
+        """Label metrics recorded on this thread with a service"""
+        self.local.service = service.lower()
+
+    def labels(self, service: str, labels: dict) -> tuple:
+        service = service or getattr(self.local, "service", None) or "unknown"
+        return (("service", service), *sorted(labels.items()))
+
+    def inc(self, name: str, amount: float = 1, service: str = None, **labels) -> None:
+        key = (name, self.labels(service, labels))
+        with self.lock:
+            for recorder in self.recorders(key):
+                recorder.counters[key] = recorder.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, service: str = None, **labels) -> None:
+        key = (name, self.labels(service, labels))
+        with self.lock:
+            for recorder in self.recorders(key):
+                recorder.histograms.setdefault(key, Histogram()).observe(value)
+
+    def recorders(self, key: tuple) -> list:
+        service = key[1][0][1]
+        return [self, *(scope for name, scope in self.scopes if name == service)]
+
+    @contextmanager
+    def scope(self, service: str) -> object:
+        """
+        Metrics of a service recorded from here on, besides the process totals
+
+        Concurrent jobs of the same service still share what they record
+        """
+        entry = (service.lower(), Metrics())
+        with self.lock:
+            self.scopes.append(entry)
+        try:
+            yield entry[1]
+        finally:
+            with self.lock:
+                self.scopes.remove(entry)
+
+    @contextmanager
+    def phase(self, phase: str, service: str = None) -> object:
+        service = self.labels(service, {})[0][1]
+        start = time.perf_counter()
+        try:
+            with profiler.phase(f"{service}.{phase}"):
+                yield
+        finally:
+            self.observe("phase_seconds", time.perf_counter() - start, service, phase=phase)
+
+    def empty(self) -> bool:
+        return not self.counters and not self.histograms
+
+    def snapshot(self) -> dict:
+        """Everything recorded so far, grouped by service"""
+        services = {}
+        with self.lock:
+            for (name, labels), histogram in self.histograms.items():
+                labels = dict(labels)
+                entry = services.setdefault(labels.pop("service"), {"phases": {}, "counters": {}})
+                entry["phases"][labels.get("phase", name)] = histogram.to_dict()
+
+            for (name, labels), value in self.counters.items():
+                labels = dict(labels)
+                entry = services.setdefault(labels.pop("service"), {"phases": {}, "counters": {}})
+                key = ".".join([name, *labels.values()])
+                entry["counters"][key] = value
+
+        return {"started": self.started, "elapsed": time.time() - self.started, "services": services}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=4)
+
+    def to_prometheus(self) -> str:
+        def label_text(labels: tuple, **extra) -> str:
+            pairs = [*labels, *extra.items()]
+            return ",".join(f'{k}="{v}"' for k, v in pairs)
+
+        lines = []
+        with self.lock:
+            for name, (kind, description) in DESCRIPTIONS.items():
+                metric = f"{PREFIX}_{name}" + ("_total" if kind == "counter" else "")
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} {kind}")
+
+                if kind == "counter":
+                    for (key, labels), value in sorted(self.counters.items()):
+                        if key == name:
+                            lines.append(f"{metric}{{{label_text(labels)}}} {value}")
+                    continue
+
+                for (key, labels), histogram in sorted(self.histograms.items()):
+                    if key != name:
+                        continue
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        lines.append(f"{metric}_bucket{{{label_text(labels, le=bound)}}} {count}")
+                    lines.append(
+                        f"{metric}_bucket{{{label_text(labels, le='+Inf')}}} {histogram.count}"
+                    )
+                    lines.append(f"{metric}_sum{{{label_text(labels)}}} {histogram.sum}")
+                    lines.append(f"{metric}_count{{{label_text(labels)}}} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, content: str) -> None:
+        # node_exporter may read the file at any moment, so it's replaced atomically
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.tmp")
+        tmp.write_text(content)
+        os.replace(tmp, path)
+
+    def summary(self, console: Console) -> None:
+        snapshot = self.snapshot()["services"]
+
+        phases = Table(title="Phases", title_justify="left")
+        for column in ("Service", "Phase", "Count", "Total", "Mean", "Max"):
+            phases.add_column(column, justify="left" if column in ("Service", "Phase") else "right")
+        for service, data in snapshot.items():
+            for phase in sorted(data["phases"], key=lambda x: PHASES.index(x) if x in PHASES else 99):
+                x = data["phases"][phase]
+                phases.add_row(
+                    service,
+                    phase,
+                    str(x["count"]),
+                    f"{x['sum']:.2f}s",
+                    f"{x['mean']:.2f}s",
+                    f"{x['max']:.2f}s",
+                )
+
+        totals = Table(title="Totals", title_justify="left")
+        for column in ("Service", "Downloaded", "Retries", "Cache hits", "Cache misses", "Done", "Failed"):
+            totals.add_column(column, justify="left" if column == "Service" else "right")
+        for service, data in snapshot.items():
+            counters = data["counters"]
+
+            def total(prefix: str) -> float:
+                return sum(v for k, v in counters.items() if k.split(".")[0] == prefix)
+
+            totals.add_row(
+                service,
+                format_size(total("bytes")),
+                str(int(total("retries"))),
+                str(int(total("cache_hits"))),
+                str(int(total("cache_misses"))),
+                str(int(counters.get("downloads.done", 0))),
+                str(int(counters.get("downloads.failed", 0))),
+            )
+
+        if phases.row_count:
+            console.print(phases)
+        console.print(totals)
+
+
+metrics = Metrics()
+
+
+def timed(phase: str) -> callable:
+    """Decorator for service methods, timing each call as a phase of that service"""
+
+    def decorator(func: callable) -> callable:
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with metrics.phase(phase, service_name(self)):
+                return func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def report(config: dict, console: Console = None, recorded: Metrics = None) -> None:
+    """Print the summary of a run, or of its scope, and write the configured exports"""
+    recorded = recorded or metrics
+    if recorded.empty():
+        return
+
+    recorded.summary(console or Console())
+
+    settings = config.get("metrics") or {}
+    try:
+        if settings.get("json"):
+            metrics.write(settings["json"], metrics.to_json())
+        if settings.get("prometheus"):
+            metrics.write(settings["prometheus"], metrics.to_prometheus())
+    except OSError as e:
+        log.warning(f"Couldn't write metrics: {e}")
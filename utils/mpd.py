@@ -0,0 +1,559 @@
+"""
+Streaming DASH manifest parser
+
+Manifests are fed through an lxml pull parser and reduced to a compact
+model of periods, adaptation sets, representations and content protection
+as they're read. Finished elements are dropped straight away, so even large
+multi-period manifests never sit in memory as a full document tree.
+"""
+from __future__ import annotations
+
+import math
+import re
+from urllib.parse import urljoin
+from xml.sax.saxutils import escape, quoteattr
+
+from lxml import etree
+
+from utils.manifests import manifest_cache
+
+WIDEVINE = "urn:uuid:edef8ba9-79d6-4ace-a3c8-27dcd51d21ed"
+# Subtitle codecs carried in fragmented MP4
+TEXT_CODECS = ("stpp", "wvtt")
+
+ELEMENTS = (
+    "MPD",
+    "Period",
+    "AdaptationSet",
+    "Representation",
+    "ContentProtection",
+    "SegmentTemplate",
+    "SegmentTimeline",
+    "S",
+    "BaseURL",
+)
+# Only these reach Python, everything else stays inside libxml2. Elements are
+# matched by local name in any namespace, or none, like BeautifulSoup did
+NAMES = {**{x: x for x in ELEMENTS}, "pssh": "cenc:pssh"}
+TAGS = [f"{{*}}{x}" for x in NAMES]
+
+BASE_URL = re.compile(r"(<(?:[\w.-]+:)?BaseURL\b[^>]*>)(.*?)(</(?:[\w.-]+:)?BaseURL>)", re.S)
+SEGMENT_TEMPLATE = re.compile(r"<(?:[\w.-]+:)?SegmentTemplate\b[^>]*>")
+TEMPLATE_URLS = re.compile(r'\b(media|initialization)="([^"]*)"')
+ADAPTATION_SET = re.compile(r"<(?:[\w.-]+:)?AdaptationSet\b[^>]*>")
+ADAPTATION_SET_END = re.compile(r"</(?:[\w.-]+:)?AdaptationSet>")
+IDENTIFIER = re.compile(r"\$(RepresentationID|Number|Time|Bandwidth)(%0\d+d)?\$|\$\$")
+
+DURATION = re.compile(
+    r"P(?:(?P<days>\d+(?:\.\d+)?)D)?"
+    r"(?:T(?:(?P<hours>\d+(?:\.\d+)?)H)?"
+    r"(?:(?P<minutes>\d+(?:\.\d+)?)M)?"
+    r"(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?"
+)
+
+
+def parse_duration(value: str) -> float:
+    """Convert an ISO 8601 duration such as PT1H2M3.5S to seconds"""
+    if not value:
+        return None
+
+    match = DURATION.fullmatch(value.strip())
+    if match is None:
+        return None
+
+    parts = {k: float(v) for k, v in match.groupdict().items() if v}
+    return (
+        parts.get("days", 0) * 86400
+        + parts.get("hours", 0) * 3600
+        + parts.get("minutes", 0) * 60
+        + parts.get("seconds", 0)
+    )
+
+
+def local(tag: str) -> str:
+    return tag.rpartition("}")[2]
+
+
+def attribute(attrib: dict, name: str) -> str:
+    """Attribute by local name, whichever namespace prefix it was written with"""
+    for key, value in attrib.items():
+        if local(key) == name:
+            return value
+    return None
+
+
+def to_int(value: str) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ContentProtection:
+    __slots__ = ("scheme", "value", "default_kid", "pssh")
+
+    def __init__(self, scheme: str, value: str = None, default_kid: str = None):
+        self.scheme = scheme.lower() if scheme else None
+        self.value = value
+        self.default_kid = default_kid
+        self.pssh = None
+
+    def __repr__(self) -> str:
+        return f"ContentProtection({self.scheme!r}, kid={self.default_kid!r})"
+
+
+class SegmentTemplate:
+    __slots__ = (
+        "media",
+        "initialization",
+        "start_number",
+        "timescale",
+        "duration",
+        "timeline",
+    )
+
+    def __init__(self, attrib: dict, parent: SegmentTemplate = None) -> None:
+        # Attributes missing on the template are inherited from the one
+        # at the level above, as DASH requires
+        self.media = attrib.get("media") or (parent.media if parent else None)
+        self.initialization = attrib.get("initialization") or (
+            parent.initialization if parent else None
+        )
+        # A startNumber of 0 is as valid as any other, only missing ones are inherited
+        self.start_number = self.inherit(attrib, "startNumber", parent, "start_number", 1)
+        self.timescale = self.inherit(attrib, "timescale", parent, "timescale", 1)
+        self.duration = self.inherit(attrib, "duration", parent, "duration", None)
+        # (t, d, r) entries exactly as listed in the SegmentTimeline, or
+        # those of the parent once the template turns out to have none
+        self.timeline = []
+
+    @staticmethod
+    def inherit(
+        attrib: dict, name: str, parent: SegmentTemplate, slot: str, default: int
+    ) -> int:
+        value = to_int(attrib.get(name))
+        if value is not None:
+            return value
+        return getattr(parent, slot) if parent is not None else default
+
+
+class Representation:
+    __slots__ = (
+        "id",
+        "bandwidth",
+        "width",
+        "height",
+        "codecs",
+        "mime_type",
+        "content_type",
+        "lang",
+        "base_url",
+        "parent_url",
+        "template",
+        "protection",
+    )
+
+    def __init__(self, attrib: dict, parent: AdaptationSet) -> None:
+        # Attributes missing on the representation are inherited
+        # from the enclosing adaptation set
+        self.id = attrib.get("id")
+        self.bandwidth = to_int(attrib.get("bandwidth"))
+        self.width = to_int(attrib.get("width")) or parent.width
+        self.height = to_int(attrib.get("height")) or parent.height
+        self.codecs = attrib.get("codecs") or parent.codecs
+        self.mime_type = attrib.get("mimeType") or parent.mime_type
+        self.content_type = parent.content_type
+        self.lang = parent.lang
+        self.base_url = None
+        # Resolved BaseURL of the enclosing MPD, period and adaptation set
+        self.parent_url = None
+        self.template = parent.template
+        self.protection = parent.protection
+
+    @property
+    def url(self) -> str:
+        """Resolved BaseURL of the representation"""
+        return urljoin(self.parent_url or "", self.base_url or "")
+
+    @property
+    def kind(self) -> str:
+        if self.content_type:
+            return self.content_type
+        if self.mime_type:
+            kind, _, subtype = self.mime_type.partition("/")
+            # Subtitles aren't always text/*, TTML is often application/ttml+xml or stpp
+            if subtype == "ttml+xml" or (self.codecs or "").startswith(TEXT_CODECS):
+                return "text"
+            return kind
+        return "video" if self.height else None
+
+    def __repr__(self) -> str:
+        return f"Representation({self.id!r}, {self.kind}, {self.height}, {self.codecs!r})"
+
+
+class AdaptationSet:
+    __slots__ = (
+        "id",
+        "content_type",
+        "mime_type",
+        "lang",
+        "codecs",
+        "width",
+        "height",
+        "base_url",
+        "template",
+        "protection",
+        "representations",
+    )
+
+    def __init__(self, attrib: dict, parent: Period) -> None:
+        self.id = attrib.get("id")
+        self.content_type = attrib.get("contentType")
+        self.mime_type = attrib.get("mimeType")
+        self.lang = attrib.get("lang")
+        self.codecs = attrib.get("codecs")
+        self.width = to_int(attrib.get("width"))
+        self.height = to_int(attrib.get("height"))
+        self.base_url = None
+        self.template = parent.template
+        self.protection = []
+        self.representations = []
+
+
+class Period:
+    __slots__ = ("id", "start", "duration", "base_url", "template", "adaptation_sets")
+
+    def __init__(self, attrib: dict) -> None:
+        self.id = attrib.get("id")
+        self.start = parse_duration(attrib.get("start"))
+        self.duration = parse_duration(attrib.get("duration"))
+        self.base_url = None
+        self.template = None
+        self.adaptation_sets = []
+
+
+class MPD:
+    __slots__ = ("url", "type", "duration", "base_url", "base_urls", "periods")
+
+    def __init__(self, url: str = None) -> None:
+        self.url = url
+        self.type = None
+        self.duration = None
+        self.base_url = None
+        # Every BaseURL in document order, at any level
+        self.base_urls = []
+        self.periods = []
+
+    @property
+    def adaptation_sets(self) -> list:
+        return [x for period in self.periods for x in period.adaptation_sets]
+
+    @property
+    def representations(self) -> list:
+        return [r for x in self.adaptation_sets for r in x.representations]
+
+    @property
+    def videos(self) -> list:
+        return [r for r in self.representations if r.kind == "video"]
+
+    @property
+    def heights(self) -> list:
+        return sorted({r.height for r in self.videos if r.height}, reverse=True)
+
+    @property
+    def codecs(self) -> list:
+        return [r.codecs for r in self.representations if r.codecs]
+
+    @property
+    def protection(self) -> list:
+        seen = {}
+        for x in self.adaptation_sets:
+            for p in x.protection:
+                seen.setdefault(id(p), p)
+            for r in x.representations:
+                for p in r.protection:
+                    seen.setdefault(id(p), p)
+        return list(seen.values())
+
+    @property
+    def default_kid(self) -> str:
+        return next(
+            (p.default_kid for p in self.protection if p.default_kid), None
+        )
+
+    @property
+    def kids(self) -> set:
+        return {p.default_kid for p in self.protection if p.default_kid}
+
+    def pssh(self, system: str = WIDEVINE) -> str:
+        return next(
+            (p.pssh for p in self.protection if p.scheme == system and p.pssh), None
+        )
+
+    def __repr__(self) -> str:
+        return f"MPD({len(self.periods)} period(s), {len(self.representations)} representation(s))"
+
+
+class MPDParser:
+    """Incremental parser, feed it chunks of the manifest and close it for the model"""
+
+    def __init__(self, url: str = None) -> None:
+        self.mpd = MPD(url)
+        self.parser = etree.XMLPullParser(
+            events=("start", "end"),
+            tag=TAGS,
+            resolve_entities=False,
+            no_network=True,
+        )
+        self.period = None
+        self.adaptation = None
+        self.representation = None
+        self.template = None
+        # Template the current one inherits from
+        self.inherited = None
+        self.content_protection = None
+
+    def feed(self, data: bytes) -> None:
+        self.parser.feed(data)
+        self.handle_events()
+
+    def close(self) -> MPD:
+        self.parser.close()
+        self.handle_events()
+        return self.mpd
+
+    def handle_events(self) -> None:
+        for event, elem in self.parser.read_events():
+            name = NAMES[local(elem.tag)]
+            if event == "start":
+                self.start(name, elem.attrib)
+            else:
+                self.end(name, elem)
+
+    def start(self, name: str, attrib: dict) -> None:
+        if name == "MPD":
+            self.mpd.type = attrib.get("type")
+            self.mpd.duration = parse_duration(
+                attrib.get("mediaPresentationDuration")
+            )
+
+        elif name == "Period":
+            self.period = Period(attrib)
+            self.mpd.periods.append(self.period)
+
+        elif name == "AdaptationSet":
+            if self.period is None:
+                self.period = self.default_period()
+            self.adaptation = AdaptationSet(attrib, self.period)
+            self.period.adaptation_sets.append(self.adaptation)
+
+        elif name == "Representation" and self.adaptation is not None:
+            self.representation = Representation(attrib, self.adaptation)
+            self.representation.parent_url = resolve_urls(
+                self.mpd.url, self.mpd.base_url, self.period.base_url, self.adaptation.base_url
+            )
+            self.adaptation.representations.append(self.representation)
+
+        elif name == "ContentProtection":
+            self.content_protection = ContentProtection(
+                attrib.get("schemeIdUri"),
+                attrib.get("value"),
+                attribute(attrib, "default_KID"),
+            )
+            if self.representation is not None:
+                # Keep the inherited list intact for sibling representations
+                if self.representation.protection is self.adaptation.protection:
+                    self.representation.protection = list(self.adaptation.protection)
+                self.representation.protection.append(self.content_protection)
+            elif self.adaptation is not None:
+                self.adaptation.protection.append(self.content_protection)
+
+        elif name == "SegmentTemplate":
+            owner = self.representation or self.adaptation or self.period
+            self.inherited = owner.template if owner is not None else None
+            self.template = SegmentTemplate(attrib, self.inherited)
+            if owner is not None:
+                owner.template = self.template
+
+        elif name == "S" and self.template is not None:
+            self.template.timeline.append(
+                (to_int(attrib.get("t")), to_int(attrib.get("d")), to_int(attrib.get("r")) or 0)
+            )
+
+    def end(self, name: str, elem: etree._Element) -> None:
+        if name == "BaseURL":
+            text = (elem.text or "").strip()
+            self.mpd.base_urls.append(text)
+            owner = self.representation or self.adaptation or self.period or self.mpd
+            if owner.base_url is None:
+                owner.base_url = text
+
+        elif name == "cenc:pssh" and self.content_protection is not None:
+            self.content_protection.pssh = (elem.text or "").strip()
+
+        elif name == "ContentProtection":
+            self.content_protection = None
+
+        elif name == "SegmentTemplate":
+            if not self.template.timeline and self.inherited is not None:
+                self.template.timeline = self.inherited.timeline
+            self.template = self.inherited = None
+
+        elif name == "Representation":
+            self.representation = None
+            self.release(elem)
+
+        elif name == "AdaptationSet":
+            self.adaptation = None
+            self.release(elem)
+
+        elif name == "Period":
+            self.period = None
+            self.release(elem)
+
+        elif name == "SegmentTimeline":
+            self.release(elem)
+
+    def default_period(self) -> Period:
+        # Some packagers leave out the Period wrapper for single period VODs
+        period = Period({})
+        self.mpd.periods.append(period)
+        return period
+
+    @staticmethod
+    def release(elem: etree._Element) -> None:
+        """Drop a finished element and anything before it from the partial tree"""
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def resolve_urls(*urls: str) -> str:
+    resolved = ""
+    for url in urls:
+        if url:
+            resolved = urljoin(resolved, url)
+    return resolved
+
+
+def fill_template(template: str, **values) -> str:
+    """Substitute $Identifier$ and $Identifier%0Nd$ in a SegmentTemplate URL"""
+
+    def replace(match: re.Match) -> str:
+        if match.group(0) == "$$":
+            return "$"
+        value = values[match.group(1)]
+        return match.group(2) % value if match.group(2) else str(value)
+
+    return IDENTIFIER.sub(replace, template)
+
+
+def template_segments(rep: Representation, duration: float = None) -> list:
+    """
+    Segment URLs of a representation, initialization first
+
+    `duration` is the length of the period in seconds, and is only needed
+    for templates without a SegmentTimeline
+    """
+    template = rep.template
+    values = {"RepresentationID": rep.id, "Bandwidth": rep.bandwidth}
+    base = rep.url
+
+    segments = []
+    if template.initialization:
+        segments.append(urljoin(base, fill_template(template.initialization, **values)))
+
+    number = template.start_number
+    if template.timeline:
+        time = 0
+        for t, d, r in template.timeline:
+            time = t if t is not None else time
+            # A negative repeat count isn't used by VOD packagers, treat it as none
+            for _ in range(max(r, 0) + 1):
+                segments.append(
+                    urljoin(base, fill_template(template.media, Number=number, Time=time, **values))
+                )
+                number += 1
+                time += d
+    elif template.duration and duration:
+        count = math.ceil(duration * template.timescale / template.duration)
+        for i in range(count):
+            segments.append(
+                urljoin(
+                    base,
+                    fill_template(
+                        template.media,
+                        Number=number + i,
+                        Time=i * template.duration,
+                        **values,
+                    ),
+                )
+            )
+    else:
+        raise ValueError("SegmentTemplate without a timeline or duration")
+
+    return segments
+
+
+def parse_mpd(data: object, url: str = None) -> MPD:
+    """Parse a manifest from bytes, text or an iterable of byte chunks"""
+    parser = MPDParser(url)
+
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    if isinstance(data, bytes):
+        data = (data,)
+
+    for chunk in data:
+        parser.feed(chunk)
+
+    return parser.close()
+
+
+def load_mpd(client: object, url: str, **kwargs) -> MPD:
+    """Parse a manifest, requested with the given client unless it's cached"""
+    return manifest_cache.parse(client, url, parse_mpd, **kwargs)
+
+
+# Manifest rewrites work on the raw text in a single pass, so the
+# manifest is never built into a document tree just to change a few nodes
+
+
+def replace_base_url(text: str, base_url: str) -> str:
+    """Replace the first BaseURL"""
+    return BASE_URL.sub(
+        lambda m: f"{m.group(1)}{escape(base_url)}{m.group(3)}", text, count=1
+    )
+
+
+def append_template_params(text: str, params: str) -> str:
+    """Append query parameters to the media and initialization URLs of every SegmentTemplate"""
+    return SEGMENT_TEMPLATE.sub(
+        lambda m: TEMPLATE_URLS.sub(
+            lambda x: f'{x.group(1)}="{x.group(2)}{escape(params)}"', m.group(0)
+        ),
+        text,
+    )
+
+
+def element(tag: str, attributes: dict, text: str = None, children: list = None) -> str:
+    """Serialize a single element, with either text or already serialized children"""
+    attrs = "".join(f" {k}={quoteattr(str(v))}" for k, v in attributes.items())
+    if text is None and not children:
+        return f"<{tag}{attrs}/>"
+    inner = escape(text) if text is not None else "".join(children)
+    return f"<{tag}{attrs}>{inner}</{tag}>"
+
+
+def add_representation(text: str, content_type: str, attributes: dict) -> str:
+    """Add a Representation to the first AdaptationSet of the given content type"""
+    for match in ADAPTATION_SET.finditer(text):
+        tag = match.group(0)
+        if f'contentType="{content_type}"' not in tag and f"contentType='{content_type}'" not in tag:
+            continue
+        end = ADAPTATION_SET_END.search(text, match.end())
+        if end is None:
+            break
+        return text[: end.start()] + element("Representation", attributes) + text[end.start() :]
+
+    return text
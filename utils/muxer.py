@@ -0,0 +1,183 @@
+"""
+Muxing of separately downloaded tracks
+
+Used when the download itself doesn't mux, either because it didn't go
+through N_m3u8DL-RE or because muxing runs in the background. Follows the
+same format and muxer settings so the output is the same either way.
+
+With background muxing, finished downloads are handed to `mux_pool`, a
+small pool of mkvmerge/ffmpeg workers bounded by CPU, so the next download
+can start while the previous one is still being muxed.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import shutil
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from utils.metrics import metrics
+from utils.storage import partial_path
+from utils.utilities import get_binary
+
+log = logging.getLogger()
+
+VIDEO_SUFFIXES = (".mp4", ".m4v", ".ts", ".mkv", ".webm")
+AUDIO_SUFFIXES = (".m4a", ".aac", ".ac3", ".eac3", ".ec3", ".mp3", ".opus", ".mka")
+SUBTITLE_SUFFIXES = (".srt", ".vtt", ".ass", ".ssa", ".ttml")
+
+
+def mkvmerge_command(binary: Path, inputs: list, output: Path, subtitles: list) -> list:
+    command = [binary, "--quiet", "--output", output, *inputs]
+    for path, name in subtitles:
+        command.extend(["--track-name", f"0:{name}", path])
+    return command
+
+
+def ffmpeg_command(binary: Path, inputs: list, output: Path, subtitles: list) -> list:
+    command = [binary, "-hide_banner", "-loglevel", "error", "-y"]
+    sources = [*inputs, *(path for path, _ in subtitles)]
+    for source in sources:
+        command.extend(["-i", source])
+    for index in range(len(sources)):
+        command.extend(["-map", str(index)])
+
+    command.extend(["-c", "copy"])
+    if subtitles:
+        command.extend(["-c:s", "mov_text" if output.suffix == ".mp4" else "srt"])
+        for index, (_, name) in enumerate(subtitles):
+            command.extend([f"-metadata:s:s:{index}", f"title={name}"])
+
+    command.append(output)
+    return command
+
+
+def mux_command(muxer: str, inputs: list, output: Path, subtitles: list = ()) -> list:
+    """Command that muxes the input tracks and (path, name) subtitles into output"""
+    name = "ffmpeg" if muxer == "ffmpeg" else "mkvmerge"
+    binary = get_binary(name)
+    if not binary:
+        raise ValueError(f"Path to {name} was not found")
+
+    build = ffmpeg_command if name == "ffmpeg" else mkvmerge_command
+    return build(binary, inputs, output, list(subtitles))
+
+
+def mux(muxer: str, inputs: list, output: Path, subtitles: list = ()) -> None:
+    # Written under a hidden name and renamed once complete
+    partial = partial_path(output)
+    command = mux_command(muxer, inputs, partial, subtitles)
+    log.debug(f"Muxing with: {' '.join(str(x) for x in command)}")
+
+    result = subprocess.run(command)
+    # mkvmerge exits with 1 on warnings, which still leaves a usable file
+    if result.returncode > (1 if muxer != "ffmpeg" else 0):
+        partial.unlink(missing_ok=True)
+        raise ValueError(f"{muxer} exited with code {result.returncode}")
+
+    os.replace(partial, output)
+
+
+def staged_tracks(directory: Path) -> tuple:
+    """Video and audio tracks, and subtitles, left in a folder by a download without muxing"""
+    files = sorted(x for x in directory.iterdir() if x.is_file())
+    tracks = [x for x in files if x.suffix in VIDEO_SUFFIXES]
+    tracks += [x for x in files if x.suffix in AUDIO_SUFFIXES]
+    subtitles = [x for x in files if x.suffix in SUBTITLE_SUFFIXES]
+    return tracks, subtitles
+
+
+def default_workers() -> int:
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+class MuxPool:
+    def __init__(self) -> None:
+        self.executor = None
+        self.workers = None
+        self.lock = threading.Lock()
+
+    def configure(self, workers: int) -> None:
+        """Set the pool size, before the first job is submitted"""
+        with self.lock:
+            if self.executor is None:
+                self.workers = workers
+
+    def start(self) -> None:
+        with self.lock:
+            if self.executor is None:
+                self.workers = self.workers or default_workers()
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="mux"
+                )
+
+    def job(
+        self,
+        muxer: str,
+        inputs: list,
+        output: Path,
+        subtitles: list,
+        cleanup: list,
+        source: str,
+        callback: callable,
+    ) -> Path:
+        try:
+            with metrics.phase("mux", source):
+                mux(muxer, inputs, output, subtitles)
+        except Exception as e:
+            if callback is not None:
+                callback(e)
+            raise
+
+        for path in cleanup:
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+
+        log.info(f"Muxed {output.name}")
+        if callback is not None:
+            callback(None)
+        return output
+
+    def submit(
+        self,
+        muxer: str,
+        inputs: list,
+        output: Path,
+        subtitles: list = (),
+        cleanup: list = (),
+        source: str = None,
+        callback: callable = None,
+    ) -> Future:
+        """
+        Mux in the background
+
+        The `cleanup` paths are removed once it succeeds, and `callback` is
+        called with the error, or None, before the future completes. `source`
+        is the service the job is recorded under in metrics
+        """
+        self.start()
+        return self.executor.submit(
+            self.job,
+            muxer,
+            list(inputs),
+            output,
+            list(subtitles),
+            list(cleanup),
+            source,
+            callback,
+        )
+
+    def wait(self, futures: list) -> None:
+        """Block until the given jobs have finished"""
+        pending = [x for x in futures if not x.done()]
+        if pending:
+            log.info(f"Waiting for {len(pending)} mux job(s) to finish...")
+        wait(pending)
+
+
+mux_pool = MuxPool()
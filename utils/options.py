@@ -2,11 +2,21 @@ from __future__ import annotations
 
 import logging
 import sys
-
+import time
+from functools import partial
+
+from utils.journal import Journal
+from utils.metrics import metrics
+from utils.muxer import mux_pool
+from utils.planner import download_planned, planned_downloads, write_plan
+from utils.server import manifest_server
+from utils.subtitles import subtitle_batch
 from utils.utilities import (
+    in_cache,
     is_title_match,
     is_url,
     set_range,
+    update_cache,
 )
 
 
@@ -142,6 +152,26 @@ class Options:
 
 
 def get_downloads(stream: object) -> tuple:
+    stream.journal = Journal(stream)
+
+    if stream.from_plan:
+        planned, title = planned_downloads(stream)
+
+    if stream.resume:
+        downloads, title = stream.journal.resume()
+        if downloads is not None:
+            stream.log.info(f"Resuming {len(downloads)} unfinished download(s) from journal")
+            stream.resume_session(downloads)
+            return downloads, title
+
+        stream.log.warning("No journal found for this selection, starting a new batch")
+
+    if stream.from_plan:
+        stream.log.info(f"Downloading {len(planned)} title(s) from {stream.from_plan}")
+        stream.resume_session(planned)
+        stream.journal.plan(planned, title)
+        return planned, title
+
     if stream.url and not any(
         [stream.episode, stream.season, stream.complete, stream.movie, stream.titles]
     ):
@@ -150,32 +180,139 @@ def get_downloads(stream: object) -> tuple:
         )
         sys.exit(1)
 
-    if (
-        hasattr(stream, "episode_re")
-        and is_url(stream.episode)
-        and is_title_match(stream.episode, stream.episode_re)
-    ):
-        downloads, title = stream.get_episode_from_url(stream.episode)
-    elif is_url(stream.episode):
-        downloads, title = stream.get_episode_from_url(stream.episode)
-    else:
-        options = Options(stream)
-        content, title = stream.get_content(stream.url)
-
-        if stream.episode:
-            downloads = options.get_episode(content)
-        if stream.season:
-            downloads = options.get_season(content)
-        if stream.complete:
-            downloads = options.get_complete(content)
-        if stream.movie:
-            downloads = options.get_movie(content)
-        if stream.titles:
-            options.list_titles(content)
+    with metrics.phase("catalog"):
+        if (
+            hasattr(stream, "episode_re")
+            and is_url(stream.episode)
+            and is_title_match(stream.episode, stream.episode_re)
+        ):
+            downloads, title = stream.get_episode_from_url(stream.episode)
+        elif is_url(stream.episode):
+            downloads, title = stream.get_episode_from_url(stream.episode)
+        else:
+            options = Options(stream)
+            content, title = stream.get_content(stream.url)
+
+            if stream.episode:
+                downloads = options.get_episode(content)
+            if stream.season:
+                downloads = options.get_season(content)
+            if stream.complete:
+                downloads = options.get_complete(content)
+            if stream.movie:
+                downloads = options.get_movie(content)
+            if stream.titles:
+                options.list_titles(content)
 
     if not downloads:
         stream.log.error(
             "Requested data returned empty. See 'get --help' for more information"
         )
 
+    stream.journal.plan(downloads, title)
+
     return downloads, title
+
+
+def finish_mux(stream: object, download: object, error: Exception) -> None:
+    with stream.journal.lock:
+        if error is not None:
+            error = f"{error.__class__.__name__}: {error}"
+            stream.log.error(f"{str(download)} failed to mux: {error}")
+            stream.journal.update(download, "failed", error)
+            stream.mux_failures.append(download)
+            return
+
+        update_cache(stream.cache, stream.config, download)
+        stream.journal.update(download, "done")
+
+
+def run_download(stream: object, download: object, title: str, *args) -> bool:
+    stream.pending_mux = None
+    try:
+        stream.journal.update(download, "downloading")
+        item = stream.planned.get(str(download.id))
+        if item is not None:
+            download_planned(stream, download, item)
+        else:
+            stream.download(download, title, *args)
+    except (Exception, SystemExit) as e:
+        if isinstance(e, SystemExit) and not e.code:
+            raise
+
+        error = f"{e.__class__.__name__}: {e}"
+        stream.log.error(f"{str(download)} failed: {error}")
+        stream.journal.update(download, "failed", error)
+        return False
+    finally:
+        manifest_server.release(getattr(stream, "manifest", None))
+
+    # With --background-mux the title is only done once the mux pool is
+    if stream.pending_mux is not None:
+        stream.journal.update(download, "muxing")
+        stream.mux_jobs.append(
+            stream.pending_mux(callback=partial(finish_mux, stream, download))
+        )
+        return True
+
+    stream.journal.update(download, "done")
+    return True
+
+
+def batch_download(stream: object, downloads: list, title: str, *args) -> None:
+    """
+    Download each title in order
+
+    Failed titles are put in a retry queue and attempted once more after the
+    rest of the batch, instead of aborting it. Anything still failing is kept
+    in the journal for a later --resume. With --plan the titles are only
+    resolved and written to a plan, see utils/planner.py
+    """
+    if stream.plan:
+        return write_plan(stream, downloads, title, *args)
+    if stream.sub_only and hasattr(stream, "get_subtitles"):
+        return subtitle_batch(stream, downloads, title)
+
+    retries = []
+    attempted = 0
+    stream.mux_jobs = []
+    stream.mux_failures = []
+
+    for download in downloads:
+        if not stream.no_cache and in_cache(stream.cache, download):
+            metrics.inc("cache_hits", cache="download")
+            metrics.inc("downloads", result="skipped")
+            stream.journal.update(download, "done")
+            continue
+
+        metrics.inc("cache_misses", cache="download")
+        attempted += 1
+
+        if stream.slowdown:
+            with stream.console.status(
+                f"Slowing things down for {stream.slowdown} seconds..."
+            ):
+                time.sleep(stream.slowdown)
+
+        if not run_download(stream, download, title, *args):
+            retries.append(download)
+
+    if retries:
+        stream.log.info(f"Retrying {len(retries)} failed download(s)...")
+        metrics.inc("retries", len(retries), kind="title")
+
+    failed = [x for x in retries if not run_download(stream, x, title, *args)]
+
+    mux_pool.wait(stream.mux_jobs)
+    failed.extend(stream.mux_failures)
+
+    metrics.inc("downloads", attempted - len(failed), result="done")
+    metrics.inc("downloads", len(failed), result="failed")
+
+    if failed:
+        for download in failed:
+            stream.log.error(f"Failed: {str(download)}")
+        stream.log.error(
+            f"{len(failed)} download(s) failed. Use --resume to continue the batch"
+        )
+        sys.exit(1)
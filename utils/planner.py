@@ -0,0 +1,299 @@
+"""
+Dry-run planner
+
+`get --plan FILE` resolves every selected title the way a download would:
+manifest, quality, audio, keys, subtitles and output path. Titles are
+resolved concurrently on copies of the service and no process is started.
+The result is written as a JSON plan with estimated sizes, which
+`get --from-plan FILE` downloads from without fetching the catalog or
+resolving any title again.
+"""
+from __future__ import annotations
+
+import copy
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlparse
+
+import requests
+
+from utils.args import dir_settings, format_settings, get_args
+from utils.downloader import manifest_data, run_downloader
+from utils.hls import parse_master
+from utils.journal import dump_title, load_title
+from utils.manifests import token_expiry
+from utils.metrics import metrics
+from utils.mpd import parse_mpd
+from utils.progress import format_size
+from utils.server import manifest_server
+from utils.storage import closest, estimate_size
+from utils.subtitles import fetch_subtitles
+from utils.utilities import update_cache
+
+log = logging.getLogger()
+
+VERSION = 1
+WORKERS = 8
+SELECTION = ("episode", "season", "complete", "movie")
+
+
+def load_plan(path: str) -> dict:
+    try:
+        with open(path, "r") as f:
+            plan = json.load(f)
+    except (OSError, ValueError) as e:
+        log.error(f"Plan could not be read: {e}")
+        sys.exit(1)
+
+    if plan.get("version") != VERSION:
+        log.error(f"{path} was written by another version of freevine, plan again")
+        sys.exit(1)
+
+    return plan
+
+
+def tracks(service: object) -> dict:
+    """Video and audio the downloader will pick from the manifest"""
+    url = str(service.manifest)
+    data = manifest_data(service, url)
+
+    if data.lstrip().startswith(b"#EXTM3U"):
+        master = parse_master(data, url)
+        variant = master.best(service.res)
+        if variant is None:
+            return {"video": None, "audio": None}
+
+        renditions = [
+            x for x in master.media if x.type == "AUDIO" and x.group_id == variant.audio
+        ]
+        audio = next((x for x in renditions if x.default), next(iter(renditions), None))
+        return {
+            "video": {
+                "height": variant.height,
+                "codecs": variant.codecs,
+                "bandwidth": variant.bandwidth,
+            },
+            "audio": {
+                "language": audio.language,
+                "name": audio.name,
+                "channels": audio.channels,
+            }
+            if audio is not None
+            else None,
+        }
+
+    mpd = parse_mpd(data, getattr(service, "base_url", None) or url)
+    videos = mpd.videos
+    audios = [x for x in mpd.representations if x.kind == "audio"]
+
+    video = audio = None
+    if videos:
+        height = closest({x.height or 0 for x in videos}, service.res)
+        video = max(
+            (x for x in videos if (x.height or 0) == height), key=lambda x: x.bandwidth or 0
+        )
+    if audios:
+        audio = max(audios, key=lambda x: x.bandwidth or 0)
+
+    return {
+        "video": {"height": video.height, "codecs": video.codecs, "bandwidth": video.bandwidth}
+        if video is not None
+        else None,
+        "audio": {"language": audio.lang, "codecs": audio.codecs, "bandwidth": audio.bandwidth}
+        if audio is not None
+        else None,
+    }
+
+
+def describe(service: object) -> dict:
+    """Everything the download needs, taken from a service that resolved a title"""
+    _, format, _, _ = format_settings(service)
+    _, _, _, file_path = dir_settings(service, format)
+
+    url = str(service.manifest)
+    # Loopback manifests only live as long as this run, so their content is kept
+    served = manifest_server.render(url)
+
+    try:
+        streams = tracks(service)
+    except Exception as e:
+        log.debug(f"Couldn't read tracks from the manifest: {e}")
+        streams = {"video": None, "audio": None}
+
+    return {
+        "manifest": url if served is None else None,
+        "manifest_content": served.decode("utf-8") if served is not None else None,
+        "manifest_name": Path(urlparse(url).path).name,
+        "playlist": hasattr(service, "playlist"),
+        "base_url": getattr(service, "base_url", None),
+        "sub_lang": getattr(service, "sub_lang", None),
+        "quality": service.res,
+        "filename": service.filename,
+        "save_path": str(service.save_path),
+        "output": str(file_path),
+        "exists": file_path.exists(),
+        "keys": Path(service.key_file).read_text().split() if service.key_file else None,
+        "subtitles": service.planned_subtitles,
+        **streams,
+        "size": estimate_size(service),
+    }
+
+
+def clone_session(session: requests.Session) -> requests.Session:
+    """
+    Session with the same state for a copy of the service
+
+    Services set headers, params and cookies on their session per title,
+    like ABC iView's license customdata, so copies that resolve at the
+    same time can't share one. Adapters are shared, their pools are thread-safe
+    """
+    # copy.copy would only keep the attributes requests pickles, not ones like timeout
+    clone = object.__new__(type(session))
+    clone.__dict__.update(session.__dict__)
+    clone.headers = session.headers.copy()
+    clone.params = copy.copy(session.params)
+    clone.cookies = session.cookies.copy()
+    clone.proxies = dict(session.proxies)
+    clone.hooks = {key: list(value) for key, value in session.hooks.items()}
+    clone.adapters = copy.copy(session.adapters)
+    return clone
+
+
+def resolve(stream: object, download: object, title: str, *args) -> dict:
+    """Resolve a title on a copy of the service, stopping short of the download"""
+    metrics.bind(stream.__class__.__name__)
+
+    service = copy.copy(stream)
+    service.client = clone_session(stream.client)
+    service.planning = True
+    service.planned_subtitles = None
+    # Keys and subtitles are written to tmp under fixed names
+    service.tmp = Path(tempfile.mkdtemp(prefix="plan.", dir=stream.tmp))
+    # Files that already exist are marked as done, which mustn't race on the cache file
+    service.config = {**stream.config, "download_cache": service.tmp / "cache.json"}
+    service.cache = dict(stream.cache)
+
+    item = {"state": "planned", "error": None, **dump_title(download)}
+    try:
+        service.download(download, title, *args)
+        item.update(describe(service))
+    except (Exception, SystemExit) as e:
+        item["state"] = "failed"
+        item["error"] = f"{e.__class__.__name__}: {e}"
+        log.error(f"{str(download)} could not be resolved: {item['error']}")
+    finally:
+        manifest_server.release(getattr(service, "manifest", None))
+        shutil.rmtree(service.tmp, ignore_errors=True)
+
+    return item
+
+
+def write_plan(stream: object, downloads: list, title: str, *args) -> None:
+    path = Path(stream.plan)
+    workers = int(stream.config.get("plan_workers") or WORKERS)
+
+    start = time.perf_counter()
+    with stream.console.status(f"Resolving {len(downloads)} title(s)..."):
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="plan") as pool:
+            items = list(pool.map(lambda x: resolve(stream, x, title, *args), downloads))
+
+    planned = [x for x in items if x["state"] == "planned"]
+    size = sum(x["size"] or 0 for x in planned)
+    plan = {
+        "version": VERSION,
+        "service": stream.__class__.__name__,
+        "url": stream.url,
+        "selection": {key: getattr(stream, key) for key in SELECTION},
+        "title": title,
+        "created": time.time(),
+        "size": size,
+        "items": items,
+    }
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with tmp.open("w") as f:
+        json.dump(plan, f, indent=4, default=str)
+    os.replace(tmp, path)
+
+    stream.log.info(
+        f"Planned {len(planned)} of {len(items)} title(s), about {format_size(size)}, "
+        f"in {time.perf_counter() - start:.1f}s: {path}"
+    )
+    if len(planned) < len(items):
+        sys.exit(1)
+
+
+def planned_downloads(stream: object) -> tuple:
+    """Titles of the plan given with --from-plan, which are kept on the stream by id"""
+    plan = load_plan(stream.from_plan)
+
+    downloads = []
+    for item in plan["items"]:
+        download = load_title(item)
+        if item["state"] != "planned":
+            stream.log.warning(f"{str(download)} wasn't resolved in the plan, skipping")
+            continue
+
+        stream.planned[str(download.id)] = item
+        downloads.append(download)
+
+    return downloads, plan["title"]
+
+
+def download_planned(stream: object, download: object, item: dict) -> None:
+    """Download a title the way the plan resolved it, instead of Service.download"""
+    expiry = token_expiry(item["manifest"]) if item["manifest"] else None
+    if expiry is not None and expiry <= time.time():
+        raise ValueError("The manifest URL in the plan has expired, plan again")
+
+    stream.res = item["quality"]
+    stream.filename = item["filename"]
+    stream.save_path = Path(item["save_path"])
+    stream.manifest = item["manifest"] or manifest_server.serve(
+        item["manifest_content"], item["manifest_name"]
+    )
+    if item["playlist"]:
+        stream.playlist = True
+    if item["base_url"]:
+        stream.base_url = item["base_url"]
+    if item["sub_lang"]:
+        stream.sub_lang = item["sub_lang"]
+
+    stream.key_file = None
+    if item["keys"]:
+        stream.key_file = stream.tmp / f"{stream.filename}.keys.txt"
+        stream.key_file.write_text("\n".join(item["keys"]))
+
+    subtitles = item["subtitles"]
+    stream.sub_path = (
+        fetch_subtitles(
+            stream,
+            subtitles["url"],
+            download.id,
+            sub_type=subtitles["type"],
+            # Services that fetch subtitles without their session
+            client=requests if subtitles["plain"] else None,
+        )
+        if subtitles is not None and not stream.skip_download
+        else None
+    )
+
+    stream.log.info(f"{str(download)}")
+
+    args, file_path = get_args(stream)
+
+    if not file_path.exists():
+        run_downloader(stream, args, file_path)
+    else:
+        stream.log.warning(f"{stream.filename} already exists. Skipping download...\n")
+
+    if not stream.skip_download and file_path.exists():
+        update_cache(stream.cache, stream.config, download)
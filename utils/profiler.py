@@ -0,0 +1,222 @@
+"""
+Profiling of pipeline phases
+
+With `--profile`, every phase recorded by `metrics.phase` (catalog,
+mediainfo, subtitles, download, mux, and search and parse for searches) is
+also run under cProfile, and optionally tracemalloc. When the run ends,
+each phase of each service gets its own set of files:
+
+    <service>.<phase>.txt         top functions by own and cumulative time
+    <service>.<phase>.collapsed   collapsed stacks for flamegraph.pl/speedscope
+    <service>.<phase>.prof        raw stats for pstats or snakeviz
+    <service>.<phase>.memory.txt  top allocating lines, with --profile-memory
+
+cProfile follows a single thread, so a phase is only profiled on the thread
+that started profiling. Phases entered by worker threads in the meantime
+are still timed by metrics, but not profiled.
+"""
+from __future__ import annotations
+
+import cProfile
+import io
+import logging
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+from utils.progress import format_size
+
+log = logging.getLogger()
+
+PROFILE_DIR = Path("profiles")
+TOP = 40
+# Frames kept for each allocation traced by tracemalloc
+MEMORY_FRAMES = 10
+# Stacks contributing less than this many microseconds are left out
+MIN_MICROSECONDS = 1
+MAX_DEPTH = 128
+
+
+def frame_label(func: tuple) -> str:
+    filename, line, name = func
+    if filename == "~":
+        return name
+
+    path = Path(filename)
+    try:
+        path = path.resolve().relative_to(Path.cwd())
+    except ValueError:
+        path = Path(*path.parts[-2:])
+    return f"{path.as_posix()}:{name}:{line}"
+
+
+def collapse(stats: pstats.Stats) -> list:
+    """
+    Collapsed stacks, as "frame;frame;frame microseconds" lines
+
+    cProfile only records caller and callee pairs, not whole stacks, so the
+    stacks are rebuilt from the call graph and each edge gets the share of
+    the callee's time that was spent below that caller
+    """
+    functions = stats.stats
+    children = {}
+    for func, (_, _, _, _, callers) in functions.items():
+        for caller, (_, _, _, cumulative) in callers.items():
+            children.setdefault(caller, []).append((func, cumulative))
+
+    folded = {}
+
+    def walk(func: tuple, share: float, stack: tuple) -> None:
+        _, _, own, cumulative, _ = functions[func]
+        stack = (*stack, frame_label(func))
+        fraction = share / cumulative if cumulative else 0
+
+        own_time = int(own * fraction * 1e6)
+        if own_time >= MIN_MICROSECONDS:
+            key = ";".join(stack)
+            folded[key] = folded.get(key, 0) + own_time
+
+        if len(stack) >= MAX_DEPTH:
+            return
+        for child, edge in children.get(func, ()):
+            child_share = edge * fraction
+            if child in functions and child_share * 1e6 >= MIN_MICROSECONDS:
+                # Recursion is folded into the frame that's already on the stack
+                if frame_label(child) not in stack:
+                    walk(child, child_share, stack)
+
+    roots = [x for x, (_, _, _, _, callers) in functions.items() if not callers]
+    for root in roots:
+        walk(root, functions[root][3], ())
+
+    return [f"{stack} {value}" for stack, value in sorted(folded.items())]
+
+
+class PhaseProfile:
+    __slots__ = ("name", "profile", "calls", "allocations", "peak")
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        # A profile keeps adding up over every call of the phase
+        self.profile = cProfile.Profile()
+        self.calls = 0
+        self.allocations = {}
+        self.peak = 0
+
+
+class Profiler:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.memory = False
+        self.directory = None
+        self.top = TOP
+        self.thread = None
+        self.phases = {}
+        # Phases currently running on the profiled thread, innermost last
+        self.stack = []
+        self.lock = threading.Lock()
+
+    def enable(self, directory: Path = None, memory: bool = False, top: int = TOP) -> None:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.directory = Path(directory or PROFILE_DIR / stamp)
+        self.memory = memory
+        self.top = top
+        self.thread = threading.get_ident()
+        self.enabled = True
+
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start(MEMORY_FRAMES)
+
+    @contextmanager
+    def phase(self, name: str) -> object:
+        if not self.enabled or threading.get_ident() != self.thread:
+            yield
+            return
+
+        with self.lock:
+            entry = self.phases.setdefault(name, PhaseProfile(name))
+        entry.calls += 1
+
+        # Only one profile can be active at a time, so the outer phase is
+        # paused while a nested one runs and its time isn't counted twice
+        outer = self.stack[-1] if self.stack else None
+        if outer is not None:
+            outer.profile.disable()
+
+        before = None
+        if self.memory:
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+
+        self.stack.append(entry)
+        entry.profile.enable()
+        try:
+            yield
+        finally:
+            entry.profile.disable()
+            self.stack.pop()
+
+            if before is not None:
+                self.allocated(entry, before)
+            if outer is not None:
+                outer.profile.enable()
+
+    def allocated(self, entry: PhaseProfile, before: tracemalloc.Snapshot) -> None:
+        entry.peak = max(entry.peak, tracemalloc.get_traced_memory()[1])
+        after = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        )
+        for stat in after.compare_to(before, "lineno"):
+            if stat.size_diff > 0:
+                frame = stat.traceback[0]
+                key = f"{frame.filename}:{frame.lineno}"
+                size, count = entry.allocations.get(key, (0, 0))
+                entry.allocations[key] = (size + stat.size_diff, count + stat.count_diff)
+
+    def report(self, entry: PhaseProfile) -> str:
+        stream = io.StringIO()
+        stats = pstats.Stats(entry.profile, stream=stream)
+        stream.write(f"{entry.name}: {entry.calls} call(s)\n\n")
+
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top)
+        return stream.getvalue()
+
+    def memory_report(self, entry: PhaseProfile) -> str:
+        lines = [
+            f"{entry.name}: {entry.calls} call(s), peak {format_size(entry.peak)} traced",
+            "",
+            f"{'Allocated':>12} {'Blocks':>9}  Line",
+        ]
+        top = sorted(entry.allocations.items(), key=lambda x: x[1][0], reverse=True)
+        for key, (size, count) in top[: self.top]:
+            lines.append(f"{format_size(size):>12} {count:>9}  {key}")
+        return "\n".join(lines) + "\n"
+
+    def write(self) -> Path:
+        """Write the profile of every phase, returning the folder they're in"""
+        if not self.enabled or not self.phases:
+            return None
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for name, entry in self.phases.items():
+            try:
+                stats = pstats.Stats(entry.profile)
+            except TypeError:
+                # Nothing was recorded
+                continue
+
+            stats.dump_stats(self.directory / f"{name}.prof")
+            (self.directory / f"{name}.txt").write_text(self.report(entry))
+            (self.directory / f"{name}.collapsed").write_text("\n".join(collapse(stats)) + "\n")
+            if self.memory:
+                (self.directory / f"{name}.memory.txt").write_text(self.memory_report(entry))
+
+        log.info(f"Profiles saved to {self.directory}")
+        return self.directory
+
+
+profiler = Profiler()
@@ -0,0 +1,234 @@
+"""
+Download progress events
+
+Downloaders publish structured progress events to `progress_hub`, which
+hands them to every subscribed sink. Sinks included here are the logger,
+per-job transfer statistics and a live view that shows the progress of all
+running jobs at once. The daemon subscribes its own sink to attach progress
+to jobs.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+
+from rich.console import Console
+from rich.progress import BarColumn, Progress, TaskID, TextColumn
+
+log = logging.getLogger()
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.2f}{unit}"
+        size /= 1024
+    return f"{size:.2f}TB"
+
+
+class ProgressEvent:
+    """
+    Progress of a single track, or a stage change of the whole download
+    when `track` is None. Stages are downloading, merging, decrypting,
+    muxing, stalled, done and failed
+    """
+
+    __slots__ = (
+        "source",
+        "track",
+        "stage",
+        "done",
+        "total",
+        "downloaded",
+        "size",
+        "speed",
+        "eta",
+        "time",
+    )
+
+    def __init__(
+        self,
+        source: str = None,
+        track: str = None,
+        stage: str = "downloading",
+        done: int = None,
+        total: int = None,
+        downloaded: int = None,
+        size: int = None,
+        speed: float = None,
+        eta: str = None,
+    ) -> None:
+        self.source = source
+        self.track = track
+        self.stage = stage
+        self.done = done
+        self.total = total
+        # Bytes, and bytes per second
+        self.downloaded = downloaded
+        self.size = size
+        self.speed = speed
+        self.eta = eta
+        self.time = time.time()
+
+    @property
+    def percent(self) -> float:
+        if self.done is None or not self.total:
+            return None
+        return self.done / self.total * 100
+
+    def to_dict(self) -> dict:
+        return {x: getattr(self, x) for x in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"ProgressEvent({self.source!r}, {self.track!r}, {self.stage}, {self.done}/{self.total})"
+
+
+class ProgressHub:
+    def __init__(self) -> None:
+        self.sinks = []
+        self.lock = threading.Lock()
+
+    def subscribe(self, sink: callable) -> None:
+        with self.lock:
+            if sink not in self.sinks:
+                self.sinks.append(sink)
+
+    def unsubscribe(self, sink: callable) -> None:
+        with self.lock:
+            if sink in self.sinks:
+                self.sinks.remove(sink)
+
+    def publish(self, event: ProgressEvent) -> None:
+        with self.lock:
+            sinks = list(self.sinks)
+        for sink in sinks:
+            try:
+                sink(event)
+            except Exception as e:
+                # A broken sink must never take a download down with it
+                log.debug(f"Progress sink {sink!r} failed: {e}")
+
+
+def log_sink(event: ProgressEvent) -> None:
+    if event.track is None:
+        log.info(f"{event.source}: {event.stage}")
+    else:
+        log.debug(
+            f"{event.source} | {event.track} | {event.done}/{event.total} | "
+            f"{format_size(event.speed or 0)}/s"
+        )
+
+
+class TransferStats:
+    """
+    Bytes, throughput and stalls per source, for metrics
+
+    A source is dropped once its downloader has taken its stats with pop()
+    """
+
+    def __init__(self) -> None:
+        self.sources = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, event: ProgressEvent) -> None:
+        with self.lock:
+            stats = self.sources.setdefault(
+                event.source,
+                {
+                    "started": event.time,
+                    "finished": None,
+                    "stage": None,
+                    "tracks": {},
+                    "peak_speed": 0,
+                    "stalls": 0,
+                },
+            )
+            if event.track is not None and event.downloaded is not None:
+                stats["tracks"][event.track] = event.downloaded
+            if event.speed:
+                stats["peak_speed"] = max(stats["peak_speed"], event.speed)
+            if event.stage == "stalled":
+                stats["stalls"] += 1
+            if event.stage in ("done", "failed"):
+                stats["finished"] = event.time
+            stats["stage"] = event.stage
+
+    @staticmethod
+    def summary(stats: dict) -> dict:
+        return {
+            "stage": stats["stage"],
+            "bytes": sum(stats["tracks"].values()),
+            "peak_speed": stats["peak_speed"],
+            "stalls": stats["stalls"],
+            "elapsed": (stats["finished"] or time.time()) - stats["started"],
+        }
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {source: self.summary(x) for source, x in self.sources.items()}
+
+    def pop(self, source: str) -> dict:
+        """Stats of a source whose transfer has ended, forgetting them"""
+        with self.lock:
+            stats = self.sources.pop(source, None)
+            return self.summary(stats) if stats is not None else {}
+
+
+class LiveView:
+    """Progress bars for every track of every running job"""
+
+    def __init__(self) -> None:
+        self.progress = Progress(
+            TextColumn("{task.fields[source]}", style="bold"),
+            TextColumn("{task.description}"),
+            BarColumn(),
+            TextColumn("{task.completed:.0f}/{task.total:.0f}"),
+            TextColumn("{task.fields[speed]}"),
+            TextColumn("{task.fields[eta]}"),
+            console=Console(),
+        )
+        self.tasks = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, event: ProgressEvent) -> None:
+        with self.lock:
+            if event.track is None:
+                if event.stage in ("done", "failed"):
+                    self.finish(event.source)
+                return
+            self.update(event)
+
+    def update(self, event: ProgressEvent) -> None:
+        key = (event.source, event.track)
+        task = self.tasks.get(key)
+        if task is None:
+            if not self.tasks:
+                self.progress.start()
+            task = self.tasks[key] = self.progress.add_task(
+                event.track, source=event.source, speed="", eta="", total=event.total
+            )
+
+        self.progress.update(
+            task,
+            completed=event.done,
+            total=event.total,
+            speed=f"{format_size(event.speed)}/s" if event.speed else "",
+            eta=event.eta or "",
+        )
+
+    def finish(self, source: str) -> None:
+        for key in [x for x in self.tasks if x[0] == source]:
+            task: TaskID = self.tasks.pop(key)
+            self.progress.remove_task(task)
+        if not self.tasks:
+            self.progress.stop()
+
+
+progress_hub = ProgressHub()
+transfer_stats = TransferStats()
+live_view = LiveView()
+
+progress_hub.subscribe(log_sink)
+progress_hub.subscribe(transfer_stats)
+progress_hub.subscribe(live_view)
@@ -1,16 +1,511 @@
+"""
+Proxy providers
+
+Hola and Windscribe proxy lists are fetched from their executables and
+cached in utils/settings/proxies.json for a while, since the credentials
+that come with them are short-lived. Candidates for a location are health
+checked concurrently and ranked by latency, and the ranking is kept
+between runs so the next run can go straight to the fastest proxy.
+
+The ranked proxies are put behind the session as a pool. Each job sticks
+to one proxy, since some services tie tokens to an IP, and only moves on
+to the next one when it fails. Failing proxies are evicted for a while.
+
+With geo routing, services can keep hosts that don't need it off the
+proxy. They list hosts that always or never need it under `geo` in their
+api.yaml, and can opt in to `default: auto` to try any other host directly
+first. Hosts that turn out to geo-block are remembered in
+utils/settings/geoblocks.json and go through the proxy from then on.
+Without rules, every request goes through the proxy, since many services
+answer from the wrong region with a 200 instead of refusing.
+"""
+from __future__ import annotations
+
+import fnmatch
+import json
 import logging
+import os
 import random
 import re
 import shutil
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
 
+from utils.metrics import metrics
 from utils.utilities import get_binary
 
 log = logging.getLogger()
 
+PROXY_CACHE = Path("utils") / "settings" / "proxies.json"
+LIST_TTL = 3600
+RANK_TTL = 900
+CHECK_URL = "https://www.gstatic.com/generate_204"
+CHECK_TIMEOUT = 5
+CHECK_WORKERS = 16
+
+# Only the proxy refusing the request is its fault, a 403 usually comes from the service
+PROXY_FAILURES = (407,)
+RATE_LIMITED = 429
+MAX_RETRY_AFTER = 60
+# Requests that are safe to send again once they may have reached the service
+IDEMPOTENT = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"))
+MAX_ATTEMPTS = 3
+# Consecutive failures, or error rate over at least EVICT_REQUESTS, before eviction
+EVICT_FAILURES = 3
+EVICT_RATE = 0.5
+EVICT_REQUESTS = 6
+EVICT_TIME = 300
+
+GEO_CACHE = Path("utils") / "settings" / "geoblocks.json"
+GEO_TTL = 30 * 24 * 3600
+GEO_STATUS = (403, 451)
+GEO_MARKERS = re.compile(
+    rb"geo.?(?:block|restrict|locat|fenc)|not available in your (?:country|region|area|location)"
+    rb"|outside (?:of )?(?:the )?(?:uk|us|united|your region)|territor(?:y|ial)",
+    re.IGNORECASE,
+)
+ROUTES = ("proxy", "direct", "auto")
+
+
+def endpoint(proxy: str) -> str:
+    """Host and port of a proxy URL, which stay the same when credentials change"""
+    parsed = urlparse(proxy)
+    return f"{parsed.hostname}:{parsed.port}"
+
+
+def unsent(error: requests.ConnectionError) -> bool:
+    """Whether the connection failed before any of the request was sent"""
+    if isinstance(error, (requests.exceptions.ProxyError, requests.exceptions.ConnectTimeout)):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def retry_after(response: requests.Response, attempt: int) -> float:
+    """Seconds to wait before retrying a rate limited request"""
+    value = response.headers.get("Retry-After")
+    delay = 2.0**attempt
+    if value is not None:
+        try:
+            delay = float(value)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                pass
+    return min(max(delay, 0.0), MAX_RETRY_AFTER)
+
+
+def check_latency(proxy: str, timeout: float = CHECK_TIMEOUT) -> float:
+    """Round trip in seconds of a request through the proxy, or None if it fails"""
+    start = time.monotonic()
+    try:
+        r = requests.head(
+            CHECK_URL, proxies={"http": proxy, "https": proxy}, timeout=timeout
+        )
+    except requests.RequestException:
+        return None
+    if r.status_code >= 400:
+        return None
+    return time.monotonic() - start
+
+
+class ProxyCache:
+    """Proxy lists and latency rankings, kept in memory and on disk"""
+
+    def __init__(self, path: Path = PROXY_CACHE) -> None:
+        self.path = path
+        self.data = None
+        self.lock = threading.RLock()
+
+    def load(self) -> dict:
+        if self.data is None:
+            try:
+                with self.path.open("r") as f:
+                    self.data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self.data = {}
+            self.data.setdefault("lists", {})
+            self.data.setdefault("rankings", {})
+        return self.data
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        # Proxy lists carry credentials
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp, self.path)
+
+    def proxies(self, key: str, fetch: callable, fresh: bool = False) -> list:
+        """Cached proxy list, fetched again once it's older than LIST_TTL or if fresh"""
+        with self.lock:
+            entry = self.load()["lists"].get(key)
+            if entry and not fresh and time.time() - entry["time"] < LIST_TTL:
+                return entry["proxies"]
+
+            proxies = fetch()
+            self.data["lists"][key] = {"time": time.time(), "proxies": proxies}
+            self.save()
+            return proxies
+
+    def ranking(self, key: str) -> list:
+        with self.lock:
+            entry = self.load()["rankings"].get(key)
+            if entry and time.time() - entry["time"] < RANK_TTL:
+                return entry["endpoints"]
+            return []
+
+    def rank(self, key: str, proxies: list) -> list:
+        """Health check all proxies at once and return the working ones, fastest first"""
+        workers = min(CHECK_WORKERS, len(proxies))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            latencies = list(executor.map(check_latency, proxies))
+
+        ranked = sorted(
+            (latency, proxy)
+            for latency, proxy in zip(latencies, proxies)
+            if latency is not None
+        )
+        with self.lock:
+            self.load()["rankings"][key] = {
+                "time": time.time(),
+                "endpoints": [[endpoint(proxy), latency] for latency, proxy in ranked],
+            }
+            self.save()
+
+        log.debug(f"{len(ranked)}/{len(proxies)} proxies passed the health check")
+        return [proxy for _, proxy in ranked]
+
+    def ranked(self, key: str, proxies: list, refetch: callable = None) -> list:
+        """Working proxies fastest first, re-using the last ranking if it's still fresh
+
+        If none of them work, the cached list may have gone stale, so a new one
+        from refetch is ranked once before giving up on the health check.
+        """
+        if not proxies:
+            raise ValueError("No proxies to choose from")
+
+        by_endpoint = {endpoint(proxy): proxy for proxy in proxies}
+        previous = [by_endpoint[x] for x, _ in self.ranking(key) if x in by_endpoint]
+        # Only the previous winner is checked again, the rest wait for a re-rank
+        if previous and check_latency(previous[0]) is not None:
+            return previous
+
+        ranked = self.rank(key, proxies)
+        if not ranked and refetch is not None:
+            log.info("No proxy passed the health check, fetching a new list")
+            proxies = refetch() or proxies
+            ranked = self.rank(key, proxies)
+        if not ranked:
+            log.warning("No proxy passed the health check, trying them in random order")
+            return random.sample(proxies, len(proxies))
+        return ranked
+
+
+proxy_cache = ProxyCache()
+
+
+def geo_blocked(response: requests.Response) -> bool:
+    """Whether a response looks like the service refusing the client's location"""
+    if response.status_code in GEO_STATUS:
+        return True
+    if response.status_code < 400:
+        return False
+    return GEO_MARKERS.search(response.content[:4096]) is not None
+
+
+class GeoCache:
+    """Hosts that turned out to geo-block, shared by all services"""
+
+    def __init__(self, path: Path = GEO_CACHE) -> None:
+        self.path = path
+        self.data = None
+        self.lock = threading.Lock()
+
+    def load(self) -> dict:
+        if self.data is None:
+            try:
+                with self.path.open("r") as f:
+                    self.data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self.data = {}
+        return self.data
+
+    def save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        with tmp.open("w") as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp, self.path)
+
+    def blocked(self, host: str) -> bool:
+        with self.lock:
+            learned = self.load().get(host)
+            return learned is not None and time.time() - learned < GEO_TTL
+
+    def learn(self, host: str) -> None:
+        with self.lock:
+            self.load()[host] = time.time()
+            self.save()
+        log.info(f"+ {host} is geo-blocked, routing it through the proxy")
+
+
+geo_cache = GeoCache()
+
+
+class GeoRouter:
+    """Decides per host whether a service's requests go through the proxy"""
+
+    def __init__(self, rules: dict = None) -> None:
+        rules = rules or {}
+        self.proxy = rules.get("proxy") or []
+        self.direct = rules.get("direct") or []
+        # Direct or auto routing is opt-in, the proxy is what --proxy asks for
+        self.default = rules.get("default") or "proxy"
+        if self.default not in ROUTES:
+            raise ValueError(f"Geo route must be one of {', '.join(ROUTES)}")
+
+    @staticmethod
+    def matches(host: str, patterns: list) -> bool:
+        return any(fnmatch.fnmatch(host, x) for x in patterns)
+
+    def route(self, host: str) -> str:
+        """proxy, direct, or auto to try directly and fall back on the proxy if blocked"""
+        if self.matches(host, self.proxy):
+            return "proxy"
+        if self.matches(host, self.direct):
+            return "direct"
+        if geo_cache.blocked(host):
+            return "proxy"
+        return self.default
+
+
+class ProxyStats:
+    __slots__ = ("requests", "errors", "failures", "latency", "evicted")
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.requests = 0
+        self.errors = 0
+        self.failures = 0
+        self.latency = None
+        self.evicted = None
+
+    @property
+    def error_rate(self) -> float:
+        return self.errors / self.requests if self.requests else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "error_rate": self.error_rate,
+            "latency": self.latency,
+            "evicted": self.evicted is not None,
+        }
+
+
+class ProxyPool:
+    """Proxies in order of preference, with error and latency tracking"""
+
+    def __init__(self, proxies: list) -> None:
+        self.proxies = list(proxies)
+        self.stats = {proxy: ProxyStats() for proxy in self.proxies}
+        # Proxy each job thread is pinned to
+        self.assigned = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, proxy: str) -> bool:
+        return proxy in self.stats
+
+    def __len__(self) -> int:
+        return len(self.proxies)
+
+    def available(self) -> list:
+        now = time.time()
+        for stats in self.stats.values():
+            # Evicted proxies get a clean slate once their time is up
+            if stats.evicted is not None and stats.evicted < now:
+                stats.reset()
+
+        proxies = [x for x in self.proxies if self.stats[x].evicted is None]
+        # A bad proxy still beats none at all
+        return proxies or list(self.proxies)
+
+    def score(self, proxy: str) -> tuple:
+        stats = self.stats[proxy]
+        return (
+            stats.error_rate >= EVICT_RATE / 2,
+            stats.latency is None,
+            stats.latency or 0,
+            self.proxies.index(proxy),
+        )
+
+    def pick(self, exclude: set = ()) -> str:
+        """Proxy for the current job, or None once all of them have been excluded"""
+        ident = threading.get_ident()
+        with self.lock:
+            available = self.available()
+            proxy = self.assigned.get(ident)
+            if proxy in available and proxy not in exclude:
+                return proxy
+
+            candidates = [x for x in available if x not in exclude]
+            if not candidates:
+                return None
+
+            proxy = self.assigned[ident] = min(candidates, key=self.score)
+            return proxy
+
+    def report(self, proxy: str, latency: float = None, error: bool = False) -> None:
+        with self.lock:
+            stats = self.stats[proxy]
+            stats.requests += 1
+            if not error:
+                stats.failures = 0
+                stats.latency = (
+                    latency
+                    if stats.latency is None
+                    else stats.latency * 0.7 + latency * 0.3
+                )
+                return
+
+            stats.errors += 1
+            stats.failures += 1
+            if stats.failures >= EVICT_FAILURES or (
+                stats.requests >= EVICT_REQUESTS and stats.error_rate >= EVICT_RATE
+            ):
+                stats.evicted = time.time() + EVICT_TIME
+                log.warning(f"Evicting proxy {endpoint(proxy)} for {EVICT_TIME}s")
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {endpoint(x): self.stats[x].to_dict() for x in self.proxies}
+
+
+class ProxyAdapter(HTTPAdapter):
+    """Sends requests through a proxy pool, retrying failed ones on the next proxy"""
+
+    def __init__(self, pool: ProxyPool, router: GeoRouter = None, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.pool = pool
+        self.router = router
+
+    def route(self, url: str) -> str:
+        if self.router is None:
+            return "proxy"
+        return self.router.route(urlparse(url).hostname or "")
+
+    def send(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        explicit = (kwargs.get("proxies") or {}).get(urlparse(request.url).scheme)
+        # Requests that bring a proxy of their own, like proxy_session, bypass the pool
+        if explicit and explicit not in self.pool:
+            return super().send(request, **kwargs)
+
+        route = self.route(request.url)
+        if route != "proxy":
+            response = super().send(request, **{**kwargs, "proxies": {}})
+            if route == "direct" or not geo_blocked(response):
+                return response
+
+            response.close()
+            proxied = self.send_proxied(request, **kwargs)
+            # Only learn it if the proxy actually gets around the block
+            if not geo_blocked(proxied):
+                geo_cache.learn(urlparse(request.url).hostname)
+            return proxied
+
+        return self.send_proxied(request, **kwargs)
+
+    def send_proxied(self, request: requests.PreparedRequest, **kwargs) -> requests.Response:
+        idempotent = request.method in IDEMPOTENT
+        tried = set()
+        response = error = None
+        for attempt in range(MAX_ATTEMPTS):
+            proxy = self.pool.pick(exclude=tried)
+            if proxy is None:
+                break
+
+            kwargs["proxies"] = {"http": proxy, "https": proxy}
+            start = time.monotonic()
+            try:
+                result = super().send(request, **kwargs)
+            except requests.ConnectionError as e:
+                self.pool.report(proxy, error=True)
+                log.debug(f"Proxy {endpoint(proxy)} failed: {e}")
+                # A request that may have reached the service is only sent again if that's safe
+                if not idempotent and not unsent(e):
+                    raise
+                tried.add(proxy)
+                metrics.inc("retries", kind="proxy")
+                error = e
+                continue
+
+            if response is not None:
+                response.close()
+            response = result
+
+            if response.status_code in PROXY_FAILURES:
+                # Refused by the proxy itself, so the service never saw it
+                self.pool.report(proxy, error=True)
+                tried.add(proxy)
+                metrics.inc("retries", kind="proxy")
+                log.debug(f"Proxy {endpoint(proxy)} got {response.status_code} for {request.url}")
+                continue
+
+            self.pool.report(proxy, latency=time.monotonic() - start)
+            if (
+                response.status_code == RATE_LIMITED
+                and idempotent
+                and attempt < MAX_ATTEMPTS - 1
+            ):
+                delay = retry_after(response, attempt)
+                metrics.inc("retries", kind="rate_limit")
+                log.debug(f"Rate limited on {request.url}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            return response
+
+        if response is not None:
+            return response
+        raise error
+
+
+def use_proxy_pool(
+    session: requests.Session, proxies: list, router: GeoRouter = None
+) -> ProxyPool:
+    """Route the session's requests through a pool of proxies, or only the ones that need it"""
+    pool = ProxyPool(proxies)
+    adapter = ProxyAdapter(pool, router)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Still read by code that copies the session's proxy, like the native downloader
+    session.proxies = {"http": pool.proxies[0], "https": pool.proxies[0]}
+    return pool
+
+
+def proxy_for(session: requests.Session, url: str) -> str:
+    """Proxy a request to url would use outside of the session, like in the native downloader"""
+    adapter = session.get_adapter(url) if hasattr(session, "get_adapter") else None
+    if isinstance(adapter, ProxyAdapter):
+        # Learned blocks only show up as proxy routes, so auto goes direct
+        return adapter.pool.pick() if adapter.route(url) == "proxy" else None
+    return (getattr(session, "proxies", None) or {}).get("https")
+
 
 class Windscribe:
     def __init__(self, username: str, password: str) -> None:
@@ -31,7 +526,7 @@ class Windscribe:
         if not self.wndstate.exists() and not self.username and not self.password:
             raise IndexError("Windscribe credentials must be provided")
 
-    def proxy(self, query):
+    def list_proxies(self) -> list:
         command = [self.executable, "-list-proxies"]
         command.extend(
             ["-username", self.username]
@@ -55,16 +550,24 @@ class Windscribe:
         ).groups()
 
         hostnames = re.findall(r"[a-zA-Z0-9.-]+\.totallyacdn\.com", output.stdout)
-        servers = [hostname for hostname in hostnames if hostname.startswith(query)]
+        return [f"https://{username}:{password}@{server}:443" for server in hostnames]
+
+    def servers(self, query: str, fresh: bool = False) -> list:
+        # The list covers every location, so one fetch serves them all
+        proxies = proxy_cache.proxies("windscribe", self.list_proxies, fresh=fresh)
+        return [x for x in proxies if urlparse(x).hostname.startswith(query)]
+
+    def proxies(self, query: str) -> list:
+        servers = self.servers(query)
         if not servers:
             raise ValueError(f"Proxy server for {query.upper()} was not found")
 
-        proxies = []
-        for server in servers:
-            proxies.append(f"https://{username}:{password}@{server}:443")
+        return proxy_cache.ranked(
+            f"windscribe:{query}", servers, lambda: self.servers(query, fresh=True)
+        )
 
-        proxy = random.choice(proxies)
-        return proxy
+    def proxy(self, query):
+        return self.proxies(query)[0]
 
 
 class Hola:
@@ -77,7 +580,7 @@ class Hola:
                 "Required hola-proxy executable was not found on your system"
             )
 
-    def proxy(self, query):
+    def list_proxies(self, query: str) -> list:
         command = [
             self.executable,
             "-country",
@@ -109,20 +612,37 @@ class Hola:
             ) = server.split(",")
             proxies.append(f"http://{username}:{password}@{ip_address}:{trial}")
 
-        proxy = random.choice(proxies)
-        return proxy
+        return proxies
+
+    def servers(self, query: str, fresh: bool = False) -> list:
+        return proxy_cache.proxies(
+            f"hola:{query}", lambda: self.list_proxies(query), fresh=fresh
+        )
+
+    def proxies(self, query: str) -> list:
+        servers = self.servers(query)
+        if not servers:
+            raise ValueError(f"Proxy server for {query.upper()} was not found")
+
+        return proxy_cache.ranked(
+            f"hola:{query}", servers, lambda: self.servers(query, fresh=True)
+        )
+
+    def proxy(self, query):
+        return self.proxies(query)[0]
 
     # TODO
     # def countries():
     #     pass
 
 
-def get_proxy(
+def get_proxies(
     cli: object = None, 
     config: dict = None, 
     client: str = None, 
     location: str = None
-) -> str:
+) -> list:
+    """Proxies for the configured provider and location, in order of preference"""
 
     if cli is not None:
         client = cli.config.get("proxy")
@@ -133,7 +653,7 @@ def get_proxy(
 
     if not client:
         log.error("A proxy must be set in config file")
-        return
+        return []
 
     client = client.lower()
     if client == "basic":
@@ -141,7 +661,8 @@ def get_proxy(
 
         log.info("+ Adding basic proxy location: %s", url)
 
-        return url
+        # Several proxies can be given separated by commas
+        return [x.strip() for x in url.split(",") if x.strip()]
 
     elif client == "hola":
         iso = location if location else cli.proxy
@@ -153,7 +674,7 @@ def get_proxy(
         query = iso.lower()
         query = "gb" if query == "uk" else query
         hola = Hola()
-        return hola.proxy(query)
+        return hola.proxies(query)
 
     elif client == "windscribe":
         iso = location if location else cli.proxy
@@ -171,7 +692,20 @@ def get_proxy(
 
         query = iso.lower()
         windscribe = Windscribe(username, password)
-        return windscribe.proxy(query)
+        return windscribe.proxies(query)
+
+    return []
+
+
+def get_proxy(
+    cli: object = None, 
+    config: dict = None, 
+    client: str = None, 
+    location: str = None
+) -> str:
+    proxies = get_proxies(cli=cli, config=config, client=client, location=location)
+    return proxies[0] if proxies else None
+
 
 def proxy_session(
     cli: object = None, 
@@ -1,6 +1,7 @@
 import re
-import uuid
+from functools import partial
 
+from utils.tokens import pluto_session, token_store
 from utils.utilities import slugify
 from bs4 import BeautifulSoup
 
@@ -275,7 +276,7 @@ def _dict(keywords: str):
     ]
 
 
-def _parse(query: dict, service: dict, client=None):
+def _parse(query: dict, service: dict, client=None, region: str = None):
     template = """
     [bold]{service}[/bold]
     Title: {title}
@@ -427,15 +428,10 @@ def _parse(query: dict, service: dict, client=None):
                 )
 
     if service["name"] == "PlutoTV":
-        params = {
-            "appName": "web",
-            "appVersion": "na",
-            "clientID": str(uuid.uuid1()),
-            "clientModelNumber": "na",
-        }
-        token = client.get("https://boot.pluto.tv/v4/start", params=params).json()[
-            "sessionToken"
-        ]
+        # Same session as the Pluto service uses, as long as it's valid
+        token = token_store.get(
+            "pluto", partial(pluto_session, client), region=region
+        ).value
 
         client.headers.update({"Authorization": f"Bearer {token}"})
 
@@ -2,10 +2,13 @@ import yaml
 import httpx
 import logging
 import sys
+from functools import partial
 from rich.console import Console
 
+from utils.metrics import metrics
 from utils.search.api import _dict, _parse
 from utils.proxies import get_proxy
+from utils.tokens import region, roku_csrf, token_store
 
 console = Console()
 log = logging.getLogger()
@@ -34,6 +37,7 @@ class Config:
 
         self.alias = [alias]
         self.keywords = keywords
+        self.proxy = proxy
 
         if "," in self.alias[0]:
             self.alias = [x for x in self.alias[0].split(",")]
@@ -65,8 +69,12 @@ def search_post(search: object, service: dict):
 
     if service.get("token"):
         try:
-            token = search.client.get(service["token"]).json()["csrf"]
-            search.client.headers.update({"csrf-token": token})
+            # Roku's CSRF token, shared with the Roku service
+            token = token_store.get(
+                "roku", partial(roku_csrf, search.client), region=region(search.proxy)
+            )
+            search.client.cookies.update(token.data["cookies"])
+            search.client.headers.update({"csrf-token": token.value})
         except:
             return None
 
@@ -99,12 +107,15 @@ def search_engine(alias: str, keywords: str, proxy: str):
     queries = []
     with console.status("Searching..."):
         for service in services:
-            if service["method"] == "GET":
-                query = search_get(cfg, service)
-            if service["method"] == "POST":
-                query = search_post(cfg, service)
-
-            results = _parse(query, service, cfg.client)
+            name = service["name"].lower().replace(" ", "")
+            with metrics.phase("search", name):
+                if service["method"] == "GET":
+                    query = search_get(cfg, service)
+                if service["method"] == "POST":
+                    query = search_post(cfg, service)
+
+            with metrics.phase("parse", name):
+                results = _parse(query, service, cfg.client, region(cfg.proxy))
             queries.append(results)
 
     queries = [results for results in queries]
@@ -0,0 +1,92 @@
+"""
+Loopback manifest server
+
+Rewritten manifests are served from memory over http://127.0.0.1 instead
+of being written to the temp folder, so concurrent jobs never share or
+overwrite each other's files. Content can be bytes, text, or a callable
+returning an iterable of chunks, which is rendered on every request so
+line-based rewrites stream straight to the downloader.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+log = logging.getLogger()
+
+CONTENT_TYPES = {
+    ".mpd": "application/dash+xml",
+    ".m3u8": "application/vnd.apple.mpegurl",
+}
+
+
+def chunks(content: object) -> object:
+    if callable(content):
+        content = content()
+    if isinstance(content, (str, bytes)):
+        content = (content,)
+    for chunk in content:
+        yield chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+class ManifestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        path = urlparse(self.path).path
+        content = self.server.manifests.get(path)
+        if content is None:
+            self.send_error(404)
+            return
+
+        suffix = path[path.rfind(".") :]
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPES.get(suffix, "text/plain"))
+        self.end_headers()
+        for chunk in chunks(content):
+            self.wfile.write(chunk)
+
+    def log_message(self, format: str, *args) -> None:
+        log.debug(f"Manifest server: {format % args}")
+
+
+class ManifestServer:
+    def __init__(self, host: str = "127.0.0.1") -> None:
+        self.host = host
+        self.manifests = {}
+        self.httpd = None
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        with self.lock:
+            if self.httpd is not None:
+                return
+            # Port 0 lets the OS pick a free port
+            self.httpd = ThreadingHTTPServer((self.host, 0), ManifestHandler)
+            self.httpd.daemon_threads = True
+            self.httpd.manifests = self.manifests
+            threading.Thread(
+                target=self.httpd.serve_forever, name="manifest-server", daemon=True
+            ).start()
+
+    def serve(self, content: object, name: str = "manifest.mpd") -> str:
+        """Serve content and return its loopback URL"""
+        self.start()
+        path = f"/{uuid.uuid4().hex}/{name}"
+        self.manifests[path] = content
+        return f"http://{self.host}:{self.httpd.server_port}{path}"
+
+    def render(self, url: str) -> bytes:
+        """Content of a served URL, without going through HTTP"""
+        content = self.manifests.get(urlparse(str(url)).path)
+        if content is None:
+            return None
+        return b"".join(chunks(content))
+
+    def release(self, url: object) -> None:
+        if url is not None:
+            self.manifests.pop(urlparse(str(url)).path, None)
+
+
+manifest_server = ManifestServer()
@@ -0,0 +1,361 @@
+"""
+Streaming subtitle conversion to SRT
+
+WebVTT and TTML/DFXP are converted one cue at a time: WebVTT is read line by
+line and TTML with an incremental parser that drops every paragraph once
+it's written, so memory stays flat however long the file is. The cues are
+cleaned up on the way, like subby's CommonIssuesFixer does: whitespace is
+normalized, empty cues are dropped and repeated cues that follow each other
+are merged.
+
+Converted files are cached by the hash of their content, so the same
+subtitles are never converted twice, and many files can be converted at
+once across a process pool with convert_batch. Anything the streaming
+converter can't read, such as WVTT and ISMT in MP4 or SAMI, goes through
+subby as before.
+"""
+from __future__ import annotations
+
+import hashlib
+import html
+import logging
+import os
+import re
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from lxml import etree
+from subby import (
+    CommonIssuesFixer,
+    ISMTConverter,
+    SAMIConverter,
+    SMPTEConverter,
+    WebVTTConverter,
+    WVTTConverter,
+)
+
+log = logging.getLogger()
+
+# Bump when the output changes, so cached conversions aren't reused
+VERSION = 1
+SUBTITLE_CACHE = Path("utils") / "settings" / "subtitles"
+MAX_CACHED = 2000
+STREAMING = ("vtt", "ttml", "dfxp")
+# Repeated cues this close together are shown as one
+MERGE_GAP = 0.05
+CHUNK = 1024 * 1024
+
+VTT_TIME = re.compile(r"(?:(\d+):)?(\d{2}):(\d{2})[.,](\d{3})")
+# Everything but the tags SRT players understand
+VTT_TAGS = re.compile(r"<(?!/?(?:i|b|u)>)[^>]*>")
+EMPTY_TAGS = re.compile(r"<([ibu])>\s*</\1>")
+CLOCK_TIME = re.compile(r"(\d+):(\d{2}):(\d{2}(?:\.\d+)?)(?::(\d+(?:\.\d+)?))?")
+OFFSET_TIME = re.compile(r"(\d+(?:\.\d+)?)(h|ms|m|s|f|t)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def subby_convert(source: Path, output: Path, sub_type: str) -> Path:
+    converters = {
+        "vtt": WebVTTConverter,
+        "ttml": SMPTEConverter,
+        "mp4": WVTTConverter,
+        "dfxp": ISMTConverter,
+        "sami": SAMIConverter,
+    }
+
+    srt, _ = CommonIssuesFixer().from_srt(converters[sub_type]().from_file(source))
+    srt.save(output)
+    return output
+
+
+def srt_time(seconds: float) -> str:
+    h, ms = divmod(max(0, round(seconds * 1000)), 3600000)
+    m, ms = divmod(ms, 60000)
+    s, ms = divmod(ms, 1000)
+    return f"{h:02}:{m:02}:{s:02},{ms:03}"
+
+
+def vtt_time(value: str) -> float:
+    match = VTT_TIME.match(value.strip())
+    if match is None:
+        raise ValueError(f"Invalid WebVTT timestamp {value!r}")
+    h, m, s, ms = match.groups()
+    return int(h or 0) * 3600 + int(m) * 60 + int(s) + int(ms) / 1000
+
+
+def vtt_cue(block: list) -> tuple:
+    timing = next((i for i, line in enumerate(block) if "-->" in line), None)
+    if timing is None:
+        # Header, NOTE, STYLE and REGION blocks
+        return None
+
+    start, _, end = block[timing].partition("-->")
+    # Cue settings follow the end time
+    end = end.strip().split(" ", 1)[0]
+    text = html.unescape(VTT_TAGS.sub("", "\n".join(block[timing + 1 :])))
+    return vtt_time(start), vtt_time(end), text
+
+
+def vtt_cues(lines: object) -> object:
+    block = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.strip():
+            block.append(line)
+            continue
+        if block:
+            cue = vtt_cue(block)
+            if cue is not None:
+                yield cue
+            block = []
+
+    if block:
+        cue = vtt_cue(block)
+        if cue is not None:
+            yield cue
+
+
+def local(name: str) -> str:
+    return name.rpartition("}")[2]
+
+
+def attribute(elem: etree._Element, name: str) -> str:
+    """Attribute by local name, in whatever namespace the TTML flavour puts it"""
+    value = elem.get(name)
+    if value is not None:
+        return value
+    for key, value in elem.attrib.items():
+        if local(key) == name:
+            return value
+    return None
+
+
+class Timing:
+    """Time expressions of a TTML document"""
+
+    __slots__ = ("frame_rate", "tick_rate")
+
+    def __init__(self, root: etree._Element) -> None:
+        frame_rate = float(attribute(root, "frameRate") or 30)
+        multiplier = (attribute(root, "frameRateMultiplier") or "1 1").split()
+        self.frame_rate = frame_rate * float(multiplier[0]) / float(multiplier[1])
+        self.tick_rate = float(attribute(root, "tickRate") or 1)
+
+    def seconds(self, value: str) -> float:
+        value = value.strip()
+        match = CLOCK_TIME.fullmatch(value)
+        if match is not None:
+            h, m, s, frames = match.groups()
+            seconds = int(h) * 3600 + int(m) * 60 + float(s)
+            return seconds + (float(frames) / self.frame_rate if frames else 0)
+
+        match = OFFSET_TIME.fullmatch(value)
+        if match is None:
+            raise ValueError(f"Invalid TTML time {value!r}")
+
+        number, unit = float(match.group(1)), match.group(2)
+        if unit == "f":
+            return number / self.frame_rate
+        if unit == "t":
+            return number / self.tick_rate
+        return number * {"h": 3600, "m": 60, "s": 1, "ms": 0.001}[unit]
+
+
+def ttml_italic(elem: etree._Element, italic_styles: set) -> bool:
+    if attribute(elem, "fontStyle") == "italic":
+        return True
+    return any(x in italic_styles for x in (elem.get("style") or "").split())
+
+
+def ttml_text(elem: etree._Element, italic_styles: set, italic: bool = False) -> str:
+    """Text of a paragraph or span, with line breaks and italics kept"""
+    inner = italic or ttml_italic(elem, italic_styles)
+
+    text = WHITESPACE.sub(" ", elem.text or "")
+    for child in elem:
+        if isinstance(child.tag, str):
+            name = local(child.tag)
+            if name == "br":
+                text += "\n"
+            elif name == "span":
+                text += ttml_text(child, italic_styles, inner)
+        text += WHITESPACE.sub(" ", child.tail or "")
+
+    if inner and not italic:
+        return "\n".join(f"<i>{x.strip()}</i>" if x.strip() else x for x in text.split("\n"))
+    return text
+
+
+def ttml_cues(source: object) -> object:
+    timing = None
+    italic_styles = set()
+    # Time offsets of the enclosing body and divs
+    offsets = [0.0]
+
+    for event, elem in etree.iterparse(
+        source, events=("start", "end"), resolve_entities=False, huge_tree=True
+    ):
+        name = local(elem.tag) if isinstance(elem.tag, str) else None
+
+        if event == "start":
+            if timing is None and name != "tt":
+                raise ValueError("Not a TTML document")
+            if name == "tt":
+                timing = Timing(elem)
+            elif name in ("body", "div"):
+                begin = elem.get("begin")
+                offsets.append(offsets[-1] + (timing.seconds(begin) if begin else 0))
+            continue
+
+        if name == "style" and attribute(elem, "fontStyle") == "italic":
+            italic_styles.add(attribute(elem, "id"))
+        elif name in ("body", "div"):
+            offsets.pop()
+        elif name == "p":
+            begin, end, dur = elem.get("begin"), elem.get("end"), elem.get("dur")
+            if begin is None or (end is None and dur is None):
+                raise ValueError("Paragraph without timing")
+
+            start = offsets[-1] + timing.seconds(begin)
+            stop = offsets[-1] + timing.seconds(end) if end else start + timing.seconds(dur)
+            yield start, stop, ttml_text(elem, italic_styles)
+
+            # Paragraphs are only needed once, drop them and what came before
+            elem.clear()
+            parent = elem.getparent()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+
+def fix_cues(cues: object) -> object:
+    """Normalize whitespace, drop empty cues and merge repeated ones, one cue behind"""
+    previous = None
+    for start, end, text in cues:
+        lines = (" ".join(line.split()) for line in text.split("\n"))
+        text = EMPTY_TAGS.sub("", "\n".join(x for x in lines if x)).strip()
+        if not text or end <= start:
+            continue
+
+        if previous is not None and text == previous[2] and start - previous[1] <= MERGE_GAP:
+            previous = (previous[0], max(end, previous[1]), text)
+            continue
+
+        if previous is not None:
+            yield previous
+        previous = (start, end, text)
+
+    if previous is not None:
+        yield previous
+
+
+def write_srt(cues: object, output: Path) -> int:
+    count = 0
+    with output.open("w", encoding="utf-8") as f:
+        for count, (start, end, text) in enumerate(cues, 1):
+            f.write(f"{count}\n{srt_time(start)} --> {srt_time(end)}\n{text}\n\n")
+    return count
+
+
+def convert(source: Path, output: Path, sub_type: str) -> Path:
+    """Convert WebVTT, TTML or DFXP to SRT cue by cue, raises ValueError if it can't"""
+    if sub_type == "vtt":
+        with source.open("r", encoding="utf-8-sig", errors="replace") as f:
+            write_srt(fix_cues(vtt_cues(f)), output)
+        return output
+
+    with source.open("rb") as f:
+        # DFXP is sometimes delivered wrapped in MP4 (ISMT)
+        if not f.read(1024).lstrip(b"\xef\xbb\xbf \t\r\n").startswith(b"<"):
+            raise ValueError("Not an XML document")
+        f.seek(0)
+        try:
+            write_srt(fix_cues(ttml_cues(f)), output)
+        except etree.XMLSyntaxError as e:
+            raise ValueError(f"Invalid TTML: {e}")
+    return output
+
+
+def convert_file(source: Path, output: Path, sub_type: str) -> Path:
+    """Convert with the streaming converter, falling back to subby"""
+    if sub_type in STREAMING:
+        try:
+            return convert(source, output, sub_type)
+        except ValueError as e:
+            log.debug(f"Streaming converter can't read {source.name} ({e}), using subby")
+
+    return subby_convert(source, output, sub_type)
+
+
+def content_hash(source: Path, sub_type: str) -> str:
+    digest = hashlib.sha1(f"{VERSION}:{sub_type}:".encode("utf-8"))
+    with source.open("rb") as f:
+        while chunk := f.read(CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def prune(directory: Path, keep: int = MAX_CACHED) -> None:
+    files = list(directory.glob("*.srt"))
+    if len(files) <= keep:
+        return
+
+    files.sort(key=lambda x: x.stat().st_mtime)
+    for path in files[: len(files) - keep]:
+        path.unlink(missing_ok=True)
+
+
+def convert_cached(
+    source: Path, output: Path, sub_type: str, cache: Path = SUBTITLE_CACHE
+) -> Path:
+    """Convert a subtitle file, reusing an earlier conversion of the same content"""
+    cached = cache / f"{content_hash(source, sub_type)}.srt"
+    if cached.exists():
+        shutil.copyfile(cached, output)
+        # Recently used conversions are pruned last
+        os.utime(cached)
+        return output
+
+    convert_file(source, output, sub_type)
+
+    cache.mkdir(parents=True, exist_ok=True)
+    # Other processes and threads may convert the same file at the same time
+    fd, tmp = tempfile.mkstemp(dir=cache, prefix=f"{cached.stem}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        shutil.copyfile(output, tmp)
+        os.replace(tmp, cached)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+    prune(cache)
+    return output
+
+
+def convert_or_error(source: Path, output: Path, sub_type: str, cache: Path) -> object:
+    try:
+        return convert_cached(source, output, sub_type, cache)
+    except Exception as e:
+        return e
+
+
+def convert_batch(files: list, workers: int = None, cache: Path = SUBTITLE_CACHE) -> list:
+    """
+    Convert (source, output, sub_type) tuples across a process pool
+
+    Returns the output path of each file in order, or the exception it failed with
+    """
+    if len(files) < 2:
+        # Not worth starting processes for
+        return [convert_or_error(*x, cache) for x in files]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(convert_cached, *x, cache) for x in files]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+    return results
@@ -0,0 +1,169 @@
+"""
+Storage planning for downloads
+
+Keeps temporary files on the same device as the destination, so finished
+files are moved into place with an atomic rename instead of a copy, checks
+that there's room for a download before it starts, based on the bandwidth
+and duration in its manifest, and finalizes output so a crash or a full
+disk never leaves a half-written file under the final name.
+"""
+from __future__ import annotations
+
+import errno
+import logging
+import os
+import shutil
+from pathlib import Path
+
+from utils.hls import parse_master, scan_media
+from utils.manifests import manifest_cache
+from utils.mpd import parse_mpd
+from utils.progress import format_size
+from utils.server import manifest_server
+
+log = logging.getLogger()
+
+# Hidden temp folder used inside the destination when temp_dir is on another device
+FALLBACK_TEMP = ".freevine"
+# Segments and the merged or decrypted track sit in temp at the same time
+TEMP_FACTOR = 2
+MARGIN = 1.05
+
+
+def existing(path: Path) -> Path:
+    """Nearest existing ancestor of a path that might not exist yet"""
+    path = Path(path).absolute()
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+def same_device(a: Path, b: Path) -> bool:
+    return os.stat(existing(a)).st_dev == os.stat(existing(b)).st_dev
+
+
+def choose_temp(temp: str, save_path: str) -> Path:
+    """The configured temp dir, or a folder in the destination if it's on another device"""
+    if same_device(temp, save_path):
+        return Path(temp)
+
+    fallback = Path(save_path) / FALLBACK_TEMP
+    log.debug(f"{temp} is on another device than {save_path}, using {fallback}")
+    return fallback
+
+
+def free_space(path: Path) -> int:
+    return shutil.disk_usage(existing(path)).free
+
+
+def closest(heights: set, res: object) -> int:
+    return min(heights, key=lambda x: abs(x - int(res or 0)))
+
+
+def dash_estimate(data: bytes, url: str, res: object) -> int:
+    mpd = parse_mpd(data, url)
+    duration = mpd.duration or sum(x.duration or 0 for x in mpd.periods)
+    videos = [x for x in mpd.videos if x.bandwidth]
+    audios = [x for x in mpd.representations if x.kind == "audio" and x.bandwidth]
+    if not duration or not videos:
+        return None
+
+    # Periods repeat the same ladder, so the rates of one period apply to all
+    height = closest({x.height or 0 for x in videos}, res)
+    bandwidth = max(x.bandwidth for x in videos if (x.height or 0) == height)
+    bandwidth += max((x.bandwidth for x in audios), default=0)
+    return int(bandwidth * duration / 8)
+
+
+def hls_estimate(service: object, data: bytes, url: str, res: object) -> int:
+    master = parse_master(data, url)
+    variant = master.best(res)
+    if variant is None:
+        return None
+
+    playlist = manifest_cache.parse(service.client, master.resolve(variant.uri), scan_media)
+    # BANDWIDTH is a peak and already covers the audio renditions
+    bandwidth = variant.average_bandwidth or variant.bandwidth
+    if not bandwidth or not playlist.duration:
+        return None
+    return int(bandwidth * playlist.duration / 8)
+
+
+def estimate_size(service: object) -> int:
+    """Expected size in bytes of the selected tracks, or None if the manifest doesn't say"""
+    url = str(service.manifest)
+    if not url.startswith("http"):
+        return None
+
+    try:
+        data = manifest_server.render(url)
+        if data is None:
+            data = manifest_cache.get(service.client, url)
+        if data.lstrip().startswith(b"#EXTM3U"):
+            return hls_estimate(service, data, url, service.res)
+        return dash_estimate(data, url, service.res)
+    except Exception as e:
+        log.debug(f"Couldn't estimate download size: {e}")
+        return None
+
+
+def preflight(service: object, temp: Path, save_path: Path) -> None:
+    """Raise ValueError if temp or destination doesn't have room for the download"""
+    size = estimate_size(service)
+    if not size:
+        return
+
+    needs = {existing(temp): size * TEMP_FACTOR * MARGIN}
+    destination = existing(save_path)
+    needs[destination] = needs.get(destination, 0) + size * MARGIN
+
+    # Paths on the same device share the same free space
+    devices = {}
+    for path, need in needs.items():
+        device = os.stat(path).st_dev
+        devices[device] = (path, devices.get(device, (path, 0))[1] + need)
+
+    for path, need in devices.values():
+        free = free_space(path)
+        if free < need:
+            raise ValueError(
+                f"Not enough free space on {path}: about {format_size(need)} "
+                f"needed, {format_size(free)} free"
+            )
+
+    log.debug(f"Estimated download size: {format_size(size)}")
+
+
+def partial_path(path: Path) -> Path:
+    """Hidden name a file is written under until it's complete, keeping its extension"""
+    return path.with_name(f".{path.stem}.partial{path.suffix}")
+
+
+def finalize(source: Path, destination: Path) -> None:
+    """Move a finished file into place, atomically unless it crosses devices"""
+    try:
+        os.replace(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # Copy next to the destination first, so the final name only
+        # ever points to a complete file
+        partial = partial_path(destination)
+        shutil.copyfile(source, partial)
+        os.replace(partial, destination)
+        source.unlink()
+
+
+def finalize_dir(directory: Path, save_path: Path) -> None:
+    """Move everything a download left in a work folder into the destination"""
+    save_path = Path(save_path)
+    save_path.mkdir(parents=True, exist_ok=True)
+    for path in directory.iterdir():
+        if path.is_file():
+            finalize(path, save_path / path.name)
+    shutil.rmtree(directory, ignore_errors=True)
+
+    # Drop the fallback temp folder once it's empty
+    fallback = save_path / FALLBACK_TEMP
+    if fallback.is_dir() and not any(fallback.iterdir()):
+        fallback.rmdir()
@@ -0,0 +1,219 @@
+"""
+Background subtitle retrieval and conversion
+
+Subtitles are fetched and converted on a small worker pool while the
+service resolves the manifest and keys, and are only joined right before
+they're handed over to the muxer.
+
+With --sub-only, services that know where a title's subtitles are without
+resolving its manifest skip the regular flow altogether: the subtitles of
+the whole selection are fetched at once and converted on a process pool,
+see utils/srt.py.
+"""
+from __future__ import annotations
+
+import logging
+import shutil
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError, as_completed
+from pathlib import Path
+
+import requests
+
+from utils.manager import service_manager
+from utils.metrics import metrics, service_name
+from utils.srt import convert_batch
+from utils.utilities import convert_subtitles, in_cache, set_filename, set_save_path
+
+log = logging.getLogger()
+executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="subtitles")
+# Longest wait for background subtitles once the media is downloaded
+JOIN_TIMEOUT = 120
+
+# Subtitle requests at once for --sub-only, within the session's connection pool
+BATCH_WORKERS = 8
+
+
+def download_subtitles(
+    client: object,
+    url: str,
+    tmp: Path,
+    name: str,
+    sub_type: str,
+    fix: bool,
+    source: str = None,
+) -> Path:
+    # Runs on the worker pool, so the service is passed along for metrics
+    with metrics.phase("subtitles", source):
+        try:
+            r = client.get(url)
+            r.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            log.warning(f"Subtitle request failed ({e}), skipping")
+            return None
+
+        metrics.inc("bytes", len(r.content), source, kind="subtitles")
+        sub_path = tmp / f"{name}.{sub_type}"
+        with open(sub_path, "wb") as f:
+            f.write(r.content)
+
+        if fix and sub_type != "srt":
+            sub_path = convert_subtitles(tmp, name, sub_type=sub_type)
+
+        return sub_path
+
+
+def fetch_subtitles(
+    service: object, url: str, name: str, sub_type: str, client: object = None
+) -> Future:
+    """
+    Start fetching and converting subtitles in the background
+
+    The file is stored under a temporary name, since the final filename
+    usually isn't known until the manifest has been parsed
+    """
+    if service.planning:
+        # Plans only keep where the subtitles are, see utils/planner.py
+        service.planned_subtitles = {"url": url, "type": sub_type, "plain": client is not None}
+        future = Future()
+        future.set_result(None)
+        return future
+
+    return executor.submit(
+        download_subtitles,
+        client or service.client,
+        url,
+        service.tmp,
+        f"{name}.sub",
+        sub_type,
+        not service.sub_no_fix,
+        service_name(service),
+    )
+
+
+def fetching_subtitles(service: object) -> bool:
+    """Whether the service's subtitles are on the background pool and not joined yet"""
+    return isinstance(getattr(service, "sub_path", None), Future)
+
+
+def join_subtitles(service: object) -> Path:
+    """
+    Wait for background subtitles and move them in place for muxing
+
+    Subtitles that fail or take too long are left out rather than holding up
+    the title
+    """
+    if not fetching_subtitles(service):
+        return service.sub_path
+
+    try:
+        sub_path = service.sub_path.result(timeout=JOIN_TIMEOUT)
+    except TimeoutError:
+        log.warning(f"Subtitles took longer than {JOIN_TIMEOUT}s, continuing without them")
+        sub_path = None
+    except Exception as e:
+        log.warning(f"Subtitles failed ({e.__class__.__name__}: {e}), continuing without them")
+        sub_path = None
+
+    if sub_path is not None:
+        sub_path = sub_path.replace(service.tmp / f"{service.filename}{sub_path.suffix}")
+
+    service.sub_path = sub_path
+    return sub_path
+
+
+def expected_quality(stream: object) -> tuple:
+    """
+    Resolution and audio for file names when no manifest is read
+
+    The requested resolution, or else the best the service offers
+    """
+    service = service_manager.find_service(stream.url or stream.episode)
+    quality, _, audio = service.quality.partition(", ")
+    return stream.quality or quality.rstrip("p"), audio
+
+
+def fetch_title(stream: object, download: object, title: str, res: str, audio: str) -> tuple:
+    metrics.bind(stream.__class__.__name__)
+
+    url, sub_type = stream.get_subtitles(download)
+    if url is None:
+        stream.log.warning(f"{str(download)} has no subtitles")
+        return None
+
+    filename = set_filename(stream, download, res, audio)
+    save_path = set_save_path(download, stream, title)
+    sub_path = download_subtitles(
+        stream.client, url, stream.tmp, filename, sub_type, False, service_name(stream)
+    )
+    if sub_path is None:
+        raise ValueError("Subtitle request failed")
+
+    return sub_path, sub_type, save_path / filename
+
+
+def save_subtitles(stream: object, download: object, sub_path: Path, target: Path) -> None:
+    shutil.move(sub_path, target.with_name(f"{target.name}{sub_path.suffix}"))
+    stream.log.info(f"{str(download)}")
+    stream.journal.update(download, "done")
+
+
+def subtitle_batch(stream: object, downloads: list, title: str) -> None:
+    """
+    Fetch the subtitles of a whole selection for --sub-only
+
+    Used by services with a get_subtitles(title) method that returns the URL
+    and format of a title's subtitles. Nothing else is resolved: subtitles
+    are requested concurrently on the service's session, converted on a
+    process pool and saved under the file name the video would get
+    """
+    if not stream.no_cache:
+        downloads = [x for x in downloads if not in_cache(stream.cache, x)]
+
+    res, audio = expected_quality(stream)
+    fix = not stream.sub_no_fix
+    failed = []
+
+    start = time.perf_counter()
+    fetched = []
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="subtitles") as pool:
+        futures = {pool.submit(fetch_title, stream, x, title, res, audio): x for x in downloads}
+        for future in as_completed(futures):
+            download = futures[future]
+            try:
+                result = future.result()
+            except (Exception, SystemExit) as e:
+                failed.append((download, e))
+                continue
+
+            if result is None:
+                stream.journal.update(download, "done")
+            elif fix and result[1] != "srt":
+                fetched.append((download, *result))
+            else:
+                save_subtitles(stream, download, result[0], result[2])
+
+    converted = convert_batch(
+        [(sub_path, sub_path.with_suffix(".srt"), sub_type) for _, sub_path, sub_type, _ in fetched]
+    )
+    for (download, _, _, target), result in zip(fetched, converted):
+        if isinstance(result, Exception):
+            failed.append((download, result))
+        else:
+            save_subtitles(stream, download, result, target)
+
+    for download, e in failed:
+        error = f"{e.__class__.__name__}: {e}"
+        stream.log.error(f"{str(download)} failed: {error}")
+        stream.journal.update(download, "failed", error)
+
+    metrics.inc("downloads", len(downloads) - len(failed), result="done")
+    metrics.inc("downloads", len(failed), result="failed")
+    stream.log.info(
+        f"Subtitles of {len(downloads) - len(failed)} title(s) in {time.perf_counter() - start:.1f}s"
+    )
+
+    if failed:
+        stream.log.error(f"{len(failed)} download(s) failed. Use --resume to continue the batch")
+        sys.exit(1)
@@ -0,0 +1,232 @@
+"""
+N_m3u8DL-RE supervisor
+
+Runs N_m3u8DL-RE with its output captured instead of letting it write to
+the terminal. Progress lines are parsed into events for `progress_hub`, its
+log lines are passed on to the logger, and a watchdog restarts downloads
+that stop making progress. Before it does, it checks that the save and
+temp directories have stopped growing too, so a download whose progress
+lines can't be parsed isn't taken for a stalled one.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import re
+import subprocess
+import threading
+import time
+
+from utils.metrics import metrics
+from utils.progress import ProgressEvent, progress_hub
+
+log = logging.getLogger()
+
+STALL_TIMEOUT = 120
+MAX_RESTARTS = 2
+
+ANSI = re.compile(r"\x1b\[[0-9;?]*[A-Za-z]")
+# Vid 1920x1080 | 5000 Kbps ━━━━━━━━━━ 58/587 9.88% 21.53MB/217.78MB 5.48MBps 00:00:35
+PROGRESS = re.compile(
+    r"^(?P<track>(?:Vid|Aud|Sub)\b[^━─]*?)\s*[━─ ]*\s(?P<done>\d+)/(?P<total>\d+)\s+[\d.]+%"
+    r"(?:\s+(?P<downloaded>[\d.]+[KMGT]?B)/(?P<size>[\d.]+[KMGT]?B))?"
+    r"(?:\s+(?P<speed>[\d.]+[KMGT]?B)ps)?"
+    r"(?:\s+(?P<eta>\d\d:\d\d:\d\d))?"
+)
+# 15:32:01.123 INFO : Binary merging...
+LOG_LINE = re.compile(r"^\d\d:\d\d:\d\d(?:\.\d+)?\s+(?P<level>[A-Z]+)\s*:\s*(?P<message>.*)")
+LEVELS = {"DEBUG": logging.DEBUG, "WARN": logging.WARNING, "ERROR": logging.ERROR}
+STAGES = (
+    ("start downloading", "downloading"),
+    ("binary merging", "merging"),
+    ("decrypting", "decrypting"),
+    ("muxing", "muxing"),
+)
+UNITS = {"B": 1, "KB": 1024, "MB": 1024**2, "GB": 1024**3, "TB": 1024**4}
+
+
+def parse_size(value: str) -> int:
+    if not value:
+        return None
+    number = value.rstrip("KMGTB")
+    return int(float(number) * UNITS[value[len(number) :]])
+
+
+def parse_progress(line: str, source: str = None) -> ProgressEvent:
+    match = PROGRESS.match(line)
+    if match is None:
+        return None
+
+    return ProgressEvent(
+        source=source,
+        track=match.group("track").strip(" |"),
+        done=int(match.group("done")),
+        total=int(match.group("total")),
+        downloaded=parse_size(match.group("downloaded")),
+        size=parse_size(match.group("size")),
+        speed=parse_size(match.group("speed")),
+        eta=match.group("eta"),
+    )
+
+
+def arg_values(args: list, *names: str) -> list:
+    return [args[i + 1] for i, x in enumerate(args[:-1]) if x in names]
+
+
+def tree_size(paths: list) -> int:
+    """Total size of the files under paths, which may not exist yet"""
+    total = 0
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.stat(os.path.join(root, name)).st_size
+                except OSError:
+                    pass
+    return total
+
+
+def split_lines(fd: int) -> object:
+    """Yield output lines, treating carriage returns of redrawn progress bars as line ends"""
+    buffer = ""
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        buffer += chunk.decode("utf-8", errors="replace")
+        *lines, buffer = re.split(r"[\r\n]", buffer)
+        for line in lines:
+            line = ANSI.sub("", line).strip()
+            if line:
+                yield line
+
+    line = ANSI.sub("", buffer).strip()
+    if line:
+        yield line
+
+
+class Supervisor:
+    def __init__(
+        self,
+        args: list,
+        source: str = None,
+        stall_timeout: int = STALL_TIMEOUT,
+        restarts: int = MAX_RESTARTS,
+    ) -> None:
+        self.args = args
+        self.source = source
+        self.stall_timeout = stall_timeout
+        self.restarts = restarts
+        self.process = None
+        self.stage = None
+        self.stalled = False
+        self.muxing = None
+        self.last_progress = 0
+        self.positions = {}
+        # Where segments and tracks are written, watched before calling it a stall
+        self.directories = arg_values(args, "--save-dir", "--tmp-dir")
+        self.size = 0
+
+    def publish(self, stage: str) -> None:
+        # N_m3u8DL-RE muxes on its own, so its mux time is taken from the stages
+        if stage == "muxing":
+            self.muxing = time.perf_counter()
+        elif self.stage == "muxing":
+            metrics.observe("phase_seconds", time.perf_counter() - self.muxing, phase="mux")
+        self.stage = stage
+        progress_hub.publish(ProgressEvent(source=self.source, stage=stage))
+
+    def handle(self, line: str) -> None:
+        event = parse_progress(line, self.source)
+        if event is not None:
+            position = (event.done, event.downloaded)
+            if self.positions.get(event.track) != position:
+                self.positions[event.track] = position
+                self.last_progress = time.monotonic()
+            progress_hub.publish(event)
+            return
+
+        match = LOG_LINE.match(line)
+        level, message = (
+            (LEVELS.get(match.group("level"), logging.DEBUG), match.group("message"))
+            if match
+            else (logging.DEBUG, line)
+        )
+        log.log(level, f"N_m3u8DL-RE: {message}")
+
+        lowered = message.lower()
+        for keyword, stage in STAGES:
+            if keyword in lowered and stage != self.stage:
+                self.publish(stage)
+                break
+        # Log output counts as a sign of life too, e.g. while retrying segments
+        self.last_progress = time.monotonic()
+
+    def watchdog(self) -> None:
+        while self.process.poll() is None:
+            time.sleep(1)
+            # Merging, decrypting and muxing print nothing for a long time
+            if self.stage not in (None, "downloading"):
+                continue
+            if time.monotonic() - self.last_progress > self.stall_timeout:
+                size = tree_size(self.directories)
+                if size != self.size:
+                    self.size = size
+                    self.last_progress = time.monotonic()
+                    continue
+
+                self.stalled = True
+                self.process.kill()
+                return
+
+    def run_once(self) -> int:
+        self.stalled = False
+        self.stage = None
+        self.positions = {}
+        self.size = tree_size(self.directories)
+        self.last_progress = time.monotonic()
+
+        self.process = subprocess.Popen(
+            self.args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        threading.Thread(target=self.watchdog, name="watchdog", daemon=True).start()
+
+        try:
+            for line in split_lines(self.process.stdout.fileno()):
+                self.handle(line)
+        finally:
+            self.process.stdout.close()
+            code = self.process.wait()
+
+        return code
+
+    def run(self) -> None:
+        """Run to completion, restarting on stalls. Raises CalledProcessError on failure"""
+        for attempt in range(self.restarts + 1):
+            code = self.run_once()
+            if not self.stalled:
+                break
+
+            self.publish("stalled")
+            if attempt < self.restarts:
+                metrics.inc("retries", kind="restart")
+                log.warning(
+                    f"{self.source}: no progress for {self.stall_timeout}s, "
+                    f"restarting N_m3u8DL-RE ({attempt + 1}/{self.restarts})"
+                )
+
+        if self.stalled or code != 0:
+            self.publish("failed")
+            raise subprocess.CalledProcessError(code, self.args)
+
+        self.publish("done")
+
+
+def supervise(service: object, args: list) -> None:
+    """Run N_m3u8DL-RE under a supervisor, or attached to the terminal for --info"""
+    if service.skip_download:
+        subprocess.run(args, check=True)
+        return
+
+    stall_timeout = int(service.config.get("stall_timeout") or STALL_TIMEOUT)
+    Supervisor(args, service.filename, stall_timeout).run()
@@ -0,0 +1,315 @@
+"""
+Token store shared by services, search and daemon jobs
+
+Session and auth tokens are stored per service and profile (the account
+username, or "default") in utils/settings/tokens.json together with their
+expiry. Tokens that only work in one region are also stored per --proxy
+location. A token is only fetched again once it's about to expire, and the
+file is locked while that happens so runs in parallel share one handshake
+instead of each doing their own. In long-running processes, tokens that
+are in use are refreshed in the background shortly before they expire.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import urlparse
+
+from utils.manifests import jwt_expiry
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+log = logging.getLogger()
+
+TOKEN_STORE = Path("utils") / "settings" / "tokens.json"
+# Tokens are renewed this many seconds before they expire
+REFRESH_AHEAD = 120
+
+
+def region(proxy: object) -> str:
+    """Region of a --proxy location: its country code, or the proxy's host and port"""
+    if not proxy or str(proxy) == "False":
+        return None
+
+    proxy = str(proxy).split(",")[0].strip()
+    if len(proxy) == 2:
+        return proxy.lower()
+    # Credentials stay out of the token file
+    parsed = urlparse(proxy if "://" in proxy else f"http://{proxy}")
+    return f"{parsed.hostname}:{parsed.port}"
+
+
+class Token:
+    __slots__ = ("value", "expiry", "refresh", "data")
+
+    def __init__(
+        self,
+        value: str,
+        expiry: object = None,
+        refresh: str = None,
+        data: dict = None,
+        expires_in: float = None,
+    ) -> None:
+        if isinstance(expiry, datetime):
+            expiry = expiry.timestamp()
+        if expires_in is not None:
+            expiry = time.time() + float(expires_in)
+
+        self.value = value
+        # Unix time, or None if the token doesn't expire
+        self.expiry = expiry
+        self.refresh = refresh
+        self.data = data or {}
+
+    def valid(self, margin: float = 0) -> bool:
+        return self.expiry is None or self.expiry - margin > time.time()
+
+    def to_dict(self) -> dict:
+        return {x: getattr(self, x) for x in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Token:
+        return cls(**{x: data.get(x) for x in cls.__slots__})
+
+    def __repr__(self) -> str:
+        return f"Token(expiry={self.expiry}, refresh={self.refresh is not None})"
+
+
+class FileLock:
+    """Exclusive lock between processes, held on a separate lock file"""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.file = None
+
+    def __enter__(self) -> FileLock:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "a+")
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+        return self
+
+    def __exit__(self, *args) -> None:
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        else:
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        self.file.close()
+
+
+class TokenStore:
+    def __init__(self, path: Path = TOKEN_STORE) -> None:
+        self.path = path
+        self.tokens = {}
+        self.locks = {}
+        self.timers = {}
+        # Latest fetch and refresh of every key, so background renewals use a live client
+        self.handlers = {}
+        # Keys used since their last renewal, the only ones refreshed in the background
+        self.used = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(service: str, profile: str = None, region: str = None) -> str:
+        key = f"{service.lower()}:{profile or 'default'}"
+        return f"{key}@{region}" if region else key
+
+    def key_lock(self, key: str) -> threading.Lock:
+        with self.lock:
+            return self.locks.setdefault(key, threading.RLock())
+
+    def read(self) -> dict:
+        try:
+            with self.path.open("r") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    def write(self, key: str, token: Token) -> None:
+        """Merge a token into the file, which the caller has locked"""
+        data = self.read()
+        data[key] = token.to_dict()
+        tmp = self.path.with_suffix(".tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp, self.path)
+
+    def get(
+        self,
+        service: str,
+        fetch: callable,
+        refresh: callable = None,
+        profile: str = None,
+        persist: bool = True,
+        region: str = None,
+    ) -> Token:
+        """
+        Valid token for a service and profile
+
+        `fetch()` returns a new Token, and `refresh(token)` renews one that
+        carries a refresh token. Tokens tied to the running process should
+        set `persist` to False, and tokens tied to a region should pass the
+        `region` of the proxy they're fetched through
+        """
+        key = self.key(service, profile, region)
+        with self.key_lock(key):
+            self.used.add(key)
+            self.handlers[key] = (service, profile, region, fetch, refresh, persist)
+            token = self.tokens.get(key)
+            if token is not None and token.valid(REFRESH_AHEAD):
+                return token
+
+            if not persist:
+                return self.renew(key, token, fetch, refresh, persist)
+
+            with FileLock(self.path.with_suffix(".lock")):
+                # Another process may have renewed it in the meantime
+                stored = self.read().get(key)
+                if stored is not None:
+                    token = Token.from_dict(stored)
+                    if token.valid(REFRESH_AHEAD):
+                        log.debug(f"Using stored token for {key}")
+                        self.tokens[key] = token
+                        self.schedule(key, token)
+                        return token
+
+                return self.renew(key, token, fetch, refresh, persist)
+
+    def renew(
+        self,
+        key: str,
+        token: Token,
+        fetch: callable,
+        refresh: callable,
+        persist: bool,
+    ) -> Token:
+        new = None
+        if token is not None and token.refresh and refresh is not None:
+            try:
+                new = refresh(token)
+                log.debug(f"Refreshed token for {key}")
+            except Exception as e:
+                log.debug(f"Couldn't refresh token for {key}, fetching a new one: {e}")
+
+        if new is None:
+            new = fetch()
+            log.debug(f"Fetched new token for {key}")
+
+        self.tokens[key] = new
+        if persist:
+            self.write(key, new)
+        self.used.discard(key)
+        self.schedule(key, new)
+        return new
+
+    def schedule(self, key: str, token: Token) -> None:
+        with self.lock:
+            timer = self.timers.pop(key, None)
+            if timer is not None:
+                timer.cancel()
+            if token.expiry is None:
+                return
+
+            delay = max(0, token.expiry - REFRESH_AHEAD - time.time())
+            timer = self.timers[key] = threading.Timer(delay, self.background, (key,))
+            timer.daemon = True
+            timer.start()
+
+    def background(self, key: str) -> None:
+        if key not in self.used:
+            return
+
+        # Whoever asked for the token last, rather than the client of the first job
+        service, profile, region, fetch, refresh, persist = self.handlers[key]
+        try:
+            with self.key_lock(key):
+                # Expire it in memory so get() goes through the usual locked renewal
+                token = self.tokens.get(key)
+                if token is not None:
+                    token.expiry = min(token.expiry or 0, time.time())
+            self.get(service, fetch, refresh, profile, persist, region)
+        except Exception as e:
+            log.warning(f"Background refresh of {key} token failed: {e}")
+
+    def invalidate(self, service: str, profile: str = None, region: str = None) -> None:
+        """Forget a token the service has rejected"""
+        key = self.key(service, profile, region)
+        with self.key_lock(key):
+            token = self.tokens.pop(key, None)
+            if token is not None:
+                token.expiry = 0
+                with FileLock(self.path.with_suffix(".lock")):
+                    self.write(key, token)
+
+
+token_store = TokenStore()
+
+
+def cookie_dict(cookies: object) -> dict:
+    """Cookies of a requests or httpx client as a plain dict"""
+    return {x.name: x.value for x in getattr(cookies, "jar", cookies)}
+
+
+# Handshakes that both services and search need
+
+
+PLUTO_BOOT = "https://boot.pluto.tv/v4/start"
+ROKU_CSRF = "https://therokuchannel.roku.com/api/v1/csrf"
+ROKU_CSRF_TTL = 1800
+
+
+def pluto_session(client: object) -> Token:
+    params = {
+        "appName": "web",
+        "appVersion": "na",
+        "clientID": str(uuid.uuid1()),
+        "deviceDNT": 0,
+        "deviceId": "unknown",
+        "clientModelNumber": "na",
+        "serverSideAds": "false",
+        "deviceMake": "unknown",
+        "deviceModel": "web",
+        "deviceType": "web",
+        "deviceVersion": "unknown",
+        "sid": str(uuid.uuid1()),
+        "drmCapabilities": "widevine:L3",
+    }
+    response = client.get(PLUTO_BOOT, params=params)
+    response.raise_for_status()
+
+    session = response.json()
+    token = session["sessionToken"]
+    expiry = jwt_expiry(token)
+    return Token(
+        token,
+        expiry=expiry,
+        expires_in=None if expiry else session.get("refreshInSec", 3600),
+        data={"params": params},
+    )
+
+
+def roku_csrf(client: object) -> Token:
+    response = client.get(ROKU_CSRF)
+    response.raise_for_status()
+
+    # The token is only accepted together with the cookies it was issued with
+    return Token(
+        response.json()["csrf"],
+        expires_in=ROKU_CSRF_TTL,
+        data={"cookies": cookie_dict(client.cookies)},
+    )
@@ -5,30 +5,30 @@ import json
 import logging
 import re
 import shutil
-import xml.etree.ElementTree as ET
 from datetime import datetime, timedelta  # noqa: F811
+from functools import lru_cache
 from pathlib import Path
 
 import click
-import m3u8
 import requests
-from bs4 import BeautifulSoup
 from lxml import etree
 from pywidevine.device import Device, DeviceTypes
 from rich.console import Console
-from subby import (
-    CommonIssuesFixer,
-    ISMTConverter,
-    SAMIConverter,
-    SMPTEConverter,
-    WebVTTConverter,
-    WVTTConverter,
-)
 from unidecode import unidecode
 
+from utils.filenames import compile_template
+from utils.hls import parse_master
+from utils.mpd import MPD, load_mpd, parse_mpd
+from utils.srt import convert_cached
+
 console = Console()
 log = logging.getLogger()
 
+# Filenames of a whole catalog are cleaned again when listing, planning and downloading
+MAX_CLEANED = 65536
+UNSAFE = re.compile(r"[:;/\\*!?¿,'\"<>|$#`’]+")
+REPEATED = re.compile(r"([._ ])\1+")
+
 
 def create_wvd(dir: Path) -> Path:
     """
@@ -139,16 +139,8 @@ def contains_ip_address(input_string):
 
 
 def get_heights(session: requests.Session, manifest: str) -> tuple:
-    r = session.get(manifest)
-    r.raise_for_status()
-
-    soup = BeautifulSoup(r.text, "xml")
-    elements = soup.find_all("Representation")
-    heights = sorted(
-        [int(x.attrs["height"]) for x in elements if x.attrs.get("height")],
-        reverse=True,
-    )
-    return heights, soup
+    mpd = load_mpd(session, manifest)
+    return mpd.heights, mpd
 
 
 def force_numbering(content: list) -> list:
@@ -204,17 +196,38 @@ def update_cache(cache: json, config: dict, download: object) -> None:
         json.dump(cache, f, indent=4)
 
 
+class Transliteration(dict):
+    """Translation table that fills itself from unidecode as characters come up"""
+
+    def __missing__(self, key: int) -> str:
+        value = self[key] = unidecode(chr(key))
+        return value
+
+
+transliteration = Transliteration()
+
+
+@lru_cache(maxsize=MAX_CLEANED)
 def string_cleaning(filename: str) -> str:
-    filename = unidecode(filename)
-    filename = filename.replace("&", "and")
-    filename = re.sub(r"[:;/]", "", filename)
-    filename = re.sub(r"[\\*!?¿,'\"<>|$#`’]", "", filename)
-    filename = re.sub(rf"[{'.'}]{{2,}}", ".", filename)
-    filename = re.sub(rf"[{'_'}]{{2,}}", "_", filename)
-    filename = re.sub(rf"[{' '}]{{2,}}", " ", filename)
+    if not filename.isascii():
+        filename = filename.translate(transliteration)
+    filename = UNSAFE.sub("", filename.replace("&", "and"))
+    if ".." in filename or "__" in filename or "  " in filename:
+        filename = REPEATED.sub(r"\1", filename)
     return filename
 
 
+@lru_cache(maxsize=MAX_CLEANED)
+def clean_filename(filename: str) -> str:
+    # Uncached cleaning, the filename is only kept once
+    filename = string_cleaning.__wrapped__(filename)
+    return (
+        filename.replace(" ", ".").replace(".-.", ".")
+        if filename.count(".") >= 2
+        else filename
+    )
+
+
 def slugify(string: str) -> str:
     string = string.lower()
     string = re.sub(r"\W+", "-", string)
@@ -241,7 +254,7 @@ def set_range(episode: str) -> list:
 
 def set_filename(service: object, stream: object, res: str, audio: str):
     if service.movie:
-        filename = service.config["filename"]["movies"].format(
+        filename = compile_template(service.config["filename"]["movies"]).render(
             title=stream.title,
             year=stream.year or "",
             resolution=f"{res}p" or "",
@@ -249,7 +262,8 @@ def set_filename(service: object, stream: object, res: str, audio: str):
             audio=audio,
         )
     else:
-        filename = service.config["filename"]["series"].format(
+        # Templates drop the S or E of a missing season or episode number
+        filename = compile_template(service.config["filename"]["series"]).render(
             title=stream.title,
             year=stream.year or "",
             season=f"{stream.season:02}" if stream.season > 0 else "",
@@ -260,88 +274,31 @@ def set_filename(service: object, stream: object, res: str, audio: str):
             audio=audio,
         )
 
-        no_ep = r"(S\d+)E"
-        no_sea = r"S(E\d+)"
-        no_num = r"SE"
-        if stream.number == 0:
-            filename = re.sub(no_ep, r"\1", filename)
-        if stream.season == 0:
-            filename = re.sub(no_sea, r"\1", filename)
-        if stream.season == 0 and stream.number == 0:
-            filename = re.sub(no_num, "", filename)
-
-    filename = string_cleaning(filename)
-    return (
-        filename.replace(" ", ".").replace(".-.", ".")
-        if filename.count(".") >= 2
-        else filename
-    )
-
-
-def add_subtitles(soup: object, subtitle: str, language: str = None) -> object:
-    """Add subtitle stream to manifest"""
-
-    lang = language if language else "English"
-
-    adaptation_set = soup.new_tag(
-        "AdaptationSet",
-        id="3",
-        group="3",
-        contentType="text",
-        mimeType="text/vtt",
-        startWithSAP="1",
-    )
-    representation = soup.new_tag("Representation", id=f"{lang}", bandwidth="0")
-    base_url = soup.new_tag("BaseURL")
-    base_url.string = f"{subtitle}"
-
-    adaptation_set.append(representation)
-    representation.append(base_url)
-
-    period = soup.find("Period")
-    period.append(adaptation_set)
-
-    return soup
+    return clean_filename(filename)
 
 
 def convert_subtitles(tmp: Path, filename: str, sub_type: str) -> Path:
-    converters = {
-        "vtt": WebVTTConverter(),
-        "ttml": SMPTEConverter(),
-        "mp4": WVTTConverter(),
-        "dfxp": ISMTConverter(),
-        "sami": SAMIConverter(),
-    }
-
-    converter = converters[sub_type]
-    fixer = CommonIssuesFixer()
-
     file = Path(tmp / f"{filename}.{sub_type}")
-    srt, _ = fixer.from_srt(converter.from_file(file))
     output = Path(tmp / f"{filename}.srt")
-    srt.save(output)
-    return output
+    return convert_cached(file, output, sub_type)
 
 
 def from_mpd(mpd_data: str, url: str = None):
-    root = ET.fromstring(mpd_data)
+    mpd = parse_mpd(mpd_data, url)
     items = []
 
-    for adaptationSet in root.iter("{urn:mpeg:dash:schema:mpd:2011}AdaptationSet"):
-        for representation in adaptationSet.iter(
-            "{urn:mpeg:dash:schema:mpd:2011}Representation"
-        ):
-            if representation.get("mimeType") in ["video/mp4", "audio/mp4"]:
-                item = {}
-                if representation.get("id"):
-                    item["id"] = representation.get("id")
-                if representation.get("codecs"):
-                    item["codecs"] = representation.get("codecs")
-                if representation.get("height"):
-                    item["height"] = representation.get("height")
-                if representation.get("bandwidth"):
-                    item["bandwidth"] = int(representation.get("bandwidth"))
-                items.append(item)
+    for representation in mpd.representations:
+        if representation.mime_type in ["video/mp4", "audio/mp4"]:
+            item = {}
+            if representation.id:
+                item["id"] = representation.id
+            if representation.codecs:
+                item["codecs"] = representation.codecs
+            if representation.height:
+                item["height"] = str(representation.height)
+            if representation.bandwidth:
+                item["bandwidth"] = representation.bandwidth
+            items.append(item)
 
     if url is not None:
         items.insert(0, {"url": url})
@@ -350,16 +307,10 @@ def from_mpd(mpd_data: str, url: str = None):
 
 
 def from_m3u8(m3u8_data: str):
-    heights = []
-    codecs = []
-
-    m3u8_obj = m3u8.loads(m3u8_data)
+    master = parse_master(m3u8_data)
 
-    for playlist in m3u8_obj.playlists:
-        if playlist.stream_info.resolution:
-            heights.append(playlist.stream_info.resolution[1])
-        if playlist.stream_info.codecs:
-            codecs.append(playlist.stream_info.codecs)
+    heights = [x.height for x in master.variants if x.height]
+    codecs = master.codecs
 
     return heights, codecs
 
@@ -384,12 +335,8 @@ def load_xml(xml):
     return root
 
 
-def kid_to_pssh(soup: object) -> str:
-    kid = (
-        soup.select_one("ContentProtection")
-        .attrs.get("cenc:default_KID")
-        .replace("-", "")
-    )
+def kid_to_pssh(mpd: MPD) -> str:
+    kid = mpd.default_kid.replace("-", "")
 
     array_of_bytes = bytearray(b"\x00\x00\x002pssh\x00\x00\x00\x00")
     array_of_bytes.extend(bytes.fromhex("edef8ba979d64acea3c827dcd51d21ed"))
@@ -398,12 +345,8 @@ def kid_to_pssh(soup: object) -> str:
     return base64.b64encode(bytes.fromhex(array_of_bytes.hex())).decode("utf-8")
 
 
-def construct_pssh(soup: object) -> str:
-    kid = (
-        soup.select_one("ContentProtection")
-        .attrs.get("cenc:default_KID")
-        .replace("-", "")
-    )
+def construct_pssh(mpd: MPD) -> str:
+    kid = mpd.default_kid.replace("-", "")
     version = "3870737368"
     system_id = "EDEF8BA979D64ACEA3C827DCD51D21ED"
     data = "48E3DC959B06"